@@ -0,0 +1,101 @@
+"""
+Measures signature size, delta size and time of the rsync steps for a range
+of file sizes, change patterns and block sizes, so that the block size policy
+of SyncClient can be chosen from data. Runs librsync locally, no server is
+involved.
+
+    $ python -m benchmarks.blocksize [file size in KB ...]
+"""
+import os
+import random
+import sys
+import time
+
+import librsync
+
+from smartfile.sync import sqrt_block_size
+
+
+KB = 1024
+
+FILE_SIZES = [4 * KB, 256 * KB, 16 * KB * KB, 256 * KB * KB]
+
+# Fixed block sizes to compare with the policy, None is librsync's default.
+BLOCK_SIZES = [None, 512, 8 * KB, 64 * KB]
+
+
+def append(data):
+    "Data appended to the end, as to a log."
+    return data + os.urandom(max(1, len(data) // 100))
+
+
+def scattered(data):
+    "Small edits spread over the file, as to a database."
+    data = bytearray(data)
+    for i in range(max(1, len(data) // (64 * KB))):
+        offset = random.randrange(len(data))
+        data[offset:offset + 16] = os.urandom(16)
+    return bytes(data)
+
+
+def rewritten(data):
+    "Half of the file rewritten, in a single region."
+    start = len(data) // 4
+    return data[:start] + os.urandom(len(data) // 2) + \
+        data[start + len(data) // 2:]
+
+
+CHANGES = [append, scattered, rewritten]
+
+
+def measure(old, new, block_size):
+    "Returns signature size, delta size and seconds of the three steps."
+    kwargs = {'block_size': block_size} if block_size else {}
+    start = time.time()
+    with open(old, 'rb') as f:
+        signature = librsync.signature(f, **kwargs)
+    signature.seek(0, os.SEEK_END)
+    signature_size = signature.tell()
+    signature.seek(0)
+    with open(new, 'rb') as f:
+        delta = librsync.delta(f, signature)
+    delta.seek(0, os.SEEK_END)
+    delta_size = delta.tell()
+    delta.seek(0)
+    with open(old, 'rb') as f:
+        librsync.patch(f, delta).close()
+    elapsed = time.time() - start
+    signature.close()
+    delta.close()
+    return signature_size, delta_size, elapsed
+
+
+def main(*sizes):
+    sizes = [int(size) * KB for size in sizes] or FILE_SIZES
+    random.seed(0)
+    old, new = 'blocksize.old', 'blocksize.new'
+    print('%10s %10s %10s %10s %10s %8s' % (
+        'file', 'change', 'block', 'signature', 'delta', 'seconds'))
+    try:
+        for size in sizes:
+            data = os.urandom(size)
+            with open(old, 'wb') as f:
+                f.write(data)
+            for change in CHANGES:
+                with open(new, 'wb') as f:
+                    f.write(change(data))
+                policy = sqrt_block_size(size)
+                for label, block_size in [(b or 'default', b)
+                                          for b in BLOCK_SIZES] + \
+                        [('sqrt:%s' % policy, policy)]:
+                    result = measure(old, new, block_size)
+                    print('%10d %10s %10s %10d %10d %8.3f' % (
+                        (size, change.__name__, label) + result))
+    finally:
+        for path in (old, new):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,52 @@
+"""
+Compares calls/sec of the pooled client against the previous behaviour of
+making every call with the module-level requests functions, which opens a
+new connection each time.
+
+    $ python -m benchmarks.pool [calls]
+"""
+import sys
+import time
+
+import requests
+
+from smartfile import BasicClient
+
+from benchmarks.server import BenchmarkServer
+
+
+API_KEY = '8g1aq1UF2QfZTG47yEVhVLAFqyfDdp'
+API_PASSWORD = '3II3UFD3pBAwy3Rbz8mVWBhJTA2Gvd'
+
+
+def unpooled(server, calls):
+    url = server.url + 'api/2/path/info/'
+    for i in range(calls):
+        requests.get(url, auth=(API_KEY, API_PASSWORD)).json()
+
+
+def pooled(server, calls):
+    with BasicClient(API_KEY, API_PASSWORD, url=server.url) as api:
+        for i in range(calls):
+            api.get('/path/info')
+
+
+def measure(func, server, calls):
+    start = time.time()
+    func(server, calls)
+    return calls / (time.time() - start)
+
+
+def main(calls=1000):
+    server = BenchmarkServer()
+    try:
+        before = measure(unpooled, server, calls)
+        after = measure(pooled, server, calls)
+    finally:
+        server.shutdown()
+    print('unpooled: %8.1f calls/sec' % before)
+    print('pooled:   %8.1f calls/sec (%.1fx)' % (after, after / before))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
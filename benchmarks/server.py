@@ -0,0 +1,174 @@
+"""
+Local stand-in for the SmartFile API, used to benchmark the client without
+touching the network. Built on the test server from tests.py.
+"""
+import cgi
+import json
+import os
+import re
+import shutil
+import threading
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+from smartfile.constants import CHUNK_SIZE
+from tests import TestHTTPRequestHandler
+from tests import TestHTTPServer
+
+
+PATH_PATTERN = re.compile(r'^/api/[^/]+/(path/(?:info|data|sync/[a-z]+))'
+                          r'(/.*?)/?$')
+
+
+class KeepAliveRequestHandler(TestHTTPRequestHandler):
+    """
+    Answers every request with a small JSON document, over HTTP/1.1 so that
+    clients may keep their connection alive.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, avoid Nagle/delayed ACK
+    # stalls on kept-alive connections.
+    disable_nagle_algorithm = True
+    timeout = 5
+
+    def record(self, method, path, query=None, data=None):
+        # Don't accumulate requests, benchmarks make a lot of them.
+        return TestHTTPRequestHandler.TestRequest(method, path, query=query,
+                                                  data=data)
+
+    def respond(self, request):
+        self.send_json({'path': request.path})
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BenchmarkRequestHandler(KeepAliveRequestHandler):
+    """
+    Serves the files in server.files (remote path: local path) for info,
+    download and sync delta requests, and discards uploads. Other requests
+    get a small JSON document. If server.throttle_every is set, every n-th
+    request is throttled. Downloads have an ETag, and are answered 304 Not
+    Modified when it matches If-None-Match.
+    """
+    def throttled(self):
+        "Whether to throttle this request."
+        server = self.server
+        if not server.throttle_every:
+            return False
+        with server.lock:
+            server.count += 1
+            return server.count % server.throttle_every == 0
+
+    def send_throttled(self):
+        server = self.server
+        self.send_response(503)
+        self.send_header('X-Throttle', 'throttled; next=%s sec' %
+                         server.throttle_delay)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def discard_body(self):
+        "Reads the request body without keeping it, returns its size."
+        size = 0
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                if not length:
+                    self.rfile.readline()
+                    return size
+                size += length
+                while length:
+                    length -= len(self.rfile.read(min(length, CHUNK_SIZE)))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length', 0))
+        while size < length:
+            size += len(self.rfile.read(min(length - size, CHUNK_SIZE)))
+        return size
+
+    def endpoint(self):
+        m = PATH_PATTERN.match(self.path.split('?')[0])
+        return m.groups() if m else (None, None)
+
+    def send_file(self, path):
+        st = os.stat(path)
+        etag = '"%x-%x"' % (int(st.st_mtime * 1e6), st.st_size)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(st.st_size))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+    def do_GET(self):
+        if self.throttled():
+            return self.send_throttled()
+        endpoint, path = self.endpoint()
+        local = self.server.files.get(path)
+        if endpoint == 'path/info' and local:
+            self.send_json({'path': path, 'isdir': False,
+                            'size': os.path.getsize(local),
+                            'time': '2013-02-23T22:49:30'})
+        elif endpoint == 'path/data' and local:
+            self.send_file(local)
+        else:
+            self.send_json({'path': self.path})
+
+    def do_POST(self):
+        if self.throttled():
+            self.discard_body()
+            return self.send_throttled()
+        endpoint, path = self.endpoint()
+        if endpoint == 'path/sync/delta':
+            return self.send_delta(self.server.files[path])
+        self.send_json({'path': self.path, 'size': self.discard_body()})
+
+    def send_delta(self, local):
+        "Computes the delta of local against the uploaded signature."
+        import librsync
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST'})
+        with open(local, 'rb') as f:
+            delta = librsync.delta(f, form['signature'].file)
+        try:
+            delta.seek(0, os.SEEK_END)
+            length = delta.tell()
+            delta.seek(0)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            shutil.copyfileobj(delta, self.wfile, CHUNK_SIZE)
+        finally:
+            delta.close()
+
+
+class BenchmarkServer(ThreadingMixIn, TestHTTPServer):
+    "Threaded, so that concurrent keep-alive connections are all served."
+    daemon_threads = True
+
+    def __init__(self, handler=BenchmarkRequestHandler, files=None,
+                 throttle_every=0, throttle_delay=0.01, **kwargs):
+        self.files = files or {}
+        self.throttle_every = throttle_every
+        self.throttle_delay = throttle_delay
+        self.count = 0
+        self.lock = threading.Lock()
+        TestHTTPServer.__init__(self, handler, **kwargs)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server_port
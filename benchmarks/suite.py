@@ -0,0 +1,394 @@
+"""
+Benchmarks the client against a local stand-in server, and writes the results
+as JSON, so that they can be compared between versions.
+
+    $ python -m benchmarks.suite [-o results.json] [--compare old.json]
+                                 [--transport name] [suite ...]
+
+The suites are calls (small calls/sec and latency percentiles), transfer
+(upload and download MB/s by file size), throttle (calls/sec while every
+n-th request is throttled), sync (download sync MB/s, which requires
+python-librsync), startup (time to import the package and construct
+clients, in fresh processes), overhead (time the client adds to a call,
+over a MockTransport, without sockets), listing (items/sec of getting and
+decoding a large folder listing with each JSON decoder installed, and with
+iter_children, over a MockTransport) and revalidate (MB/s of downloading an
+unchanged file again, with and without an HTTPCache in memory and on disk).
+The suites using the server send requests over the transport named by
+--transport. With --compare, throughput that dropped or latency or time that
+grew by more than the tolerance is reported, and the exit status is 1.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import smartfile
+from smartfile import BasicClient
+from smartfile import OAuthClient
+from smartfile import jsondecode
+from smartfile.cache import DiskHTTPCache
+from smartfile.cache import HTTPCache
+from smartfile.transport import MockTransport
+from smartfile.transport import TRANSPORTS
+
+from benchmarks.server import BenchmarkServer
+
+
+API_KEY = '8g1aq1UF2QfZTG47yEVhVLAFqyfDdp'
+API_PASSWORD = '3II3UFD3pBAwy3Rbz8mVWBhJTA2Gvd'
+
+KB = 1024
+MB = 1024 * KB
+
+TRANSFER_SIZES = [64 * KB, MB, 16 * MB, 64 * MB]
+SYNC_SIZES = [16 * MB]
+LISTING_ITEMS = 10000
+
+# Transport used by the suites that call the server, set by --transport.
+TRANSPORT = 'requests'
+
+
+def client(server, **kwargs):
+    kwargs.setdefault('transport', TRANSPORT)
+    url = server.url if server else 'http://127.0.0.1/'
+    return BasicClient(API_KEY, API_PASSWORD, url=url, **kwargs)
+
+
+def percentile(values, percent):
+    "The value below which percent of the sorted values fall."
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def write_random(path, size):
+    with open(path, 'wb') as f:
+        for i in range(0, size, MB):
+            f.write(os.urandom(min(MB, size - i)))
+
+
+def bench_calls(root, calls=2000):
+    "Calls/sec and latency of small, sequential calls."
+    server = BenchmarkServer()
+    latencies = []
+    try:
+        with client(server) as api:
+            start = time.time()
+            for i in range(calls):
+                before = time.time()
+                api.get('/path/info', '/foo')
+                latencies.append((time.time() - before) * 1000)
+            elapsed = time.time() - start
+    finally:
+        server.shutdown()
+    latencies.sort()
+    return {'calls': calls, 'calls_per_sec': calls / elapsed,
+            'latency_ms': dict(('p%s' % p, percentile(latencies, p))
+                               for p in (50, 90, 99)),
+            'max_latency_ms': latencies[-1]}
+
+
+def bench_transfer(root, sizes=TRANSFER_SIZES):
+    "Upload and download MB/s by file size."
+    results = {}
+    server = BenchmarkServer()
+    try:
+        with client(server) as api:
+            for size in sizes:
+                local = os.path.join(root, 'transfer-%s' % size)
+                write_random(local, size)
+                server.files['/transfer'] = local
+                start = time.time()
+                with open(local, 'rb') as f:
+                    api.upload('transfer', f)
+                upload = time.time() - start
+                start = time.time()
+                api.download('/transfer', download_to_path=local + '.down')
+                download = time.time() - start
+                results[str(size)] = {
+                    'upload_mb_per_sec': size / MB / upload,
+                    'download_mb_per_sec': size / MB / download}
+                os.remove(local)
+                os.remove(local + '.down')
+    finally:
+        server.shutdown()
+    return results
+
+
+def bench_throttle(root, calls=500, throttle_every=5):
+    "Calls/sec when every throttle_every-th request is throttled."
+    server = BenchmarkServer(throttle_every=throttle_every)
+    try:
+        with client(server) as api:
+            start = time.time()
+            for i in range(calls):
+                api.get('/path/info', '/foo')
+            elapsed = time.time() - start
+    finally:
+        server.shutdown()
+    return {'calls': calls, 'throttle_every': throttle_every,
+            'calls_per_sec': calls / elapsed,
+            'retries': server.count - calls}
+
+
+def bench_sync(root, sizes=SYNC_SIZES):
+    "Throughput of syncing a changed file down."
+    try:
+        from smartfile.sync import SyncClient
+    except ImportError:
+        return {'skipped': 'python-librsync is not installed'}
+    from benchmarks.sync_memory import write_files
+    results = {}
+    server = BenchmarkServer()
+    try:
+        with client(server) as api:
+            for size in sizes:
+                local, server.files['/remote'] = write_files(root, size // MB)
+                sync = SyncClient(api)
+                start = time.time()
+                sync.download(local, '/remote')
+                elapsed = time.time() - start
+                summary = sync.planner.summary()
+                results[str(size)] = {'mb_per_sec': size / MB / elapsed,
+                                      'sent': summary['sent']}
+    finally:
+        server.shutdown()
+    return results
+
+
+# Run in a fresh process, prints the startup times in ms as JSON.
+STARTUP_SCRIPT = """
+import json, time
+start = time.time()
+import smartfile
+times = {'import': time.time() - start}
+start = time.time()
+smartfile.BasicClient()
+times['first_client'] = time.time() - start
+start = time.time()
+for i in range(%(clients)d):
+    smartfile.BasicClient()
+times['client'] = (time.time() - start) / %(clients)d
+start = time.time()
+smartfile.OAuthClient(%(oauth)r, %(oauth)r)
+times['first_oauth_client'] = time.time() - start
+print(json.dumps(dict((k, v * 1000) for k, v in times.items())))
+"""
+
+
+def bench_startup(root, runs=10, clients=100):
+    """Median time to import the package, to construct the first clients
+    (credentials from ~/.netrc) and then each other client."""
+    netrc = os.path.join(root, '.netrc')
+    with open(netrc, 'w') as f:
+        f.write('machine app.smartfile.com\n  login %s\n  password %s\n' % (
+            API_KEY, API_PASSWORD))
+    os.chmod(netrc, 0o600)
+    env = dict((k, v) for k, v in os.environ.items()
+               if not k.startswith('SMARTFILE_'))
+    env['HOME'] = root
+    script = STARTUP_SCRIPT % {'clients': clients, 'oauth': API_KEY}
+    runs = [json.loads(subprocess.check_output(
+        [sys.executable, '-c', script], env=env).decode('utf8'))
+        for i in range(runs)]
+    return {'time_ms': dict((key, percentile(sorted(run[key] for run in runs),
+                                             50))
+                            for key in runs[0])}
+
+
+def respond(request):
+    "Answers every request with an empty JSON object."
+    return 200, {'Content-Type': 'application/json'}, b'{}'
+
+
+def bench_overhead(root, calls=20000):
+    """Microseconds per call of the clients over MockTransport, which only
+    prepares the request, as requests does, and returns a canned response.
+    The time is the overhead of the client."""
+    def per_call(call):
+        start = time.time()
+        for i in range(calls):
+            call()
+        return (time.time() - start) / calls * 1e6
+
+    results = {}
+    oauth = OAuthClient(API_KEY, API_PASSWORD, API_KEY, API_PASSWORD,
+                        url='http://127.0.0.1/',
+                        transport=MockTransport(respond))
+    basic = client(None, transport=MockTransport(respond))
+    for name, api in [('basic', basic), ('oauth', oauth)]:
+        results[name + '_us'] = per_call(
+            lambda: api.get('/path/info', '/foo'))
+        results[name + '_calls_per_sec'] = 1e6 / results[name + '_us']
+    return results
+
+
+def listing(items):
+    "A /path/info response listing items children."
+    children = [{
+        'acl': {'list': True, 'read': True, 'remove': True, 'write': True},
+        'attributes': {}, 'extension': '.txt', 'id': i, 'isdir': False,
+        'isfile': True, 'items': 0, 'mime': 'text/plain',
+        'name': 'file%s.txt' % i, 'owner': None,
+        'path': '/folder/file%s.txt' % i, 'size': i * KB, 'tags': [],
+        'time': '2013-02-23T22:49:30',
+        'url': 'http://127.0.0.1/api/2/path/info/folder/file%s.txt' % i}
+        for i in range(items)]
+    return json.dumps({'path': '/folder', 'isdir': True, 'items': items,
+                       'children': children}).encode('utf8')
+
+
+def bench_listing(root, items=LISTING_ITEMS, runs=20):
+    """Median time to get and decode a listing of items children with each
+    JSON decoder installed, and to iterate over it with iter_children, which
+    parses it incrementally."""
+    body = listing(items)
+
+    def respond(request):
+        return 200, {'Content-Type': 'application/json'}, body
+
+    def timed(call):
+        times = []
+        for i in range(runs):
+            start = time.time()
+            call()
+            times.append((time.time() - start) * 1000)
+        ms = percentile(sorted(times), 50)
+        return {'time_ms': ms, 'items_per_sec': items / ms * 1000}
+
+    results = {'items': items, 'bytes': len(body)}
+    for name in jsondecode.DECODERS:
+        try:
+            jsondecode.get_decoder(name)
+        except NotImplementedError:
+            continue
+        api = client(None, transport=MockTransport(respond),
+                     json_decoder=name)
+        results[name] = timed(lambda: api.get('/path/info', '/folder',
+                                              children=True))
+    api = client(None, transport=MockTransport(respond))
+    results['iter_children'] = timed(lambda: list(api.iter_children(
+        '/folder', page_size=items + 1)))
+    return results
+
+
+def bench_revalidate(root, size=16 * MB, runs=5):
+    """MB/s of downloading an unchanged file again, without a cache and with
+    an HTTPCache in memory or on disk, which turns it into a 304."""
+    local = os.path.join(root, 'revalidate')
+    write_random(local, size)
+    results = {}
+    server = BenchmarkServer(files={'/revalidate': local})
+    caches = [('none', lambda: None),
+              ('memory', lambda: HTTPCache(maxsize=2 * size)),
+              ('disk', lambda: DiskHTTPCache(os.path.join(root, 'cache')))]
+    try:
+        for name, cache in caches:
+            with client(server, http_cache=cache()) as api:
+                api.download('/revalidate', download_to_path=local + '.down')
+                start = time.time()
+                for i in range(runs):
+                    api.download('/revalidate',
+                                 download_to_path=local + '.down')
+                elapsed = time.time() - start
+            results[name] = {'mb_per_sec': size * runs / MB / elapsed}
+    finally:
+        server.shutdown()
+        os.remove(local)
+        os.remove(local + '.down')
+    return results
+
+
+SUITES = {
+    'calls': bench_calls,
+    'transfer': bench_transfer,
+    'throttle': bench_throttle,
+    'sync': bench_sync,
+    'startup': bench_startup,
+    'overhead': bench_overhead,
+    'listing': bench_listing,
+    'revalidate': bench_revalidate,
+}
+
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+def compare(old, new, tolerance):
+    """
+    Lists the throughputs, latency percentiles and times that got worse by
+    more than tolerance. Maximum latency is too noisy to compare.
+    """
+    old = dict(flatten(old['results']))
+    regressions = []
+    for key, value in flatten(new['results']):
+        if not old.get(key):
+            continue
+        change = (value - old[key]) / float(old[key])
+        # Times are either a number or a dict of percentiles.
+        names = key.split('.')
+        if key.endswith('per_sec') and change < -tolerance or \
+                ('latency_ms' in names or 'time_ms' in names) and \
+                change > tolerance:
+            regressions.append((key, old[key], value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help='one of %s, all by default' %
+                        ', '.join(sorted(SUITES)))
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('--compare', help='results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--transport', default='requests',
+                        choices=sorted(TRANSPORTS))
+    args = parser.parse_args(argv)
+    global TRANSPORT
+    TRANSPORT = args.transport
+    for name in args.suites:
+        if name not in SUITES:
+            parser.error('unknown suite: %s' % name)
+    root = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name in args.suites or sorted(SUITES):
+            sys.stderr.write('%s...\n' % name)
+            results[name] = SUITES[name](root)
+    finally:
+        shutil.rmtree(root)
+    report = {'version': smartfile.__version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'date': datetime.datetime.utcnow().isoformat() + 'Z',
+              'transport': args.transport,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for key, value in flatten(results):
+        print('%-40s %12.2f' % (key, value))
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for key, before, after, change in regressions:
+            print('REGRESSION %s: %.2f -> %.2f (%+.0f%%)' % (
+                key, before, after, change * 100))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
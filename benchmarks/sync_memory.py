@@ -0,0 +1,71 @@
+"""
+Measures the peak memory (RSS) of syncing files of growing size, to show that
+it does not grow with the size of the file or of its delta. Requires
+python-librsync, which the local server uses to compute deltas.
+
+Each sync downloads a remote file that differs from the local copy by one
+changed block per megabyte, and runs in a fresh process so that its peak RSS
+can be measured on its own.
+
+    $ python -m benchmarks.sync_memory [size in MB ...]
+"""
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from smartfile import BasicClient
+from smartfile.sync import SyncClient
+
+from benchmarks.server import BenchmarkServer
+
+
+API_KEY = '8g1aq1UF2QfZTG47yEVhVLAFqyfDdp'
+API_PASSWORD = '3II3UFD3pBAwy3Rbz8mVWBhJTA2Gvd'
+
+MB = 1024 * 1024
+
+
+def write_files(root, size):
+    "Writes a local file, and a remote one with a block changed per MB."
+    local = os.path.join(root, 'local')
+    remote = os.path.join(root, 'remote')
+    with open(local, 'wb') as lf, open(remote, 'wb') as rf:
+        for i in range(size):
+            chunk = os.urandom(MB)
+            lf.write(chunk)
+            rf.write(os.urandom(4096) + chunk[4096:])
+    return local, remote
+
+
+def child(url, local):
+    "Syncs local with the remote file, prints the peak RSS in KB."
+    with BasicClient(API_KEY, API_PASSWORD, url=url) as api:
+        SyncClient(api).download(local, '/remote')
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main(*sizes):
+    sizes = [int(size) for size in sizes] or [16, 64, 256]
+    root = tempfile.mkdtemp()
+    server = BenchmarkServer()
+    try:
+        print('%8s %12s' % ('size MB', 'peak RSS MB'))
+        for size in sizes:
+            local, server.files['/remote'] = write_files(root, size)
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.sync_memory', '--child',
+                server.url, local])
+            print('%8d %12.1f' % (size, int(output.split()[-1]) / 1024.0))
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:])
+    else:
+        main(*sys.argv[1:])
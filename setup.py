@@ -39,6 +39,9 @@ setup(
     description='A Python client for the SmartFile API.',
     long_description=long_description,
     install_requires=required,
+    extras_require={
+        'http2': ['httpx[http2]'],
+    },
     author='SmartFile',
     author_email='tech@smartfile.com',
     maintainer='Ben Timby',
@@ -1,10 +1,12 @@
+import base64
 import os
+import posixpath
 import re
 import shutil
+import threading
 import time
 import urllib
 
-from netrc import netrc
 try:
     import urlparse
     # Fixed pyflakes warning...
@@ -12,9 +14,14 @@ try:
 except ImportError:
     from urllib import parse as urlparse
 
-import requests
+from requests.auth import AuthBase
 from requests.exceptions import RequestException
 
+from smartfile import jsondecode
+from smartfile import transport as transports
+from smartfile.retry import RetryPolicy
+from smartfile.retry import rewinder
+from smartfile.multipart import MultipartEncoder
 from smartfile.errors import APIError
 from smartfile.errors import RequestError
 from smartfile.errors import ResponseError
@@ -27,6 +34,93 @@ API_URL = 'https://app.smartfile.com/'
 
 THROTTLE_PATTERN = re.compile('^.*; next=([\d\.]+) sec$')
 HTTP_USER_AGENT = 'SmartFile Python API client v{0}'.format(__version__)
+HTTP_METHODS = ('get', 'put', 'post', 'delete', 'head', 'options', 'patch')
+SAFE_METHODS = ('get', 'head', 'options')
+SLASHES = re.compile('/{2,}')
+
+# Number of endpoint URLs kept by a client.
+MAX_ROUTES = 1024
+
+# Connection pool defaults. pool_connections is the number of hosts for which
+# a pool is kept, pool_maxsize is the number of connections kept per host.
+# Pooled connections idle for longer than keepalive_timeout seconds are
+# discarded, as the server will most likely have closed them already.
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_KEEPALIVE_TIMEOUT = 60
+
+# Number of files transferred concurrently by the bulk transfer methods. Keep
+# this at or below pool_maxsize, so that every worker has a connection.
+DEFAULT_TRANSFER_WORKERS = 4
+
+# Size of the byte ranges fetched by segmented downloads.
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Number of children requested per page when listing a folder.
+DEFAULT_PAGE_SIZE = 1000
+
+# Number of paths sent per request by the bulk move and remove methods.
+DEFAULT_BATCH_SIZE = 500
+
+
+_netrc_cache = {}
+_netrc_lock = threading.Lock()
+
+
+def netrc_authenticators(host, netrcfile=None):
+    """Looks up the (login, account, password) of host in a netrc file,
+    ~/.netrc by default. Returns None if there is no such entry or file. A
+    file is parsed once per process, and again only if it is modified."""
+    path = netrcfile or os.path.join(os.path.expanduser('~'), '.netrc')
+    try:
+        mtime = os.stat(path).st_mtime
+    except EnvironmentError:
+        return None
+    # The default file is resolved on every call, as $HOME may change.
+    key = (path, netrcfile is None)
+    with _netrc_lock:
+        cached = _netrc_cache.get(key)
+        if cached is None or cached[0] != mtime:
+            from netrc import netrc, NetrcParseError
+            try:
+                # Passed as None, the default file is checked to be private.
+                rc = netrc(netrcfile)
+            except (EnvironmentError, NetrcParseError):
+                rc = None
+            cached = _netrc_cache[key] = (mtime, rc)
+    return cached[1] and cached[1].authenticators(host)
+
+
+def load_oauth():
+    """Imports OAuth support on first use, so that it is only paid for by
+    OAuth clients. Returns requests_oauthlib's OAuth1."""
+    try:
+        from requests_oauthlib import OAuth1
+    except ImportError:
+        raise NotImplementedError('You must install oauthlib and '
+                                  'requests_oauthlib to use the OAuthClient. '
+                                  'Try "pip install requests_oauthlib" to '
+                                  'install both.')
+    return OAuth1
+
+
+def oauth1(*args, **kwargs):
+    "Builds the OAuth1 authentication of a request, signed in plaintext."
+    kwargs.setdefault('signature_method', 'PLAINTEXT')
+    return load_oauth()(*args, **kwargs)
+
+
+class BasicAuth(AuthBase):
+    "HTTP basic authentication, whose header is built once."
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.header = 'Basic ' + base64.b64encode(
+            ('%s:%s' % (username, password)).encode('latin1')).decode('ascii')
+
+    def __call__(self, request):
+        request.headers['Authorization'] = self.header
+        return request
 
 
 def clean_tokens(*args):
@@ -41,27 +135,160 @@ def clean_tokens(*args):
 
 
 class Client(object):
-    """Base API client, handles communication, retry, versioning etc."""
-    def __init__(self, url=None, version=__major__, throttle_wait=True):
+    """Base API client, handles communication, retry, versioning etc.
+
+    Requests are made over a persistent, thread-safe connection pool, so
+    keep-alive connections are reused between calls. Call close() (or use the
+    client as a context manager) to release the pooled connections.
+
+    Path info may be cached by passing a MetadataCache as info_cache. The
+    client drops the cached info of paths it changes.
+
+    GET responses with validators, such as path info and downloads, may be
+    cached by passing a cache.HTTPCache or cache.DiskHTTPCache as
+    http_cache. They are revalidated by every request, and served from the
+    cache when the server answers that they are not modified.
+
+    Requests may be paced by passing a RateLimiter as rate_limiter, or True
+    to share one limiter with all clients using the same account and host.
+
+    Failed requests are retried as decided by retry_policy, by default a
+    RetryPolicy retrying idempotent requests up to 3 times.
+
+    Requests may be instrumented by passing a list of metrics.Hooks, such as
+    a MetricsCollector, as hooks.
+
+    Requests are sent by transport, a transport.Transport or the name of one
+    of transport.TRANSPORTS: requests (the default), urllib3 or http2.
+
+    Compressed responses, and optionally uploads, may be negotiated by
+    passing a compression.Compression as compression, or True for the
+    default one, which compresses responses only.
+
+    JSON responses are decoded by json_decoder, the name of one of
+    jsondecode.DECODERS or a function decoding bytes. By default the fastest
+    decoder installed is used."""
+    def __init__(self, url=None, version=__major__, throttle_wait=True,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 info_cache=None, rate_limiter=None, retry_policy=None,
+                 hooks=None, transport=None, compression=None,
+                 json_decoder=None, http_cache=None):
         self.url = url or os.environ.get('SMARTFILE_API_URL') or API_URL
         self.version = version
         self.throttle_wait = throttle_wait
-
-    def _do_request(self, request, url, **kwargs):
-        "Actually makes the HTTP request."
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keepalive_timeout = keepalive_timeout
+        self.info_cache = info_cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or self._default_retry_policy()
+        self.hooks = list(hooks or ())
+        if compression is True:
+            from smartfile.compression import Compression
+            compression = Compression()
+        self.compression = compression
+        self.json_decoder = json_decoder
+        self.http_cache = http_cache
+        self.transport = transports.create(
+            transport, pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize, pool_block=pool_block,
+            keepalive_timeout=keepalive_timeout)
+        self._tasks_lock = threading.Lock()
+        self._routes = {}
+        self._auth = None
+        self._tasks = None
+
+    def _default_retry_policy(self):
+        return RetryPolicy()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def session(self):
+        "The pooled requests session of the default transport."
+        return self.transport.session
+
+    @property
+    def tasks(self):
+        "The TaskTracker polling the tasks started by this client."
+        with self._tasks_lock:
+            if self._tasks is None:
+                from smartfile.tasks import TaskTracker
+                self._tasks = TaskTracker(self)
+            return self._tasks
+
+    def _task(self, response):
+        "Wraps the response of an operation that started a task."
+        if isinstance(response, dict) and 'uuid' in response:
+            from smartfile.tasks import Task
+            return Task(response, self.tasks)
+        return response
+
+    def close(self):
+        "Closes all pooled connections. The client may still be used after."
+        self.transport.close()
+
+    def _do_request(self, method, url, decode=True, event=None,
+                    compression=None, **kwargs):
+        """Actually makes the HTTP request. Unless decode is False, a JSON
+        response is decoded. event is the attempt reported to the hooks, the
+        body of an encoded response is decoded and counted by compression."""
+        key = self._cache_key(method, url, kwargs)
+        cached = None if key is None else self._revalidate(key, kwargs)
         try:
-            response = request(url, stream=True, **kwargs)
+            response = self.transport.request(method, url, **kwargs)
+            # Hooks are told of a revalidated response as it was received.
+            status = response.status_code
+            if key is not None:
+                response = self._cache_response(key, response, cached)
         except RequestException as e:
+            if cached is not None:
+                cached[1].close()
             raise RequestError(e)
         else:
+            if compression is not None or event is not None:
+                from smartfile.metrics import ObservedBody
+            if compression is not None and response.headers.get(
+                    'Content-Encoding', 'identity') != 'identity':
+                raw = response.raw
+                raw.decode_content = True
+                response.raw = ObservedBody(raw, lambda size: (
+                    compression.decoded(size, raw.tell())))
+            if event is not None:
+                length = response.request.headers.get('Content-Length')
+                self._response_headers(event, status,
+                                       int(length) if length else None)
+                response.raw = ObservedBody(
+                    response.raw, lambda size: self._body_done(event, size))
             if response.status_code >= 400:
-                raise ResponseError(response)
+                # The error reads the body, the connection can be reused.
+                error = ResponseError(response)
+                response.close()
+                raise error
         # Try to return the response in the most useful fashion given it's
         # type.
-        if response.headers.get('content-type') == 'application/json':
+        if not decode:
+            return response
+        elif response.headers.get('content-type') == 'application/json':
+            # Read the whole body, so that the connection goes back to the
+            # pool now, and a failure to read it can be retried.
+            try:
+                content = response.content
+            except RequestException as e:
+                raise RequestError(e)
+            finally:
+                response.close()
+            decoder = self._decoder()
             try:
                 # Try to decode as JSON
-                return response.json()
+                return decoder(content)
             except (TypeError, ValueError):
                 # If that fails, return the text.
                 return response.text
@@ -72,59 +299,252 @@ class Client(object):
             else:
                 return response
 
+    def _cache_key(self, method, url, kwargs):
+        "The key of a request in http_cache, None if it is not cached."
+        if self.http_cache is None or method != 'get' or \
+                'Range' in kwargs.get('headers', {}):
+            return None
+        from smartfile.cache import params_key
+        params = kwargs.get('params') or {}
+        return (self._account(), url, params_key(params))
+
+    def _revalidate(self, key, kwargs):
+        """Returns the cached headers and body of a request, whose validators
+        are sent with it, or None."""
+        cached = self.http_cache.get(key)
+        if cached is not None:
+            validators = dict((name.lower(), value)
+                              for name, value in cached[0])
+            headers = kwargs['headers'] = dict(kwargs.get('headers') or {})
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last-modified' in validators:
+                headers['If-Modified-Since'] = validators['last-modified']
+        return cached
+
+    def _cache_response(self, key, response, cached):
+        """Serves a response that was not modified from the cache, or stores
+        a cacheable one as its body is read."""
+        from smartfile.cache import StoringBody, cacheable, stored_headers
+        if cached is not None:
+            if response.status_code == 304:
+                # Read the empty body, so that the connection can be reused.
+                response.content
+                response.close()
+                return transports.make_response(response.request, 200,
+                                                *cached)
+            cached[1].close()
+        if cacheable(response.status_code, response.headers):
+            response.raw = StoringBody(response.raw, self.http_cache.writer(
+                key, stored_headers(response.headers)))
+        return response
+
+    def _decoder(self):
+        "The function decoding JSON bodies, given by json_decoder."
+        if callable(self.json_decoder):
+            return self.json_decoder
+        return jsondecode.get_decoder(self.json_decoder)
+
+    def _url(self, endpoint, id=None):
+        "Builds the URL of an endpoint, optionally for the given object ID."
+        key = (self.url, self.version, endpoint)
+        url = self._routes.get(key)
+        if url is None:
+            if len(self._routes) >= MAX_ROUTES:
+                self._routes.clear()
+            url = self._routes[key] = self.url + SLASHES.sub(
+                '/', 'api/%s/%s/' % (self.version, endpoint))
+        # If we received an ID, append it to the path.
+        if id:
+            id = SLASHES.sub('/', str(id).lstrip('/'))
+            url += id if not id or id.endswith('/') else id + '/'
+        return url
+
     def _request(self, method, endpoint, id=None, **kwargs):
         "Handles retrying failed requests and error handling."
-        request = getattr(requests, method, None)
-        if not callable(request):
+        if method not in HTTP_METHODS:
             raise RequestError('Invalid method %s' % method)
-        # Find files, separate them out to correct kwarg for requests.
-        data = kwargs.get('data')
-        if data:
-            files = {}
-            for name, value in list(data.items()):
-                # Value might be a file-like object (with a read method), or it
-                # might be a (filename, file-like) tuple.
-                if hasattr(value, 'read') or isinstance(value, tuple):
-                    files[name] = data.pop(name)
-            if files:
-                kwargs.setdefault('files', {}).update(files)
-        path = ['api', self.version, endpoint]
-        # If we received an ID, append it to the path.
-        if id:
-            path.append(str(id))
-        # Join fragments into a URL
-        path = '/'.join(path)
-        if not path.endswith('/'):
-            path += '/'
-        while '//' in path:
-            path = path.replace('//', '/')
-        url = self.url + path
+        progress = kwargs.pop('progress', None)
+        compress = kwargs.pop('compress', None)
         # Add our user agent.
         kwargs.setdefault('headers', {}).setdefault('User-Agent',
                                                     HTTP_USER_AGENT)
-        # Now try the request, if we get throttled, sleep and try again.
-        trys, retrys = 0, 3
+        # Find files, if there are any the data is sent as a multipart body
+        # which is streamed, reading the files a chunk at a time.
+        data, body = kwargs.get('data'), None
+        if hasattr(data, 'read'):
+            # A file sent as the body, as is.
+            body = data
+        elif data:
+            # Value might be a file-like object (with a read method), or it
+            # might be a (filename, file-like) tuple.
+            if any(hasattr(value, 'read') or isinstance(value, tuple)
+                   for value in data.values()):
+                fields = sorted(data.items(), key=lambda f: isinstance(
+                    f[1], tuple) or hasattr(f[1], 'read'))
+                body = MultipartEncoder(fields, callback=progress)
+                kwargs['data'] = body
+                kwargs['headers']['Content-Type'] = body.content_type
+        # compress overrides the compression of the client for this call.
+        compression = self.compression
+        if compress is False:
+            kwargs['headers'].setdefault('Accept-Encoding', 'identity')
+            compression = None
+        elif compress and compression is None:
+            from smartfile.compression import Compression
+            compression = Compression()
+        if compression is not None:
+            kwargs['compression'] = compression
+            kwargs['headers'].setdefault('Accept-Encoding',
+                                         compression.accept)
+            if body is not None and (compress or compress is None and
+                                     compression.upload):
+                body = kwargs['data'] = compression.compress(body)
+                kwargs['headers']['Content-Encoding'] = \
+                    compression.upload_encoding
+        url = self._url(endpoint, id)
+        try:
+            return self._send(method, url, body, endpoint.strip('/'),
+                              **kwargs)
+        finally:
+            if self.info_cache is not None and method not in SAFE_METHODS \
+                    and endpoint.strip('/').startswith('path/'):
+                self._invalidate(id, data)
+
+    def _account(self):
+        """Identifies the account requests are made as, for rate limiting and
+        caching."""
+        return None
+
+    def _limiter(self):
+        if self.rate_limiter is True:
+            from smartfile.ratelimit import RateLimiter
+            return RateLimiter.shared(urlparse.urlparse(self.url).netloc,
+                                      self._account())
+        return self.rate_limiter
+
+    def _throttle_delay(self, error):
+        "The seconds a throttled request asks to wait, None if not throttled."
+        m = isinstance(error, ResponseError) and error.status_code == 503 \
+            and THROTTLE_PATTERN.match(
+                error.response.headers.get('x-throttle', ''))
+        return float(m.group(1)) if m else None
+
+    def _retry(self, method, error, attempt, started, limiter, rewind):
+        """Returns the number of seconds to wait before sending a failed
+        request again, or raises if it should not be sent again."""
+        policy = self.retry_policy
+        elapsed = time.time() - started
+        throttle = self._throttle_delay(error)
+        if throttle is not None:
+            if limiter is not None:
+                limiter.throttled(throttle)
+            if not self.throttle_wait:
+                raise error
+            # A throttled request was not processed, so it is retried
+            # whatever the method. The limiter holds back the next request.
+            delay = 0 if limiter is not None else throttle
+            if attempt >= policy.max_attempts or \
+                    not policy.within_budget(elapsed, delay):
+                raise RequestError('Could not complete request after %s '
+                                   'trys.' % attempt)
+        else:
+            delay = policy.delay(method, error, attempt, elapsed)
+            if delay is None:
+                raise error
+        if rewind is None:
+            # The body was a stream, and has been consumed.
+            raise error
+        return delay
+
+    def _send(self, method, url, body=None, endpoint=None, **kwargs):
+        "Sends a request, if it fails (or we get throttled) try again."
+        limiter = self._limiter()
+        rewind = rewinder(body)
+        started, attempt = time.time(), 0
         while True:
-            if trys == retrys:
-                raise RequestError('Could not complete request after %s trys.'
-                                   % trys)
-            trys += 1
+            attempt += 1
+            event = None
+            if self.hooks:
+                event = {'method': method, 'endpoint': endpoint, 'url': url,
+                         'attempt': attempt}
+            if rewind is not None:
+                rewind()
+            if limiter is not None:
+                waited = limiter.acquire()
+                if waited and event is not None:
+                    self._throttle_sleep(event, waited)
+            if event is not None:
+                self._request_started(event)
             try:
-                return self._do_request(request, url, **kwargs)
-            except ResponseError as e:
-                if self.throttle_wait and e.status_code == 503:
-                    m = THROTTLE_PATTERN.match(
-                        e.response.headers.get('x-throttle', ''))
-                    if m:
-                        time.sleep(float(m.group(1)))
-                        continue
-                # Failed for a reason other than throttling.
-                raise
+                response = self._do_request(method, url, event=event,
+                                            **kwargs)
+            except (RequestError, ResponseError) as e:
+                delay = self._retry(method, e, attempt, started, limiter,
+                                    rewind)
+                if event is not None:
+                    self._retried(event, e, delay)
+                time.sleep(delay)
+                continue
+            if limiter is not None:
+                limiter.success()
+            return response
+
+    def _emit(self, name, event):
+        for hook in self.hooks:
+            getattr(hook, name)(event)
+
+    def _request_started(self, event):
+        event['started'] = time.time()
+        self._emit('request_started', event)
+
+    def _response_headers(self, event, status, bytes_sent):
+        event.update(status=status, bytes_sent=bytes_sent,
+                     headers_elapsed=time.time() - event['started'])
+        self._emit('response_headers', event)
+
+    def _body_done(self, event, bytes_received):
+        event.update(bytes_received=bytes_received,
+                     elapsed=time.time() - event['started'])
+        self._emit('body_done', event)
+
+    def _retried(self, event, error, delay):
+        event.update(error=error, delay=delay)
+        self._emit('retry', event)
+        if delay and self._throttle_delay(error) is not None:
+            self._throttle_sleep(event, delay)
+
+    def _throttle_sleep(self, event, seconds):
+        event['sleep'] = seconds
+        self._emit('throttle_sleep', event)
+
+    def _invalidate(self, id, data):
+        "Drops cached info of the paths changed by a request."
+        paths = [str(id)] if id else []
+        for name, value in (data or {}).items():
+            if name in ('path', 'src', 'dst'):
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                paths.extend(value)
+            elif isinstance(value, tuple):
+                # An uploaded (filename, file-like) tuple.
+                paths.append(posixpath.join(str(id or '/'), value[0]))
+        for path in paths:
+            self.info_cache.invalidate(path)
 
     def __call__(self, *args, **kwargs):
         return self.get(*args, **kwargs)
 
     def get(self, endpoint, id=None, **kwargs):
+        if self.info_cache is not None and \
+                endpoint.strip('/') == 'path/info':
+            key = self.info_cache.key(id, kwargs)
+            info = self.info_cache.get(key)
+            if info is None:
+                info = self._request('get', endpoint, id=id, params=kwargs)
+                if isinstance(info, dict):
+                    self.info_cache.set(key, info)
+            return info
         return self._request('get', endpoint, id=id, params=kwargs)
 
     def put(self, endpoint, id=None, **kwargs):
@@ -137,22 +557,134 @@ class Client(object):
         return self._request('delete', endpoint, id=id, data=kwargs)
 
     def remove(self, deletefile):
+        """ Removes a path. Returns a Task, which may be waited for. """
         try:
-            return self.post('/path/oper/remove', path=deletefile)
+            return self._task(self.post('/path/oper/remove', path=deletefile))
         except KeyError:
             raise Exception("Destination file does not exist")
 
-    def upload(self, filename, fileobj):
+    def _batched(self, oper, items, batch_size, workers):
+        """ Calls oper(paths, dst) for batches of up to batch_size of the
+        (path, dst) items, grouped by dst, on a pool of workers. Returns a
+        TransferResult per item, in order, holding the result of its batch. """
+        from smartfile import transfer
+        groups = {}
+        for index, (path, dst) in enumerate(items):
+            groups.setdefault(dst, []).append(index)
+        batches = []
+        for dst, indexes in sorted(groups.items(), key=lambda g: g[1][0]):
+            for i in range(0, len(indexes), batch_size):
+                batches.append((indexes[i:i + batch_size], dst))
+
+        def call(indexes, dst):
+            return oper([items[i][0] for i in indexes], dst)
+        results = [None] * len(items)
+        for batch in transfer.run(call, batches, workers):
+            for i in batch.remote:
+                results[i] = transfer.TransferResult(
+                    items[i][0], items[i][1], batch.result, batch.error)
+        return results
+
+    def remove_many(self, paths, batch_size=DEFAULT_BATCH_SIZE,
+                    workers=DEFAULT_TRANSFER_WORKERS):
+        """ Removes paths, sending batch_size paths per request, up to
+        workers requests at a time. Returns a TransferResult per path whose
+        result is the Task removing it. A failed batch does not stop the
+        others. """
+        def remove(batch, dst):
+            return self._task(self.post('/path/oper/remove', path=batch))
+        return self._batched(remove, [(path, None) for path in paths],
+                             batch_size, workers)
+
+    def move_many(self, pairs, batch_size=DEFAULT_BATCH_SIZE,
+                  workers=DEFAULT_TRANSFER_WORKERS):
+        """ Moves paths into folders. pairs is an iterable of (src_path,
+        dst_path) pairs, those with the same destination are moved in
+        batches of batch_size paths, up to workers requests at a time.
+        Returns a TransferResult per pair whose result is the Task moving
+        it. A failed batch does not stop the others. """
+        def move(batch, dst):
+            return self._task(self.post('/path/oper/move/', src=batch,
+                                        dst=dst))
+        pairs = [(self._oper_path(src), self._oper_path(dst))
+                 for src, dst in pairs]
+        return self._batched(move, pairs, batch_size, workers)
+
+    def upload(self, filename, fileobj, progress=None, compress=None):
+        """ Uploads fileobj, which is read and sent a chunk at a time. It may
+        also be an iterable of bytes, of unknown length. progress is called
+        with the MultipartEncoder after each chunk, to report progress.
+        compress, if not None, overrides whether the client compresses the
+        upload. """
         if filename.endswith('/'):
             filename = filename[:-1]
         arg = (filename, fileobj)
-        return self.post('/path/data/', file=arg)
-
-    def download(self, file_to_be_downloaded, perform_download=True, download_to_path=None):
+        return self._request('post', '/path/data/', data={'file': arg},
+                             progress=progress, compress=compress)
+
+    def _upload_to(self, remote, local):
+        "Uploads a local path or file-like object to a full remote path."
+        from smartfile import transfer
+        folder, name = posixpath.split(transfer.remote_path(remote))
+        if hasattr(local, 'read'):
+            return self.post('/path/data/', folder, file=(name, local))
+        with open(local, 'rb') as f:
+            return self.post('/path/data/', folder, file=(name, f))
+
+    def upload_many(self, files, workers=DEFAULT_TRANSFER_WORKERS,
+                    create_folders=True):
+        """ Uploads files concurrently. files is an iterable of (remote_path,
+        local) pairs, where local is a path or a file-like object. The remote
+        folders are created first, once each. Returns a TransferResult per
+        file, a failed upload does not stop the others. """
+        from smartfile import transfer
+
+        def mkdir(path, local):
+            return self.post('/path/oper/mkdir/', path=path)
+        files = list(files)
+        if create_folders:
+            for level in transfer.folder_levels(f[0] for f in files):
+                # Folders may already exist, failures to create them are
+                # reported by the uploads into them.
+                transfer.run(mkdir, [(path, None) for path in level], workers)
+        return transfer.run(self._upload_to, files, workers)
+
+    def upload_tree(self, local_root, remote_root='/', **kwargs):
+        """ Uploads all files below local_root into remote_root, keeping the
+        directory structure. Accepts the arguments of upload_many. """
+        from smartfile import transfer
+
+        def walk():
+            for dirpath, dirnames, filenames in os.walk(local_root):
+                for filename in sorted(filenames):
+                    local = os.path.join(dirpath, filename)
+                    relpath = os.path.relpath(local, local_root)
+                    yield (transfer.remote_path(remote_root,
+                                                *relpath.split(os.sep)),
+                           local)
+        return self.upload_many(walk(), **kwargs)
+
+    def download(self, file_to_be_downloaded, perform_download=True,
+                 download_to_path=None, workers=None,
+                 segment_size=DEFAULT_SEGMENT_SIZE, compress=None):
         """ file_to_be_downloaded is a file-like object that has already
-        been uploaded, you cannot download folders """
-        response = self.get(
-            '/path/data/', file_to_be_downloaded, raw=False)
+        been uploaded, you cannot download folders.
+
+        If workers is given, the file is fetched in segments of segment_size
+        bytes, by that many concurrent Range requests. Such a download is
+        resumed if it is repeated after being interrupted. Segments are never
+        compressed, otherwise compress, if not None, overrides whether the
+        client asks for a compressed download. """
+        if workers and perform_download:
+            if not download_to_path:
+                download_to_path = file_to_be_downloaded.split("/")[-1]
+            from smartfile.segmented import SegmentedDownload
+            return SegmentedDownload(self, file_to_be_downloaded,
+                                     download_to_path, workers,
+                                     segment_size).run()
+        response = self._request('get', '/path/data/',
+                                 id=file_to_be_downloaded,
+                                 params={'raw': False}, compress=compress)
         if not perform_download:
             # The caller can decide how to process the download of the data
             return response
@@ -160,23 +692,122 @@ class Client(object):
             download_to_path = file_to_be_downloaded.split("/")[-1]
         # download uses shutil.copyfileobj to download, which copies
         # the data in chunks
-        o = open(download_to_path, 'wb')
-        return shutil.copyfileobj(response.raw, o)
+        with open(download_to_path, 'wb') as o:
+            return shutil.copyfileobj(response.raw, o)
+
+    def iter_children(self, path, page_size=DEFAULT_PAGE_SIZE):
+        """ Yields the info of the children of a remote folder. The listing is
+        fetched a page at a time, and each page is parsed as it is received,
+        so that memory use does not grow with the size of the folder.
+
+        The listing ends at the last page, according to the number of pages
+        in the response, or the folder's number of items. Without those, it
+        ends at an empty page, as the server may send fewer children than
+        page_size. A page starting with the same child as the previous one
+        also ends it, as the server then ignores the page asked for. """
+        from smartfile import jsonstream
+        page, total, first = 1, 0, None
+        while True:
+            response = self._request('get', '/path/info', id=path,
+                                     params={'children': True, 'page': page,
+                                             'limit': page_size},
+                                     decode=False)
+            members = {}
+            try:
+                response.raw.decode_content = True
+                count = 0
+                for info in jsonstream.iter_items(response.raw, 'children',
+                                                  members=members):
+                    if not count:
+                        if info == first:
+                            return
+                        first = info
+                    count += 1
+                    yield info
+            finally:
+                response.close()
+            total += count
+            if not count or page >= members.get('pages', page + 1) or \
+                    total >= members.get('items', total + 1):
+                break
+            page += 1
+
+    def _list(self, path):
+        "Lists the info of the children of a remote folder."
+        return list(self.iter_children(path))
+
+    def _download_to(self, info, local):
+        """Downloads a remote file (given its info) to a local path, unless
+        the local file's size and mtime show that it is up to date."""
+        from smartfile import transfer
+        if transfer.is_current(info, local):
+            return False
+        response = self.get('/path/data/', info['path'], raw=False)
+        try:
+            transfer.write_atomic(response.raw, local,
+                                  transfer.parse_time(info['time']))
+        finally:
+            response.close()
+        return True
+
+    def walk_tree(self, remote_root, workers=DEFAULT_TRANSFER_WORKERS):
+        """ Lists everything below remote_root. The tree is listed a level
+        at a time, the folders of each level concurrently. Returns the info
+        of each file and folder, keyed by its path relative to remote_root,
+        using / as separator. """
+        from smartfile import transfer
+        remote_root = transfer.remote_path(remote_root)
+        infos, folders = {}, [remote_root]
+        with transfer.ThreadPoolExecutor(max_workers=workers) as pool:
+            while folders:
+                listings = list(pool.map(self._list, folders))
+                folders = []
+                for listing in listings:
+                    for info in listing:
+                        relpath = posixpath.relpath(info['path'], remote_root)
+                        infos[relpath] = info
+                        if info['isdir']:
+                            folders.append(info['path'])
+        return infos
+
+    def download_tree(self, remote_root, local_root,
+                      workers=DEFAULT_TRANSFER_WORKERS):
+        """ Downloads all files below remote_root into local_root, keeping
+        the directory structure. Files are written atomically and get the
+        remote mtime, files whose size and mtime already match are skipped.
+        Returns a TransferResult per file, a failed download does not stop
+        the others. """
+        from smartfile import transfer
+        transfer.makedirs(local_root)
+        infos, files = {}, []
+        for relpath, info in sorted(self.walk_tree(remote_root,
+                                                   workers).items()):
+            local = os.path.join(local_root, *relpath.split('/'))
+            if info['isdir']:
+                transfer.makedirs(local)
+            else:
+                infos[info['path']] = info
+                files.append((info['path'], local))
+        return transfer.run(lambda remote, local: self._download_to(
+            infos[remote], local), files, workers)
+
+    def _oper_path(self, path):
+        "Adds the leading and trailing slashes move expects."
+        # check folder for / at end
+        if not path.endswith("/"):
+            path = path + "/"
+        # check folder for / at begining
+        if not path.startswith("/"):
+            path = "/" + path
+        return path
 
     def move(self, src_path, dst_path):
-        # check destination folder for / at end
-        if not src_path.endswith("/"):
-            src_path = src_path + "/"
-        # check destination folder for / at begining
-        if not src_path.startswith("/"):
-            src_path = "/" + src_path
-        # check destination folder for / at end
-        if not dst_path.endswith("/"):
-            dst_path = dst_path + "/"
-        # check destination folder for / at begining
-        if not dst_path.startswith("/"):
-            dst_path = "/" + dst_path
-        return self.post('/path/oper/move/', src=src_path, dst=dst_path)
+        """ Moves a path into a folder. Returns a Task, which may be waited
+        for. """
+        src_path = self._oper_path(src_path)
+        dst_path = self._oper_path(dst_path)
+        return self._task(self.post('/path/oper/move/', src=src_path,
+                                    dst=dst_path))
 
 
 class BasicClient(Client):
@@ -190,148 +821,150 @@ class BasicClient(Client):
         if password is None:
             password = os.environ.get('SMARTFILE_API_PASSWORD')
         if key is None or password is None:
-            try:
-                rc = netrc(netrcfile)
-            except:
-                pass
-            else:
-                urlp = urlparse.urlparse(self.url)
-                auth = rc.authenticators(urlp.netloc)
-                if auth is not None:
-                    if key is None:
-                        key = auth[0]
-                    if key is None:
-                        key = auth[1]
-                    if password is None:
-                        password = auth[2]
+            urlp = urlparse.urlparse(self.url)
+            auth = netrc_authenticators(urlp.netloc, netrcfile)
+            if auth is not None:
+                if key is None:
+                    key = auth[0]
+                if key is None:
+                    key = auth[1]
+                if password is None:
+                    password = auth[2]
         try:
             self.key, self.password = clean_tokens(key, password)
         except ValueError:
             raise APIError('Please provide an API key and password. Use '
                            'arguments or environment variables.')
 
+    def _account(self):
+        return self.key
+
     def _do_request(self, *args, **kwargs):
-        # Add the token authentication
-        kwargs['auth'] = (self.key, self.password)
+        # Add the token authentication, built again only if it changed.
+        credentials = (self.key, self.password)
+        if self._auth is None or self._auth[0] != credentials:
+            self._auth = (credentials, BasicAuth(*credentials))
+        kwargs['auth'] = self._auth[1]
         return super(BasicClient, self)._do_request(*args, **kwargs)
 
 
-try:
-    from requests_oauthlib import OAuth1
-    from oauthlib.oauth1 import SIGNATURE_PLAINTEXT
-
-    # OAuth, if available.
+class OAuthToken(object):
+    "Internal representation of an OAuth (token, secret) tuple."
+    def __init__(self, token=None, secret=None):
+        self.token = token
+        self.secret = secret
 
-    class OAuthToken(object):
-        "Internal representation of an OAuth (token, secret) tuple."
-        def __init__(self, token=None, secret=None):
-            self.token = token
-            self.secret = secret
+    def __iter__(self):
+        yield self.token
+        yield self.secret
+        raise StopIteration()
 
-        def __iter__(self):
-            yield self.token
-            yield self.secret
-            raise StopIteration()
+    def __getitem__(self, index):
+        return (self.token, self.secret)[index]
 
-        def __getitem__(self, index):
-            return (self.token, self.secret)[index]
+    def is_valid(self):
+        try:
+            clean_tokens(self.token, self.secret)
+            return True
+        except ValueError:
+            return False
+
+
+class OAuthClient(Client):
+    """API client that uses OAuth tokens. Layers a more complex
+    form of authentication useful for 3rd party access on top of
+    the base Client."""
+    def __init__(self, client_token=None, client_secret=None,
+                 access_token=None, access_secret=None, **kwargs):
+        if client_token is None:
+            client_token = os.environ.get('SMARTFILE_CLIENT_TOKEN')
+        if client_secret is None:
+            client_secret = os.environ.get('SMARTFILE_CLIENT_SECRET')
+        if access_token is None:
+            access_token = os.environ.get('SMARTFILE_ACCESS_TOKEN')
+        if access_secret is None:
+            access_secret = os.environ.get('SMARTFILE_ACCESS_SECRET')
+        load_oauth()
+        self._client = OAuthToken(client_token, client_secret)
+        if not self._client.is_valid():
+            raise APIError('You must provide a client_token'
+                           'and client_secret for OAuth.')
+        self._access = OAuthToken(access_token, access_secret)
+        self._request_token = OAuthToken()
+        super(OAuthClient, self).__init__(**kwargs)
 
-        def is_valid(self):
-            try:
-                clean_tokens(self.token, self.secret)
-                return True
-            except ValueError:
-                return False
-
-    class OAuthClient(Client):
-        """API client that uses OAuth tokens. Layers a more complex
-        form of authentication useful for 3rd party access on top of
-        the base Client."""
-        def __init__(self, client_token=None, client_secret=None,
-                     access_token=None, access_secret=None, **kwargs):
-            if client_token is None:
-                client_token = os.environ.get('SMARTFILE_CLIENT_TOKEN')
-            if client_secret is None:
-                client_secret = os.environ.get('SMARTFILE_CLIENT_SECRET')
-            if access_token is None:
-                access_token = os.environ.get('SMARTFILE_ACCESS_TOKEN')
-            if access_secret is None:
-                access_secret = os.environ.get('SMARTFILE_ACCESS_SECRET')
-            self._client = OAuthToken(client_token, client_secret)
-            if not self._client.is_valid():
-                raise APIError('You must provide a client_token'
-                               'and client_secret for OAuth.')
-            self._access = OAuthToken(access_token, access_secret)
-            super(OAuthClient, self).__init__(**kwargs)
-
-        def _do_request(self, *args, **kwargs):
+    def _do_request(self, *args, **kwargs):
+        # Add the OAuth parameters, built again only if the tokens changed.
+        credentials = (self._client.token, self._client.secret,
+                       self._access.token, self._access.secret)
+        if self._auth is None or self._auth[0] != credentials:
             if not self._access.is_valid():
                 raise APIError('You must obtain an access token'
                                'before making API calls.')
-            # Add the OAuth parameters.
-            kwargs['auth'] = OAuth1(self._client.token,
-                                    client_secret=self._client.secret,
-                                    resource_owner_key=self._access.token,
-                                    resource_owner_secret=self._access.secret,
-                                    signature_method=SIGNATURE_PLAINTEXT)
-            return super(OAuthClient, self)._do_request(*args, **kwargs)
-
-        def get_request_token(self, callback=None):
-            "The first step of the OAuth workflow."
-            oauth = OAuth1(self._client.token,
-                           client_secret=self._client.secret,
-                           callback_uri=callback,
-                           signature_method=SIGNATURE_PLAINTEXT)
-            r = requests.post(urlparse.urljoin(
-                self.url, 'oauth/request_token/'), auth=oauth)
-            credentials = urlparse.parse_qs(r.text)
-            self.__request = OAuthToken(credentials.get('oauth_token')[0],
-                                        credentials.get(
-                                        'oauth_token_secret')[0])
-            return self.__request
-
-        def get_authorization_url(self, request=None):
-            "The second step of the OAuth workflow."
-            if request is None:
-                if not self.__request.is_valid():
-                    raise APIError('You must obtain a request token to'
-                                   'request and access token. Use'
-                                   'get_request_token() first.')
-                request = self.__request
-            url = urlparse.urljoin(self.url, 'oauth/authorize/')
-            return url + '?' + urllib.urlencode(
-                dict(oauth_token=request.token))
-
-        def get_access_token(self, request=None, verifier=None):
-            """The final step of the OAuth workflow. After this the client
-            can make API calls."""
-            if request is None:
-                if not self.__request.is_valid():
-                    raise APIError('You must obtain a request token to request '
-                                   'and access token. Use get_request_token() '
-                                   'first.')
-                request = self.__request
-            oauth = OAuth1(self._client.token,
-                           client_secret=self._client.secret,
-                           resource_owner_key=request.token,
-                           resource_owner_secret=request.secret,
-                           verifier=verifier,
-                           signature_method=SIGNATURE_PLAINTEXT)
-            r = requests.post(urlparse.urljoin(
-                self.url, 'oauth/access_token/'), auth=oauth)
-            credentials = urlparse.parse_qs(r.text)
-            self._access = OAuthToken(credentials.get('oauth_token')[0],
-                                      credentials.get('oauth_token_secret')[0])
-            return self._access
-
-
-except ImportError:
-    # OAuth, if not available.
-
-    # Instead of a class, define this as a function, thus when a user tries to
-    # "instantiate" it, they receive an exception.
-    def OAuthClient(*args, **kwargs):
-        raise NotImplementedError('You must install oauthlib and '
-                                  'requests_oauthlib to use the OAuthClient. '
-                                  'Try "pip install requests_oauthlib" to '
-                                  'install both.')
+            self._auth = (credentials, oauth1(
+                self._client.token, client_secret=self._client.secret,
+                resource_owner_key=self._access.token,
+                resource_owner_secret=self._access.secret))
+        kwargs['auth'] = self._auth[1]
+        return super(OAuthClient, self)._do_request(*args, **kwargs)
+
+    def _account(self):
+        return self._access.token
+
+    def _parse_token(self, text):
+        "Parses the token from an OAuth token endpoint response body."
+        credentials = urlparse.parse_qs(text)
+        return OAuthToken(credentials.get('oauth_token')[0],
+                          credentials.get('oauth_token_secret')[0])
+
+    def _fetch_token(self, path, oauth):
+        "Obtains a token from one of the OAuth token endpoints."
+        r = self.transport.request('post', urlparse.urljoin(self.url, path),
+                                   auth=oauth)
+        return self._parse_token(r.text)
+
+    def _request_token_auth(self, callback=None):
+        "OAuth parameters for obtaining a request token."
+        return oauth1(self._client.token,
+                      client_secret=self._client.secret,
+                      callback_uri=callback)
+
+    def _access_token_auth(self, request=None, verifier=None):
+        "OAuth parameters for exchanging a request token for access."
+        if request is None:
+            if not self._request_token.is_valid():
+                raise APIError('You must obtain a request token to '
+                               'request and access token. Use '
+                               'get_request_token() first.')
+            request = self._request_token
+        return oauth1(self._client.token,
+                      client_secret=self._client.secret,
+                      resource_owner_key=request.token,
+                      resource_owner_secret=request.secret,
+                      verifier=verifier)
+
+    def get_request_token(self, callback=None):
+        "The first step of the OAuth workflow."
+        self._request_token = self._fetch_token(
+            'oauth/request_token/', self._request_token_auth(callback))
+        return self._request_token
+
+    def get_authorization_url(self, request=None):
+        "The second step of the OAuth workflow."
+        if request is None:
+            if not self._request_token.is_valid():
+                raise APIError('You must obtain a request token to'
+                               'request and access token. Use'
+                               'get_request_token() first.')
+            request = self._request_token
+        url = urlparse.urljoin(self.url, 'oauth/authorize/')
+        return url + '?' + urllib.urlencode(
+            dict(oauth_token=request.token))
+
+    def get_access_token(self, request=None, verifier=None):
+        """The final step of the OAuth workflow. After this the client
+        can make API calls."""
+        self._access = self._fetch_token(
+            'oauth/access_token/',
+            self._access_token_auth(request, verifier))
+        return self._access
@@ -0,0 +1,343 @@
+"""
+Asyncio API clients. These mirror the blocking clients, but every API call is
+a coroutine, so many calls can be in flight from a single event loop. Requires
+aiohttp (and Python 3.6+).
+
+    >>> from smartfile.aio import AsyncBasicClient
+    >>> async with AsyncBasicClient() as api:
+    ...     await api.get('/ping')
+"""
+import asyncio
+import json
+import time
+from urllib import parse as urlparse
+
+from smartfile import BasicAuth
+from smartfile import BasicClient
+from smartfile import Client
+from smartfile import OAuthClient
+from smartfile import HTTP_METHODS
+from smartfile import HTTP_USER_AGENT
+from smartfile.constants import CHUNK_SIZE
+from smartfile.errors import RequestError
+from smartfile.multipart import MultipartEncoder
+from smartfile.errors import ResponseError
+from smartfile import retry
+from smartfile.retry import rewinder
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+else:
+    # Errors retried by the default RetryPolicy of the asyncio clients:
+    # those of the blocking clients, and those of aiohttp.
+    RETRY_EXCEPTIONS = retry.RETRY_EXCEPTIONS + (
+        aiohttp.ClientConnectionError, asyncio.TimeoutError)
+    NO_RETRY_EXCEPTIONS = retry.NO_RETRY_EXCEPTIONS + (
+        aiohttp.ClientSSLError,)
+
+
+def oauth_headers(oauth, url, method):
+    "Signs a request using a requests_oauthlib OAuth1 instance's client."
+    headers = oauth.client.sign(url, http_method=method.upper())[1]
+    # The client is configured to produce bytes for requests.
+    return dict((k.decode('utf8') if isinstance(k, bytes) else k,
+                 v.decode('utf8') if isinstance(v, bytes) else v)
+                for k, v in headers.items())
+
+
+def form_fields(data):
+    """Converts form data or query parameters to (name, value) pairs for
+    aiohttp. As requests does, a list is sent as a field per item and None
+    is left out. Other values, except files, are sent as strings."""
+    fields = []
+    for name, value in data.items():
+        for item in value if isinstance(value, list) else [value]:
+            if item is None:
+                continue
+            if not (isinstance(item, tuple) or hasattr(item, 'read')):
+                item = str(item)
+            fields.append((name, item))
+    return fields
+
+
+async def stream(body):
+    "Sends a MultipartEncoder a chunk at a time."
+    for chunk in body:
+        yield chunk
+
+
+def blocking_only(name):
+    """A method of the blocking clients that the asyncio clients do not
+    provide, as it makes blocking calls from threads."""
+    def method(self, *args, **kwargs):
+        raise NotImplementedError('The asyncio clients do not support %s(), '
+                                  'use a blocking client.' % name)
+    method.__name__ = name
+    return method
+
+
+class AsyncResponse(object):
+    """A fully read aiohttp response. Provides the parts of the requests
+    response interface that ResponseError relies upon."""
+    def __init__(self, response, content):
+        self.response = response
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode(self.response.get_encoding(), 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncClient(Client):
+    """Base asyncio API client. Calls are coroutines, throttling is waited for
+    without blocking the event loop, and file bodies are streamed."""
+    def __init__(self, *args, **kwargs):
+        if aiohttp is None:
+            raise NotImplementedError('You must install aiohttp to use the '
+                                      'asyncio clients. Try "pip install '
+                                      'aiohttp".')
+        if kwargs.get('info_cache') is not None:
+            raise NotImplementedError('The asyncio clients do not support '
+                                      'info_cache.')
+        if kwargs.get('http_cache') is not None:
+            raise NotImplementedError('The asyncio clients do not support '
+                                      'http_cache.')
+        if kwargs.get('compression') is not None:
+            raise NotImplementedError('The asyncio clients do not support '
+                                      'compression, aiohttp already decodes '
+                                      'compressed responses.')
+        if kwargs.get('transport') is not None:
+            raise NotImplementedError('The asyncio clients always use '
+                                      'aiohttp, they do not support '
+                                      'transport.')
+        super(AsyncClient, self).__init__(*args, **kwargs)
+        self._session = None
+
+    def _default_retry_policy(self):
+        return retry.RetryPolicy(exceptions=RETRY_EXCEPTIONS,
+                                 no_retry_exceptions=NO_RETRY_EXCEPTIONS)
+
+    upload_many = blocking_only('upload_many')
+    upload_tree = blocking_only('upload_tree')
+    remove_many = blocking_only('remove_many')
+    move_many = blocking_only('move_many')
+    walk_tree = blocking_only('walk_tree')
+    download_tree = blocking_only('download_tree')
+    iter_children = blocking_only('iter_children')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_connections * self.pool_maxsize,
+            limit_per_host=self.pool_maxsize,
+            keepalive_timeout=self.keepalive_timeout)
+        return aiohttp.ClientSession(connector=connector)
+
+    @property
+    def session(self):
+        "The pooled session, created on first use within the event loop."
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    async def close(self):
+        "Closes all pooled connections. The client may still be used after."
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+
+    def _body(self, data, progress=None):
+        """Converts data to a body for aiohttp. If it contains files it is
+        encoded as a multipart body, produced a chunk at a time."""
+        fields = form_fields(data)
+        if all(isinstance(value, str) for name, value in fields):
+            return fields
+        # Files are sent last.
+        fields.sort(key=lambda f: not isinstance(f[1], str))
+        return MultipartEncoder(fields, callback=progress)
+
+    async def _do_request(self, method, url, event=None, **kwargs):
+        """Actually makes the HTTP request. event is the attempt reported to
+        the hooks, whose body_done is only sent for bodies read here."""
+        auth = kwargs.pop('auth', None)
+        if isinstance(auth, BasicAuth):
+            kwargs['headers']['Authorization'] = auth.header
+        elif auth is not None:
+            # An OAuth1 instance, use its oauthlib client to sign.
+            kwargs['headers'].update(oauth_headers(auth, url, method))
+        try:
+            response = await self.session.request(method, url, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise RequestError(e)
+        if event is not None:
+            length = response.request_info.headers.get('Content-Length')
+            self._response_headers(event, response.status,
+                                   int(length) if length else None)
+        if response.status >= 400:
+            try:
+                content = await response.read()
+            finally:
+                response.release()
+            if event is not None:
+                self._body_done(event, len(content))
+            raise ResponseError(AsyncResponse(response, content))
+        # Try to return the response in the most useful fashion given it's
+        # type.
+        if response.headers.get('content-type') == 'application/json':
+            try:
+                response = AsyncResponse(response, await response.read())
+            finally:
+                response.response.release()
+            if event is not None:
+                self._body_done(event, len(response.content))
+            decoder = self._decoder()
+            try:
+                # Try to decode as JSON
+                return decoder(response.content)
+            except (TypeError, ValueError):
+                # If that fails, return the text.
+                return response.text
+        else:
+            # This might be a file, so return it as a stream.
+            if dict(kwargs.get('params', ())).get('raw', 'True') == 'True':
+                return response.content
+            else:
+                return response
+
+    async def _request(self, method, endpoint, id=None, **kwargs):
+        "Handles retrying failed requests and error handling."
+        if method not in HTTP_METHODS:
+            raise RequestError('Invalid method %s' % method)
+        progress = kwargs.pop('progress', None)
+        if kwargs.pop('compress', None):
+            raise NotImplementedError('The asyncio clients do not compress '
+                                      'uploads.')
+        data, body = kwargs.pop('data', None), None
+        params = kwargs.get('params')
+        if params:
+            # Unlike requests, aiohttp does not serialize booleans or lists.
+            kwargs['params'] = form_fields(params)
+        url = self._url(endpoint, id)
+        # Add our user agent.
+        kwargs.setdefault('headers', {}).setdefault('User-Agent',
+                                                    HTTP_USER_AGENT)
+        if data:
+            body = self._body(data, progress)
+        if isinstance(body, MultipartEncoder):
+            kwargs['headers']['Content-Type'] = body.content_type
+            if body.len is not None:
+                kwargs['headers']['Content-Length'] = str(body.len)
+        # Now try the request, if it fails (or we get throttled) wait and
+        # try again.
+        limiter = self._limiter()
+        rewind = rewinder(body)
+        endpoint = endpoint.strip('/')
+        started, attempt = time.time(), 0
+        while True:
+            attempt += 1
+            event = None
+            if self.hooks:
+                event = {'method': method, 'endpoint': endpoint, 'url': url,
+                         'attempt': attempt}
+            if isinstance(body, MultipartEncoder):
+                body.rewind()
+                kwargs['data'] = stream(body)
+            elif body:
+                kwargs['data'] = body
+            if limiter is not None:
+                waited, wait = 0, limiter.reserve()
+                while wait:
+                    await asyncio.sleep(wait)
+                    waited += wait
+                    wait = limiter.reserve()
+                if waited and event is not None:
+                    self._throttle_sleep(event, waited)
+            if event is not None:
+                self._request_started(event)
+            try:
+                response = await self._do_request(method, url, event=event,
+                                                  **kwargs)
+            except (RequestError, ResponseError) as e:
+                delay = self._retry(method, e, attempt, started, limiter,
+                                    rewind)
+                if event is not None:
+                    self._retried(event, e, delay)
+                await asyncio.sleep(delay)
+                continue
+            if limiter is not None:
+                limiter.success()
+            return response
+
+    async def download(self, file_to_be_downloaded, perform_download=True,
+                       download_to_path=None):
+        """ file_to_be_downloaded is a file-like object that has already
+        been uploaded, you cannot download folders """
+        response = await self.get(
+            '/path/data/', file_to_be_downloaded, raw=False)
+        if not perform_download:
+            # The caller can decide how to process the download of the data
+            return response
+        if not download_to_path:
+            download_to_path = file_to_be_downloaded.split("/")[-1]
+        try:
+            with open(download_to_path, 'wb') as o:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    o.write(chunk)
+        finally:
+            response.release()
+
+    async def remove(self, deletefile):
+        """ Removes a path. Unlike the blocking clients, returns the info of
+        the task as a dict rather than a Task: Tasks are polled with blocking
+        calls from a thread. Poll it with get('/task', info['uuid']). """
+        return await self.post('/path/oper/remove', path=deletefile)
+
+    async def move(self, src_path, dst_path):
+        """ Moves a path into a folder. Returns the info of the task as a
+        dict, as remove does. """
+        return await self.post('/path/oper/move/',
+                               src=self._oper_path(src_path),
+                               dst=self._oper_path(dst_path))
+
+
+class AsyncBasicClient(BasicClient, AsyncClient):
+    """Asyncio API client that uses a key and password."""
+
+
+class AsyncOAuthClient(OAuthClient, AsyncClient):
+    """Asyncio API client that uses OAuth tokens. The steps of the OAuth
+    workflow that make requests are coroutines."""
+    async def _fetch_token(self, path, oauth):
+        url = urlparse.urljoin(self.url, path)
+        headers = oauth_headers(oauth, url, 'POST')
+        try:
+            async with self.session.post(url, headers=headers) as r:
+                return self._parse_token(await r.text())
+        except aiohttp.ClientError as e:
+            raise RequestError(e)
+
+    async def get_request_token(self, callback=None):
+        "The first step of the OAuth workflow."
+        self._request_token = await self._fetch_token(
+            'oauth/request_token/', self._request_token_auth(callback))
+        return self._request_token
+
+    async def get_access_token(self, request=None, verifier=None):
+        """The final step of the OAuth workflow. After this the client
+        can make API calls."""
+        self._access = await self._fetch_token(
+            'oauth/access_token/',
+            self._access_token_auth(request, verifier))
+        return self._access
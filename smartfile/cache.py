@@ -0,0 +1,466 @@
+"""
+Client side caching of API responses, and of file signatures used for
+synchronization.
+"""
+import copy
+import errno
+import hashlib
+import io
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from smartfile.transport import BodyWrapper
+
+
+def params_key(params):
+    "A hashable form of request parameters, whose values may be lists."
+    return tuple(sorted((name, tuple(value) if isinstance(value, list)
+                         else value) for name, value in params.items()))
+
+
+class MetadataCache(object):
+    """
+    A cache of path info (/path/info responses), bounded by entry count and
+    by age. The least recently used entry is evicted when maxsize is reached,
+    entries older than ttl seconds are not used. Safe to share between
+    threads.
+
+    Entries are keyed by path and request parameters. Invalidating a path
+    drops the entries of the path, of everything below it and of its parent.
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(path, params=None):
+        path = posixpath.normpath('/' + (path or '').strip('/'))
+        return (path, params_key(params or {}))
+
+    def get(self, key):
+        "Returns a copy of the cached value, or None."
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move to the most recently used end.
+            del self._entries[key]
+            self._entries[key] = entry
+        return copy.deepcopy(entry[1])
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl,
+                                  copy.deepcopy(value))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, path):
+        "Drops entries affected by a change to path."
+        path = self.key(path)[0]
+        parent = posixpath.dirname(path)
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] in (path, parent) or key[0].startswith(prefix):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+def default_cache_dir(name='signatures'):
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'smartfile', name)
+
+
+class DirectoryCache(object):
+    """
+    Files stored in directory, named after their key and bounded by their
+    total size in bytes. The least recently used files are evicted when
+    maxsize is exceeded. The directory may be shared by processes.
+    """
+    suffix = '.cache'
+
+    # Seconds after which a temporary file no longer written to is removed.
+    # It was left by a process that died.
+    stale_age = 3600
+
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, name + self.suffix)
+
+    def _open(self, key):
+        "Returns the cached file as an open file, or None."
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            # The modification time orders the entries for eviction.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    def _create(self):
+        "Creates a temporary file, to be committed or removed."
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix='.tmp',
+                                           delete=False)
+
+    def _commit(self, key, name):
+        "Moves the temporary file name into place, and returns it opened."
+        path = self._path(key)
+        getattr(os, 'replace', os.rename)(name, path)
+        # Opened before evicting, it stays readable if it is evicted at once.
+        f = open(path, 'rb')
+        self._evict()
+        return f
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # Evicted by another process.
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return sorted(entries)
+
+    def _sweep(self):
+        "Removes the stale temporary files, which are not counted."
+        stale = time.time() - self.stale_age
+        for name in os.listdir(self.directory):
+            if not name.startswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < stale:
+                    os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _evict(self):
+        with self._lock:
+            self._sweep()
+            entries = self._entries()
+            size = sum(entry[1] for entry in entries)
+            for mtime, entry_size, name in entries:
+                if size <= self.maxsize:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                size -= entry_size
+                self.evictions += 1
+
+    def size(self):
+        "Total size in bytes of the cached files."
+        return sum(entry[1] for entry in self._entries())
+
+    def clear(self):
+        for entry in self._entries():
+            try:
+                os.remove(os.path.join(self.directory, entry[2]))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'size': self.size(), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class SignatureCache(DirectoryCache):
+    """
+    A cache of file signatures, stored as files in directory and bounded by
+    their total size in bytes. The least recently used signatures are evicted
+    when maxsize is exceeded.
+
+    Signatures are keyed by the device, inode, size and modification time of
+    the file, and the block size, so a file that changed (or was replaced) is
+    never given a stale signature. The directory may be shared by processes.
+    """
+    suffix = '.sig'
+
+    def __init__(self, directory=None, maxsize=1024 * 1024 * 1024):
+        super(SignatureCache, self).__init__(
+            directory or default_cache_dir(), maxsize)
+
+    @staticmethod
+    def key(path, block_size=None):
+        st = os.stat(path)
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1e9)
+        return (st.st_dev, st.st_ino, st.st_size, mtime_ns, block_size)
+
+    def get(self, key):
+        "Returns the cached signature as an open file, or None."
+        return self._open(key)
+
+    def set(self, key, fileobj):
+        """
+        Stores the signature read from fileobj, and returns it as an open
+        file.
+        """
+        with self._create() as output:
+            try:
+                shutil.copyfileobj(fileobj, output)
+            except Exception:
+                os.remove(output.name)
+                raise
+        return self._commit(key, output.name)
+
+
+# Headers describing how a response was transferred rather than its body,
+# which is stored decoded.
+TRANSFER_HEADERS = ('connection', 'content-encoding', 'content-length',
+                    'keep-alive', 'transfer-encoding')
+
+
+def cacheable(status, headers):
+    """Whether a response can be stored, to be revalidated: it succeeded and
+    has a validator."""
+    return status == 200 and ('ETag' in headers or
+                              'Last-Modified' in headers) and \
+        'no-store' not in headers.get('Cache-Control', '')
+
+
+def stored_headers(headers):
+    "The headers of a response to store with its decoded body."
+    return [(name, value) for name, value in headers.items()
+            if name.lower() not in TRANSFER_HEADERS]
+
+
+class StoringBody(BodyWrapper):
+    """
+    Wraps the raw body of a response, writing what is read of it to writer.
+    The entry is committed once the body has been read to its end, and
+    discarded if it is closed before. The wrapped body is decoded.
+    """
+    def __init__(self, raw, writer):
+        super(StoringBody, self).__init__(raw)
+        self.__dict__['_writer'] = writer
+        raw.decode_content = True
+
+    def _data(self, data):
+        if not self._finished:
+            try:
+                self._writer.write(data)
+            except EnvironmentError:
+                # The disk may be full, serve the body without storing it.
+                self._end(False)
+
+    def _finish(self, complete):
+        if complete:
+            self._writer.commit()
+        else:
+            self._writer.abort()
+
+
+class HTTPCache(object):
+    """
+    A cache of responses with validators (an ETag or Last-Modified header),
+    kept in memory and bounded by the total size of their bodies in bytes.
+    The least recently used responses are evicted when maxsize is exceeded,
+    larger ones are not stored. Safe to share between threads.
+
+    Clients revalidate cached responses on every request, with If-None-Match
+    and If-Modified-Since headers, and serve them when the server answers
+    304 Not Modified.
+    """
+    def __init__(self, maxsize=64 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        "Returns the headers and body, as an open file, of a response."
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move to the most recently used end.
+            self._entries[key] = entry
+        return entry[0], io.BytesIO(entry[1])
+
+    def writer(self, key, headers):
+        "Returns a writer storing the body of a response as it is read."
+        return MemoryWriter(self, key, headers)
+
+    def set(self, key, headers, body):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            if len(body) > self.maxsize:
+                return
+            self._entries[key] = (headers, body)
+            self._size += len(body)
+            while self._size > self.maxsize:
+                self._size -= len(self._entries.popitem(last=False)[1][1])
+                self.evictions += 1
+
+    def size(self):
+        "Total size in bytes of the cached bodies."
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        return {'size': self._size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class MemoryWriter(object):
+    "Buffers a body for HTTPCache, unless it grows larger than the cache."
+    def __init__(self, cache, key, headers):
+        self.cache = cache
+        self.key = key
+        self.headers = headers
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        if self.chunks is not None:
+            self.size += len(data)
+            if self.size > self.cache.maxsize:
+                self.chunks = None
+            else:
+                self.chunks.append(data)
+
+    def commit(self):
+        if self.chunks is not None:
+            self.cache.set(self.key, self.headers, b''.join(self.chunks))
+
+    def abort(self):
+        self.chunks = None
+
+
+class DiskHTTPCache(DirectoryCache):
+    """
+    An HTTPCache storing responses as files in directory, bounded by their
+    total size in bytes. Each file holds the headers of a response, as a
+    line of JSON, followed by its body. The directory may be shared by
+    processes.
+    """
+    suffix = '.http'
+
+    def __init__(self, directory=None, maxsize=1024 * 1024 * 1024):
+        super(DiskHTTPCache, self).__init__(
+            directory or default_cache_dir('http'), maxsize)
+
+    def get(self, key):
+        "Returns the headers and body, as an open file, of a response."
+        f = self._open(key)
+        if f is None:
+            return None
+        try:
+            headers = json.loads(f.readline().decode('utf8'))
+        except ValueError:
+            # Truncated, by a full disk for instance.
+            f.close()
+            return None
+        return [tuple(header) for header in headers], f
+
+    def writer(self, key, headers):
+        "Returns a writer storing the body of a response as it is read."
+        return DiskWriter(self, key, headers)
+
+
+class DiskWriter(object):
+    """Writes a body for DiskHTTPCache to a temporary file, until committed.
+    The file is created once the body is first read, so that a response
+    dropped unread leaves nothing behind."""
+    def __init__(self, cache, key, headers):
+        self.cache = cache
+        self.key = key
+        self.headers = headers
+        self.output = None
+
+    def _open(self):
+        if self.output is None:
+            self.output = self.cache._create()
+            self.output.write(json.dumps(self.headers).encode('utf8') +
+                              b'\n')
+        return self.output
+
+    def write(self, data):
+        self._open().write(data)
+
+    def commit(self):
+        output = self._open()
+        output.close()
+        self.cache._commit(self.key, output.name).close()
+
+    def abort(self):
+        if self.output is not None:
+            self.output.close()
+            os.remove(self.output.name)
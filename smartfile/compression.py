@@ -0,0 +1,148 @@
+"""
+Content encoding of requests and responses. A client given a Compression
+asks for compressed responses and decodes them, including downloads, and may
+compress upload bodies as they are sent. Savings are counted.
+
+    >>> from smartfile.compression import Compression
+    >>> compression = Compression(upload=True)
+    >>> api = BasicClient(compression=compression)
+    >>> api.upload('access.log', open('access.log', 'rb'))
+    >>> compression.saved
+"""
+import threading
+import zlib
+
+from urllib3.util.request import ACCEPT_ENCODING
+
+from smartfile.constants import CHUNK_SIZE
+from smartfile.retry import rewinder
+
+
+# zlib window bits producing each upload encoding.
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class CompressedBody(object):
+    """
+    Compresses a file-like body as it is read, so that it is still sent a
+    chunk at a time. Once body has been read to its end, done is called with
+    the bytes read from it and the bytes produced. It can be rewound, for a
+    retry, if body can.
+    """
+    def __init__(self, body, encoding='gzip', level=6, done=None):
+        self.body = body
+        self.encoding = encoding
+        self.level = level
+        self.done = done
+        self._rewind = rewinder(body)
+        self._reset()
+
+    def _reset(self):
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                            WBITS[self.encoding])
+        self._buffer = bytearray()
+        self._eof = False
+        self.bytes_read = 0
+        self.bytes_compressed = 0
+
+    def seekable(self):
+        "Whether the body can be rewound."
+        return self._rewind is not None
+
+    @property
+    def rewind(self):
+        "Rewinds the body. Only present if body can be rewound."
+        if self._rewind is None:
+            raise AttributeError('rewind')
+        return self._restart
+
+    def _restart(self):
+        self._rewind()
+        self._reset()
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self.body.read(CHUNK_SIZE)
+            if chunk:
+                self.bytes_read += len(chunk)
+                data = self._compressor.compress(chunk)
+            else:
+                data = self._compressor.flush()
+                self._eof = True
+            self.bytes_compressed += len(data)
+            self._buffer += data
+            if self._eof and self.done is not None:
+                self.done(self.bytes_read, self.bytes_compressed)
+
+    def read(self, size=-1):
+        size = -1 if size is None else size
+        self._fill(size)
+        size = len(self._buffer) if size < 0 else size
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+class Compression(object):
+    """
+    The content encodings used by a client.
+
+    Responses are asked for in the encodings in accept, by default all those
+    urllib3 can decode: gzip and deflate, plus br and zstd when brotli and
+    zstandard are installed. Downloads are decoded as they are read.
+
+    With upload, request bodies containing files are compressed with
+    upload_encoding (gzip or deflate) at level as they are sent, and sent
+    with a Content-Encoding header, which the server must support. Either
+    may be overridden per call with the compress argument of upload and
+    download.
+
+    Counts the bytes of bodies sent and received, before and after
+    compression. One instance may be shared by several clients and threads.
+    """
+    def __init__(self, upload=False, upload_encoding='gzip', level=6,
+                 accept=ACCEPT_ENCODING):
+        if upload_encoding not in WBITS:
+            raise ValueError('Unsupported upload encoding: %s' %
+                             upload_encoding)
+        self.upload = upload
+        self.upload_encoding = upload_encoding
+        self.level = level
+        self.accept = accept
+        self.sent = 0
+        self.sent_compressed = 0
+        self.received = 0
+        self.received_compressed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def saved(self):
+        "Bytes not transferred thanks to compression."
+        return self.sent - self.sent_compressed + \
+            self.received - self.received_compressed
+
+    def compress(self, body):
+        "Wraps a file-like request body to be compressed as it is sent."
+        return CompressedBody(body, self.upload_encoding, self.level,
+                              self._sent)
+
+    def _sent(self, size, compressed):
+        with self._lock:
+            self.sent += size
+            self.sent_compressed += compressed
+
+    def decoded(self, size, compressed):
+        "Counts a response body of size bytes received as compressed bytes."
+        with self._lock:
+            self.received += size
+            self.received_compressed += compressed
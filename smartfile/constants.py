@@ -0,0 +1,6 @@
+"""
+Constants shared by the modules of the package.
+"""
+
+# Size of the chunks in which bodies and files are read, written and sent.
+CHUNK_SIZE = 64 * 1024
@@ -46,3 +46,15 @@ class ResponseError(APIError):
 
     def __str__(self):
         return 'Response {0}: {1}'.format(self.status_code, self.detail)
+
+
+class TaskError(APIError):
+    """ Exception for a server side task that did not succeed. """
+    def __init__(self, task, *args, **kwargs):
+        self.task = task
+        self.detail = 'Task {0} ended with status {1}'.format(task.uuid,
+                                                              task.status)
+        super(TaskError, self).__init__(*args, **kwargs)
+
+    def __str__(self):
+        return self.detail
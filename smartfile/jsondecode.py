@@ -0,0 +1,43 @@
+"""
+Decoders of JSON responses. By default the fastest one installed is used:
+orjson, then ujson, then the json module of the standard library. Decoders
+are imported on first use, and are passed the body as bytes.
+
+    >>> api = BasicClient(json_decoder='json')
+"""
+import json
+
+
+# Names of the decoders, fastest first.
+DECODERS = ('orjson', 'ujson', 'json')
+
+_decoders = {}
+
+
+def _load(name):
+    if name == 'json':
+        return json.loads
+    return __import__(name).loads
+
+
+def get_decoder(name=None):
+    """
+    Returns the loads function of the named decoder, or of the fastest one
+    installed if name is None. Raises NotImplementedError if the named
+    decoder is not installed.
+    """
+    try:
+        return _decoders[name]
+    except KeyError:
+        pass
+    if name is not None and name not in DECODERS:
+        raise ValueError('Unknown JSON decoder: %s' % name)
+    for candidate in (name,) if name else DECODERS:
+        try:
+            decoder = _load(candidate)
+        except ImportError:
+            continue
+        _decoders[name] = decoder
+        return decoder
+    raise NotImplementedError('You must install %s to decode JSON with it. '
+                              'Try "pip install %s".' % (name, name))
@@ -0,0 +1,111 @@
+"""
+Incremental parsing of large JSON documents, so that the items of a listing
+can be processed as they arrive rather than after the whole response has been
+read and decoded.
+"""
+import codecs
+import json
+
+from smartfile.constants import CHUNK_SIZE
+
+
+WHITESPACE = ' \t\n\r'
+
+
+class JSONStream(object):
+    """
+    Reads JSON values from a binary file-like object, keeping only the
+    unparsed part of the document in memory.
+    """
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        "Reads another chunk into the buffer. Returns False at EOF."
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        self.eof = not chunk
+        # Drop what has been parsed already.
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(
+            chunk or b'', final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        "Skips whitespace and returns the next character, '' at EOF."
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of %r at %r' % (
+                chars, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        "Parses the next value."
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            # A number might continue in the next chunk.
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self, key, members=None):
+        """
+        Yields the items of the array at key of the top level object. Other
+        members of the object are parsed and discarded, or stored in the
+        dict members if it is given, in which case the object is parsed to
+        its end.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            name = self.value()
+            self.expect(':')
+            if name == key and self.peek() == '[':
+                self.pos += 1
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.expect(',]') == ']':
+                            break
+                if members is None:
+                    return
+            else:
+                value = self.value()
+                if members is not None:
+                    members[name] = value
+            if self.expect(',}') == '}':
+                return
+
+
+def iter_items(fileobj, key, chunk_size=CHUNK_SIZE, members=None):
+    """
+    Yields the items of the array at key of the JSON object in fileobj. The
+    other members of the object are stored in members, if it is given.
+    """
+    return JSONStream(fileobj, chunk_size).items(key, members)
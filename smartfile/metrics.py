@@ -0,0 +1,224 @@
+"""
+Instrumentation of the requests made by a client. Hooks passed to a client are
+told when each attempt at a request starts, when its response headers and body
+have been received, when it is retried and when the client sleeps because of
+throttling. MetricsCollector aggregates these into per-endpoint latency
+histograms and counters, which it exports in the Prometheus text format.
+
+    >>> from smartfile.metrics import MetricsCollector
+    >>> metrics = MetricsCollector()
+    >>> api = BasicClient(hooks=[metrics])
+    >>> print(metrics.prometheus())
+"""
+import bisect
+import threading
+
+from smartfile.transport import BodyWrapper
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+class Hooks(object):
+    """
+    Receives the events of the requests made by a client. Override the events
+    of interest, the others do nothing.
+
+    Each event is passed a dict describing one attempt at a request, which is
+    updated as the attempt progresses and holds:
+
+    - method, endpoint (without the object ID), url and attempt (from 1)
+    - started, when the attempt was sent as time.time(), from
+      request_started on
+    - status, headers_elapsed (seconds until the response headers arrived,
+      including connecting) and bytes_sent (None if not known), once the
+      response headers are received
+    - bytes_received and elapsed (seconds until the body was read), once the
+      body has been read to its end or closed
+    - error and delay (seconds before the next attempt), if retried
+    - sleep, the seconds slept because of throttling
+
+    Hooks are called on the thread making the request, and exceptions they
+    raise are not caught.
+    """
+    def request_started(self, event):
+        "An attempt at a request is about to be sent."
+
+    def response_headers(self, event):
+        "The status and headers of the response have been received."
+
+    def body_done(self, event):
+        "The body of the response has been read, or the response closed."
+
+    def retry(self, event):
+        "The attempt failed and the request will be sent again."
+
+    def throttle_sleep(self, event):
+        "The client is about to sleep, or has slept, to respect throttling."
+
+
+class ObservedBody(BodyWrapper):
+    """
+    Wraps the raw body of a streamed response. Counts the bytes read, and
+    calls done with the count once the body has been read to its end or
+    closed.
+    """
+    def __init__(self, raw, done):
+        super(ObservedBody, self).__init__(raw)
+        self.__dict__.update(_done=done, bytes_read=0)
+
+    def _data(self, data):
+        self.__dict__['bytes_read'] += len(data)
+
+    def _finish(self, complete):
+        self._done(self.bytes_read)
+
+
+class Histogram(object):
+    "Counts observed values into buckets by upper bound."
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        "Yields (upper bound, count of values up to it), ending with +Inf."
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    labels = ['%s="%s"' % (name, _escape(value))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsCollector(Hooks):
+    """
+    Hooks that keep, per method and endpoint, histograms of the time to the
+    response headers and to the end of the body, and counters of responses
+    by status, retries, throttle sleeps and bytes sent and received. The
+    counters are in counters, keyed by metric name and label values.
+
+    One collector may be shared by several clients and threads.
+    """
+    # name: (type, help, label names)
+    METRICS = {
+        'response_headers_seconds': (
+            'histogram', 'Time until the response headers were received.',
+            ('method', 'endpoint')),
+        'request_seconds': (
+            'histogram', 'Time until the response body was read.',
+            ('method', 'endpoint')),
+        'responses_total': (
+            'counter', 'Responses received, by status.',
+            ('method', 'endpoint', 'status')),
+        'retries_total': (
+            'counter', 'Failed attempts that were retried.',
+            ('method', 'endpoint')),
+        'throttle_sleeps_total': (
+            'counter', 'Sleeps because of throttling.',
+            ('method', 'endpoint')),
+        'throttle_sleep_seconds_total': (
+            'counter', 'Time slept because of throttling.',
+            ('method', 'endpoint')),
+        'sent_bytes_total': (
+            'counter', 'Request body bytes sent.', ('method', 'endpoint')),
+        'received_bytes_total': (
+            'counter', 'Response body bytes received.',
+            ('method', 'endpoint')),
+    }
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='smartfile_'):
+        self.buckets = buckets
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, name, labels, value):
+        with self._lock:
+            key = (name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(value)
+
+    def _add(self, name, labels, value=1):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def response_headers(self, event):
+        labels = (event['method'], event['endpoint'])
+        self._observe('response_headers_seconds', labels,
+                      event['headers_elapsed'])
+        self._add('responses_total', labels + (event['status'],))
+        if event.get('bytes_sent'):
+            self._add('sent_bytes_total', labels, event['bytes_sent'])
+
+    def body_done(self, event):
+        labels = (event['method'], event['endpoint'])
+        self._observe('request_seconds', labels, event['elapsed'])
+        self._add('received_bytes_total', labels, event['bytes_received'])
+
+    def retry(self, event):
+        self._add('retries_total', (event['method'], event['endpoint']))
+
+    def throttle_sleep(self, event):
+        labels = (event['method'], event['endpoint'])
+        self._add('throttle_sleeps_total', labels)
+        self._add('throttle_sleep_seconds_total', labels, event['sleep'])
+
+    def prometheus(self):
+        "The metrics in the Prometheus text exposition format."
+        lines = []
+        with self._lock:
+            for name in sorted(self.METRICS):
+                kind, text, names = self.METRICS[name]
+                full = self.prefix + name
+                lines.append('# HELP %s %s' % (full, text))
+                lines.append('# TYPE %s %s' % (full, kind))
+                if kind == 'counter':
+                    for (metric, labels), value in sorted(
+                            self.counters.items()):
+                        if metric == name:
+                            lines.append('%s%s %s' % (
+                                full, _labels(names, labels), _number(value)))
+                    continue
+                for (metric, labels), histogram in sorted(
+                        self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_bucket%s %s' % (
+                            full, _labels(names, labels,
+                                          'le="%s"' % _number(bound)),
+                            count))
+                    lines.append('%s_sum%s %s' % (
+                        full, _labels(names, labels), _number(histogram.sum)))
+                    lines.append('%s_count%s %s' % (
+                        full, _labels(names, labels), histogram.count))
+        return '\n'.join(lines) + '\n'
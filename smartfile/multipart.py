@@ -0,0 +1,195 @@
+"""
+Streaming multipart/form-data encoding. Files are read in fixed size chunks
+while the request is sent, rather than the whole body being built in memory.
+"""
+import binascii
+import os
+import time
+
+import six
+
+from smartfile.constants import CHUNK_SIZE
+
+
+def _length(fileobj):
+    "Number of bytes left to read from fileobj, or None if unknown."
+    # Seeking works for files, and unlike fileno() does not make a spooled
+    # temporary file roll over to disk.
+    try:
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        length = fileobj.tell() - position
+        fileobj.seek(position)
+        return length
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+
+
+def _quote(value):
+    return value.replace('\\', '\\\\').replace('"', '%22')
+
+
+class Part(object):
+    """
+    One field of a multipart body. value is a string, a file-like object or
+    an iterable of bytes. A file-like object is read from its current
+    position, which is remembered so that the part can be rewound.
+    """
+    def __init__(self, name, value, filename=None):
+        disposition = 'form-data; name="%s"' % _quote(name)
+        if filename is not None:
+            disposition += '; filename="%s"' % _quote(filename)
+        headers = 'Content-Disposition: %s\r\n' % disposition
+        if filename is not None:
+            headers += 'Content-Type: application/octet-stream\r\n'
+        self.headers = (headers + '\r\n').encode('utf8')
+        self.start = None
+        if isinstance(value, six.text_type):
+            value = value.encode('utf8')
+        if isinstance(value, bytes):
+            self.value, self.length = None, len(value)
+            self.data = value
+        elif hasattr(value, 'read'):
+            self.value, self.length = value, _length(value)
+            try:
+                self.start = value.tell()
+            except (AttributeError, EnvironmentError, ValueError):
+                pass
+        else:
+            self.value, self.length = value, None
+
+    def seekable(self):
+        "Whether the part can be rewound. An iterable can only be read once."
+        return self.value is None or self.start is not None
+
+    def rewind(self):
+        "Returns a file value to where it started, so it may be sent again."
+        if self.start is not None:
+            self.value.seek(self.start)
+
+    def chunks(self, chunk_size):
+        if self.value is None:
+            yield self.data
+        elif hasattr(self.value, 'read'):
+            while True:
+                chunk = self.value.read(chunk_size)
+                if not chunk:
+                    break
+                if isinstance(chunk, six.text_type):
+                    chunk = chunk.encode('utf8')
+                yield chunk
+        else:
+            for chunk in self.value:
+                yield chunk
+
+
+class MultipartEncoder(object):
+    """
+    A multipart/form-data request body that is produced as it is sent.
+
+    fields is a list of (name, value) pairs. A value may be a string, a file
+    like object, or a (filename, file-like or iterable of bytes) tuple. As
+    with requests, other values are sent as strings, None is left out and a
+    list is sent as a field per item. When the length of every value is
+    known, len is set and the body is sent with a Content-Length. Otherwise
+    len is None and the body should be sent using chunked transfer encoding.
+
+    callback, if given, is called with the encoder whenever a chunk has been
+    read, so that bytes_read, len and rate may be used to report progress.
+    """
+    def __init__(self, fields, boundary=None, chunk_size=CHUNK_SIZE,
+                 callback=None):
+        self.boundary = boundary or binascii.hexlify(
+            os.urandom(16)).decode('ascii')
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.parts = []
+        for name, value in fields:
+            for item in value if isinstance(value, list) else [value]:
+                if item is not None:
+                    self.parts.append(self._part(name, item))
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.len = self._content_length()
+        self.rewind()
+
+    def _part(self, name, value):
+        filename = None
+        if isinstance(value, tuple):
+            filename, value = value
+        elif hasattr(value, 'read'):
+            # Temporary files may be named by their descriptor.
+            filename = getattr(value, 'name', None)
+            if not isinstance(filename, six.string_types):
+                filename = name
+            filename = os.path.basename(filename)
+        elif not isinstance(value, (bytes, six.text_type)):
+            value = six.text_type(value)
+        return Part(name, value, filename=filename)
+
+    def _content_length(self):
+        if any(part.length is None for part in self.parts):
+            return None
+        delimiter = len(self.boundary) + 6
+        return sum(delimiter + len(part.headers) + part.length
+                   for part in self.parts) + delimiter
+
+    def rewind(self):
+        "Restarts the body from the beginning, for instance for a retry."
+        for part in self.parts:
+            part.rewind()
+        self.bytes_read = 0
+        self.started = None
+        self._chunks = self._generate()
+        self._buffer = b''
+
+    def seekable(self):
+        "Whether the body can be rewound, which it can if all its parts can."
+        return all(part.seekable() for part in self.parts)
+
+    @property
+    def rate(self):
+        "Average bytes per second read so far."
+        if not self.started:
+            return 0.0
+        return self.bytes_read / max(time.time() - self.started, 1e-6)
+
+    def _generate(self):
+        boundary = self.boundary.encode('ascii')
+        for part in self.parts:
+            yield b'--' + boundary + b'\r\n' + part.headers
+            for chunk in part.chunks(self.chunk_size):
+                # An empty chunk would signal the end of the body.
+                if chunk:
+                    yield chunk
+            yield b'\r\n'
+        yield b'--' + boundary + b'--\r\n'
+
+    def _read_chunk(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return b''
+        if self.started is None:
+            self.started = time.time()
+        self.bytes_read += len(chunk)
+        if self.callback:
+            self.callback(self)
+        return chunk
+
+    def read(self, size=-1):
+        "Reads up to size bytes of the body, buffering at most one chunk."
+        if size is None or size < 0:
+            return b''.join(iter(self._read_chunk, b''))
+        while len(self._buffer) < size:
+            chunk = self._read_chunk()
+            if not chunk:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def __iter__(self):
+        if self._buffer:
+            data, self._buffer = self._buffer, b''
+            yield data
+        for chunk in iter(self._read_chunk, b''):
+            yield chunk
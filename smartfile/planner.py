@@ -0,0 +1,134 @@
+"""
+Choosing how to transfer a file that is being synchronized: whole, or as a
+delta computed with the rsync algorithm.
+"""
+import json
+import threading
+import time
+
+
+WHOLE = 'whole'
+DELTA = 'delta'
+
+# Bytes per block in a librsync signature: a weak and a strong checksum.
+SIGNATURE_ENTRY_SIZE = 12
+
+# Block size assumed when it is left to librsync.
+DEFAULT_BLOCK_SIZE = 2048
+
+
+class Plan(dict):
+    """
+    The strategy chosen for one file and why, with the estimates it was
+    chosen by. Once the transfer is done, sent and seconds are filled in.
+    """
+    @property
+    def strategy(self):
+        return self['strategy']
+
+
+class TransferPlanner(object):
+    """
+    Chooses between sending a file whole and syncing it, by estimating how
+    long each would take.
+
+    Sending a file whole costs a round trip and the time to send the file.
+    Syncing costs three round trips, the time to send the signature and the
+    delta, and the time to checksum the file on both ends. The size of the
+    delta is estimated from the ratio of delta to file size seen when the
+    file was last synced, or on average when it was not. Round trip time and
+    bandwidth start at the given values, and are updated from the transfers
+    that are made, so estimates follow the actual network.
+
+    Every plan is kept in plans, and written as a line of JSON to audit, if
+    given, once the transfer has been recorded.
+    """
+    def __init__(self, rtt=0.1, bandwidth=1024 * 1024,
+                 checksum_rate=100 * 1024 * 1024, delta_ratio=0.5,
+                 min_delta_size=64 * 1024, smoothing=0.3, audit=None):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.checksum_rate = checksum_rate
+        self.delta_ratio = delta_ratio
+        self.min_delta_size = min_delta_size
+        self.smoothing = smoothing
+        self.audit = audit
+        self.plans = []
+        self._ratios = {}
+        self._lock = threading.Lock()
+
+    def _average(self, old, new):
+        return old + self.smoothing * (new - old)
+
+    def estimate_whole(self, size):
+        return self.rtt + size / float(self.bandwidth)
+
+    def estimate_delta(self, path, size, block_size=None):
+        ratio = self._ratios.get(path, self.delta_ratio)
+        signature = size // (block_size or DEFAULT_BLOCK_SIZE) * \
+            SIGNATURE_ENTRY_SIZE
+        return (3 * self.rtt +
+                (signature + ratio * size) / float(self.bandwidth) +
+                2 * size / float(self.checksum_rate))
+
+    def plan(self, path, size, exists=True, block_size=None):
+        """
+        Plans the transfer of size bytes to path. exists tells whether the
+        destination has a copy of the file to sync.
+        """
+        plan = Plan(path=path, size=size, time=time.time())
+        if not exists:
+            plan.update(strategy=WHOLE, reason='destination missing')
+        elif size < self.min_delta_size:
+            plan.update(strategy=WHOLE, reason='small file')
+        else:
+            whole = self.estimate_whole(size)
+            delta = self.estimate_delta(path, size, block_size)
+            plan.update(estimated_whole=whole, estimated_delta=delta)
+            if delta < whole:
+                plan.update(strategy=DELTA, reason='delta estimated faster')
+            else:
+                plan.update(strategy=WHOLE, reason='whole estimated faster')
+        with self._lock:
+            self.plans.append(plan)
+        return plan
+
+    def observe_rtt(self, seconds):
+        with self._lock:
+            self.rtt = self._average(self.rtt, seconds)
+
+    def record(self, plan, sent, seconds, delta_size=None):
+        """
+        Records the outcome of a planned transfer: the bytes sent (file,
+        or signature and delta), the time it took, and for a sync the size
+        of the delta.
+        """
+        round_trips = 3 if plan.strategy == DELTA else 1
+        with self._lock:
+            plan.update(sent=sent, seconds=seconds)
+            if delta_size is not None and plan['size']:
+                ratio = delta_size / float(plan['size'])
+                self._ratios[plan['path']] = ratio
+                self.delta_ratio = self._average(self.delta_ratio, ratio)
+            transfer_time = seconds - round_trips * self.rtt
+            if plan.strategy == DELTA:
+                transfer_time -= 2 * plan['size'] / float(self.checksum_rate)
+            if sent and transfer_time > 0:
+                self.bandwidth = self._average(self.bandwidth,
+                                               sent / transfer_time)
+            if self.audit is not None:
+                self.audit.write(json.dumps(plan, sort_keys=True) + '\n')
+                self.audit.flush()
+
+    def summary(self):
+        "Totals of the recorded transfers, and the bytes saved by syncing."
+        summary = {WHOLE: 0, DELTA: 0, 'size': 0, 'sent': 0}
+        with self._lock:
+            for plan in self.plans:
+                if 'sent' not in plan:
+                    continue
+                summary[plan.strategy] += 1
+                summary['size'] += plan['size']
+                summary['sent'] += plan['sent']
+        summary['saved'] = summary['size'] - summary['sent']
+        return summary
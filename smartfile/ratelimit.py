@@ -0,0 +1,111 @@
+"""
+Client side rate limiting, pacing requests so that they are not throttled by
+the API in the first place.
+"""
+import collections
+import threading
+import time
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class RateLimiter(object):
+    """
+    A token bucket allowing rate requests per second, with bursts of up to
+    burst requests. Safe to share between threads and clients.
+
+    The rate need not be known up front. When the API throttles a request,
+    throttled() is called with the delay from its x-throttle header: every
+    request then waits out the delay, and the rate is lowered below the rate
+    that was being achieved. While requests succeed the rate is slowly raised
+    again, so that it settles just under the limit the API enforces.
+    """
+    def __init__(self, rate=None, burst=None, min_rate=0.5, decrease=0.8,
+                 increase=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.throttles = 0
+        self.waited = 0.0
+        self._tokens = 0.0
+        self._updated = clock()
+        self._resume = 0.0
+        self._recent = collections.deque()
+        self._lock = threading.Lock()
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, host, account=None, **kwargs):
+        "Returns the process wide limiter for an account on a host."
+        with cls._registry_lock:
+            key = (host, account)
+            if key not in cls._registry:
+                cls._registry[key] = cls(**kwargs)
+            return cls._registry[key]
+
+    def _capacity(self):
+        return max(1.0, self.burst or self.rate)
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(self._capacity(), self._tokens +
+                               (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """
+        Takes a token and returns 0 if a request may be sent now, otherwise
+        returns the number of seconds to wait before trying again.
+        """
+        with self._lock:
+            wait = self._admit(clock())
+        self.waited += wait
+        return wait
+
+    def _admit(self, now):
+        if now < self._resume:
+            return self._resume - now
+        self._refill(now)
+        if self.rate is not None:
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        # Remember when requests were admitted, to measure the rate.
+        self._recent.append(now)
+        while self._recent[0] < now - 1:
+            self._recent.popleft()
+        return 0
+
+    def acquire(self):
+        "Blocks until a request may be sent, returns the seconds waited."
+        waited = 0
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self, delay):
+        "Pauses all requests for delay seconds and lowers the rate."
+        with self._lock:
+            now = clock()
+            self.throttles += 1
+            self._resume = max(self._resume, now + delay)
+            rate = len([t for t in self._recent if t >= now - 1])
+            if self.rate is not None:
+                rate = min(rate, self.rate)
+            self.rate = max(rate * self.decrease, self.min_rate)
+            self._tokens = 0.0
+            self._updated = now
+
+    def success(self):
+        "Raises the rate a little, probing for the limit."
+        with self._lock:
+            if self.rate is not None:
+                self.rate += self.increase / self.rate
@@ -0,0 +1,124 @@
+"""
+Retrying of requests that failed for reasons that are likely to be temporary.
+"""
+import random
+
+import requests
+
+from smartfile.errors import RequestError
+from smartfile.errors import ResponseError
+
+
+# Methods that have the same effect when repeated, so may be retried even if
+# the server might have processed the failed attempt.
+IDEMPOTENT_METHODS = ('get', 'head', 'options', 'put', 'delete')
+
+# Gateway errors and service unavailable.
+RETRY_STATUSES = (502, 503, 504)
+
+# Connection failures and timeouts. A certificate that does not verify will
+# not verify when retried either. smartfile.aio has those of aiohttp.
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+NO_RETRY_EXCEPTIONS = (requests.exceptions.SSLError,)
+
+
+def retry_after(error):
+    "Seconds to wait given by the Retry-After header of an error response."
+    if not isinstance(error, ResponseError):
+        return 0
+    try:
+        return max(0, int(error.response.headers.get('Retry-After', 0)))
+    except ValueError:
+        # An HTTP date, ignored.
+        return 0
+
+
+def rewinder(body):
+    """
+    Returns a function that returns body to its current position, so that it
+    can be sent again, or None if the body is a stream that cannot be rewound.
+    """
+    if body is None or not hasattr(body, 'read'):
+        return lambda: None
+    if hasattr(body, 'rewind'):
+        # A body made of several values may contain one that cannot be.
+        if hasattr(body, 'seekable') and not body.seekable():
+            return None
+        return body.rewind
+    try:
+        position = body.tell()
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    return lambda: body.seek(position)
+
+
+class RetryPolicy(object):
+    """
+    Decides whether, and after how long, a failed request is sent again.
+
+    A request is sent at most max_attempts times. The n-th retry waits
+    backoff * multiplier ** (n - 1) seconds, up to max_backoff, or longer if
+    the response asks to with a Retry-After header. With jitter the wait is
+    randomized between 0 and that, so that clients failing together do not
+    retry together. No retry is made that would end more than budget seconds
+    after the first attempt started.
+
+    Responses with a status in statuses, and errors that are instances of
+    exceptions (by default RETRY_EXCEPTIONS) but not of no_retry_exceptions
+    (by default NO_RETRY_EXCEPTIONS), are retried for the methods in
+    methods. By default these are the idempotent methods, as a POST that
+    timed out may still have been processed. Throttled requests are not
+    processed, they are retried whatever the method.
+    """
+    def __init__(self, max_attempts=3, backoff=0.5, multiplier=2.0,
+                 max_backoff=30.0, jitter=True, statuses=RETRY_STATUSES,
+                 exceptions=None, methods=IDEMPOTENT_METHODS,
+                 budget=None, no_retry_exceptions=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+        self.exceptions = exceptions
+        self.no_retry_exceptions = no_retry_exceptions
+        self.methods = methods
+        self.budget = budget
+
+    def backoff_delay(self, attempt):
+        "Seconds to wait after the given (1 based) attempt failed."
+        delay = min(self.max_backoff,
+                    self.backoff * self.multiplier ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def retryable(self, method, error):
+        "Whether a request that failed with error may be sent again."
+        if method.lower() not in self.methods:
+            return False
+        if isinstance(error, ResponseError):
+            return error.status_code in self.statuses
+        if isinstance(error, RequestError):
+            return isinstance(error.exc,
+                              self.exceptions or RETRY_EXCEPTIONS) and \
+                not isinstance(error.exc, self.no_retry_exceptions or
+                               NO_RETRY_EXCEPTIONS)
+        return False
+
+    def within_budget(self, elapsed, delay):
+        return self.budget is None or elapsed + delay <= self.budget
+
+    def delay(self, method, error, attempt, elapsed):
+        """
+        Returns the number of seconds to wait before sending a request again,
+        after attempt failed with error elapsed seconds after the first one
+        started. Returns None if the request should not be sent again.
+        """
+        if attempt >= self.max_attempts or not self.retryable(method, error):
+            return None
+        delay = max(self.backoff_delay(attempt), retry_after(error))
+        if not self.within_budget(elapsed, delay):
+            return None
+        return delay
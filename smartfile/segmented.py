@@ -0,0 +1,171 @@
+"""
+Downloads split into byte ranges, which are fetched concurrently using HTTP
+Range requests, and which can be resumed after being interrupted.
+"""
+import errno
+import json
+import os
+import re
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from smartfile import transfer
+from smartfile.constants import CHUNK_SIZE
+from smartfile.errors import APIError
+from smartfile.errors import ResponseError
+
+
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class SegmentedDownload(object):
+    """
+    Downloads a remote file into a local file, segment_size bytes at a time,
+    using up to workers concurrent requests.
+
+    Data is written into a preallocated <local>.part file, and the segments
+    that are complete are recorded in a <local>.part.json state file. If the
+    download is interrupted, running it again fetches only the missing
+    segments, as long as the remote file has not changed, which the server
+    must tell with an ETag or Last-Modified header. If the server does not
+    honour the Range header, the file is downloaded in one piece.
+    """
+    def __init__(self, api, path, local, workers, segment_size):
+        self.api = api
+        self.path = path
+        self.local = local
+        self.workers = workers
+        self.segment_size = segment_size
+        self.part = local + '.part'
+        self.state_path = self.part + '.json'
+        self.lock = threading.Lock()
+        self.state = None
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+        if not os.path.exists(self.part) or not state.get('validator'):
+            return None
+        return state
+
+    def _save_state(self):
+        if not self.state['validator']:
+            # Without a validator, a file that changed could not be told
+            # from the one partly downloaded, so it is not resumed.
+            return
+        temp = self.state_path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f)
+        getattr(os, 'replace', os.rename)(temp, self.state_path)
+
+    def _discard(self):
+        _remove(self.state_path)
+        _remove(self.part)
+
+    def _segments(self):
+        "Indexes of the segments that have not been downloaded yet."
+        count = -(-self.state['size'] // self.state['segment_size'])
+        done = set(self.state['done'])
+        return [i for i in range(count) if i not in done]
+
+    def _get(self, index, segment_size, validator=None):
+        start = index * segment_size
+        headers = {'Range': 'bytes=%s-%s' % (start, start + segment_size - 1)}
+        if validator:
+            # Have the whole file sent instead if it has changed.
+            headers['If-Range'] = validator
+        # Ranges of a compressed response could not be decoded on their own.
+        return self.api._request('get', '/path/data/', id=self.path,
+                                 params={'raw': False}, headers=headers,
+                                 compress=False)
+
+    def _write(self, index, response):
+        "Writes the body of a ranged response into the part file."
+        m = CONTENT_RANGE_PATTERN.match(
+            response.headers.get('Content-Range', ''))
+        if response.status_code != 206 or not m:
+            raise APIError('Range request for %s was not honoured, the file '
+                           'may have changed.' % self.path)
+        with open(self.part, 'r+b') as f:
+            f.seek(int(m.group(1)))
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        with self.lock:
+            self.state['done'].append(index)
+            self._save_state()
+
+    def _fetch(self, index):
+        response = self._get(index, self.state['segment_size'],
+                             self.state['validator'])
+        try:
+            self._write(index, response)
+        finally:
+            response.close()
+
+    def _fallback(self, response=None):
+        "Downloads the whole file in one piece."
+        self._discard()
+        if response is None:
+            response = self.api.get('/path/data/', self.path, raw=False)
+        try:
+            transfer.write_atomic(response.raw, self.local)
+        finally:
+            response.close()
+
+    def _finish(self):
+        getattr(os, 'replace', os.rename)(self.part, self.local)
+        _remove(self.state_path)
+
+    def run(self):
+        self.state = self._load_state()
+        if self.state and not self._segments():
+            # Interrupted after the last segment was written.
+            return self._finish()
+        if self.state:
+            index = self._segments()[0]
+            segment_size = self.state['segment_size']
+            validator = self.state['validator']
+        else:
+            index, segment_size, validator = 0, self.segment_size, None
+        try:
+            response = self._get(index, segment_size, validator)
+        except ResponseError as e:
+            if e.status_code != 416:
+                raise
+            # Range not satisfiable, the file is empty.
+            return self._fallback()
+        m = CONTENT_RANGE_PATTERN.match(
+            response.headers.get('Content-Range', ''))
+        if response.status_code != 206 or not m:
+            # Ranges are not supported, or the file changed since our state
+            # was saved and is being sent whole.
+            return self._fallback(response)
+        size = int(m.group(3))
+        validator = (response.headers.get('ETag') or
+                     response.headers.get('Last-Modified'))
+        if not self.state or self.state['size'] != size or \
+                self.state['validator'] != validator:
+            # Start over, keeping the segment we just requested.
+            self.state = {'size': size, 'segment_size': segment_size,
+                          'validator': validator, 'done': []}
+            with open(self.part, 'wb') as f:
+                f.truncate(size)
+        try:
+            self._write(index, response)
+        finally:
+            response.close()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self._fetch, self._segments()))
+        self._finish()
@@ -1,6 +1,10 @@
+import math
 import os
 import errno
+import posixpath
+import shutil
 import tempfile
+import time
 
 try:
     import librsync
@@ -8,6 +12,78 @@ except ImportError:
     raise ImportError('python-librsync is required for sync capabilities. '
                       'Install it using `pip install python-librsync`.')
 
+from smartfile import DEFAULT_TRANSFER_WORKERS
+from smartfile import transfer
+from smartfile.constants import CHUNK_SIZE
+from smartfile.errors import ResponseError
+from smartfile.planner import DELTA
+from smartfile.planner import TransferPlanner
+
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# Signatures and deltas received from the API are kept in memory up to this
+# size, larger ones are spilled to a temporary file.
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def spool(stream, max_size=SPOOL_SIZE):
+    """
+    Reads a response stream into a temporary file that is kept in memory
+    until it exceeds max_size. The stream is closed, releasing its
+    connection, and the file is returned rewound, so it can be read (and
+    sent) more than once.
+    """
+    if not hasattr(stream, 'read'):
+        # Decoded from JSON.
+        return stream
+    f = tempfile.SpooledTemporaryFile(max_size=max_size)
+    try:
+        if hasattr(stream, 'decode_content'):
+            stream.decode_content = True
+        shutil.copyfileobj(stream, f, CHUNK_SIZE)
+    except Exception:
+        f.close()
+        raise
+    finally:
+        stream.close()
+    f.seek(0)
+    return f
+
+
+# Bounds of the block sizes chosen by sqrt_block_size.
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 128 * 1024
+
+
+def sqrt_block_size(size, minimum=MIN_BLOCK_SIZE, maximum=MAX_BLOCK_SIZE):
+    """
+    Chooses a block size of about the square root of the file size, as rsync
+    does. This balances the size of the signature (one entry per block)
+    against that of the delta (a changed byte costs a whole block).
+    """
+    block_size = int(math.sqrt(size)) // 8 * 8
+    return max(minimum, min(maximum, block_size))
+
+
+def close(obj):
+    "Closes a signature or delta, if it is a file."
+    if hasattr(obj, 'close'):
+        obj.close()
+
+
+def size_of(obj):
+    "The size of a signature or delta, if it is a file."
+    try:
+        position = obj.tell()
+        obj.seek(0, os.SEEK_END)
+        size = obj.tell()
+        obj.seek(position)
+        return size
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+
 
 class BaseFile(object):
     """
@@ -16,40 +92,77 @@ class BaseFile(object):
     def __init__(self, path):
         self.path = path
 
+    def block_size(self, block_size):
+        """
+        Resolves a block size, which may be a function choosing one from the
+        size of the file.
+        """
+        if callable(block_size):
+            return block_size(self.size())
+        return block_size
+
 
 class LocalFile(BaseFile):
     """
     Represents a local file that is being synchronized. Uses librsync to
-    perform the steps of the rsync algorithm.
+    perform the steps of the rsync algorithm. Signatures are kept in
+    signature_cache, a SignatureCache, if one is given.
     """
+    def __init__(self, path, signature_cache=None):
+        super(LocalFile, self).__init__(path)
+        self.signature_cache = signature_cache
+
+    def size(self):
+        return os.path.getsize(self.path)
+
     def signature(self, block_size=None):
         "Calculates signature for local file."
+        block_size = self.block_size(block_size)
         kwargs = {}
         if block_size:
             kwargs['block_size'] = block_size
-        return librsync.signature(open(self.path, 'rb'), **kwargs)
+        cache = self.signature_cache
+        if cache is None:
+            with open(self.path, 'rb') as f:
+                return librsync.signature(f, **kwargs)
+        key = cache.key(self.path, block_size)
+        signature = cache.get(key)
+        if signature is not None:
+            return signature
+        with open(self.path, 'rb') as f:
+            signature = librsync.signature(f, **kwargs)
+        if cache.key(self.path, block_size) != key:
+            # Changed while being read, the signature may be of neither
+            # version.
+            return signature
+        try:
+            return cache.set(key, signature)
+        finally:
+            signature.close()
 
     def delta(self, signature):
         "Generates delta for local file using remote signature."
-        return librsync.delta(open(self.path, 'rb'), signature)
+        with open(self.path, 'rb') as f:
+            return librsync.delta(f, signature)
 
     def patch(self, delta):
         "Applies remote delta to local file."
         # Create a temp file in which to store our synced copy. We will handle
         # deleting it manually, since we may move it instead.
-        with (tempfile.NamedTemporaryFile(prefix='.sync',
-              suffix=os.path.basename(self.path),
-              dir=os.path.dirname(self.path), delete=False)) as output:
+        fd, path = transfer.temporary_file(self.path, '.sync')
+        with os.fdopen(fd, 'wb') as output:
             try:
                 # Open the local file, data may be read from it.
                 with open(self.path, 'rb') as reference:
                     # Patch the local file into our temporary file.
                     r = librsync.patch(reference, delta, output)
-                    os.rename(output.name, self.path)
+                    output.close()
+                    transfer.copy_mode(self.path, path)
+                    os.rename(path, self.path)
                     return r
             finally:
                 try:
-                    os.remove(output.name)
+                    os.remove(path)
                 except OSError as e:
                     if e.errno != errno.ENOENT:
                         raise
@@ -58,22 +171,42 @@ class LocalFile(BaseFile):
 class RemoteFile(BaseFile):
     """
     Represents a remote file that is being synchronized. Makes API calls to
-    perform the steps of the rsync algorithm.
+    perform the steps of the rsync algorithm. Signatures and deltas are sent
+    as streamed request bodies, and received into spooled temporary files.
     """
-    def __init__(self, path, api):
+    def __init__(self, path, api, size=None):
         super(RemoteFile, self).__init__(path)
         self.api = api
+        self._size = size
+        self._missing = False
+
+    def size(self):
+        """
+        The size of the remote file, looked up once if it was not given.
+        None if the file does not exist.
+        """
+        if self._size is None and not self._missing:
+            try:
+                self._size = self.api.get('/path/info', self.path)['size']
+            except ResponseError as e:
+                if e.status_code != 404:
+                    raise
+                self._missing = True
+        return self._size
 
     def signature(self, block_size=None):
         "Requests a signature for remote file via API."
+        block_size = self.block_size(block_size)
         kwargs = {}
         if block_size:
             kwargs['block_size'] = block_size
-        return self.api.get('path/sync/signature', self.path, **kwargs)
+        return spool(self.api.get('path/sync/signature', self.path,
+                                  **kwargs))
 
     def delta(self, signature):
         "Generates delta for remote file via API using local file's signature."
-        return self.api.post('path/sync/delta', self.path, signature=signature)
+        return spool(self.api.post('path/sync/delta', self.path,
+                                   signature=signature))
 
     def patch(self, delta):
         "Applies delta for local file to remote file via API."
@@ -84,12 +217,23 @@ class SyncClient(object):
     """
     Synchronizes remote and local files.
     """
-    def __init__(self, api, block_size=None):
+    def __init__(self, api, block_size=sqrt_block_size,
+                 signature_cache=None, planner=None):
         """
-        Synchronizes files with SmartFile using the sync API.
+        Synchronizes files with SmartFile using the sync API. block_size is
+        the block size of signatures, or a function choosing it from the size
+        of the file being signed, by default sqrt_block_size. None uses the
+        librsync default. Signatures of local files are cached in
+        signature_cache, a SignatureCache, if one is given, so that unchanged
+        files are not read to compute them.
+
+        Whether upload() and download() send a file whole or sync it is
+        decided by planner, a TransferPlanner, which records its decisions.
         """
         self.api = api
         self.block_size = block_size
+        self.signature_cache = signature_cache
+        self.planner = planner or TransferPlanner()
 
     @property
     def version(self):
@@ -103,19 +247,192 @@ class SyncClient(object):
         1. Calculate signature of destination.
         2. Generate delta from source.
         3. Apply delta to destination.
+
+        Signatures and deltas are streamed, and spilled to disk when large,
+        so memory use does not grow with the size of the file. They are
+        closed as soon as they have been used.
         """
-        return dst.patch(src.delta(dst.signature(block_size=self.block_size)))
+        return self._sync(src, dst)[0]
 
-    def upload(self, local, remote):
+    def _sync(self, src, dst):
+        "Syncs, returns the result and the sizes of signature and delta."
+        signature = dst.signature(block_size=self.block_size)
+        try:
+            signature_size = size_of(signature)
+            delta = src.delta(signature)
+        finally:
+            close(signature)
+        try:
+            delta_size = size_of(delta)
+            return dst.patch(delta), signature_size, delta_size
+        finally:
+            close(delta)
+
+    def _transfer(self, src, dst, size, exists, send_whole):
+        "Sends a file whole or syncs it, as planned, and records how it went."
+        block_size = dst.block_size(self.block_size) if exists else None
+        plan = self.planner.plan(dst.path, size, exists, block_size)
+        started = time.time()
+        if plan.strategy == DELTA:
+            result, signature_size, delta_size = self._sync(src, dst)
+            sent = (signature_size or 0) + (delta_size or 0)
+        else:
+            result, sent, delta_size = send_whole(), size, None
+        self.planner.record(plan, sent, time.time() - started, delta_size)
+        return result
+
+    def upload(self, local, remote, remote_size=None):
         """
         Performs synchronization from a local file to a remote file. The local
-        path is the source and remote path is the destination.
+        path is the source and remote path is the destination. The size of
+        the remote file may be given, to save looking it up. The file is
+        uploaded whole if the planner finds that quicker, or if the remote
+        file does not exist.
         """
-        self.sync(LocalFile(local), RemoteFile(remote, self.api))
+        src = LocalFile(local)
+        dst = RemoteFile(remote, self.api, remote_size)
+        if remote_size is None:
+            # A small request, which tells the round trip time.
+            started = time.time()
+            dst.size()
+            self.planner.observe_rtt(time.time() - started)
+        self._transfer(src, dst, src.size(), dst.size() is not None,
+                       lambda: self.api._upload_to(remote, local))
+
+    def _download_whole(self, local, remote):
+        response = self.api.get('/path/data/', remote, raw=False)
+        try:
+            transfer.write_atomic(response.raw, local)
+        finally:
+            response.close()
 
-    def download(self, local, remote):
+    def download(self, local, remote, remote_size=None, mtime=None):
         """
         Performs synchronization from a remote file to a local file. The
-        remote path is the source and the local path is the destination.
+        remote path is the source and the local path is the destination. The
+        size of the remote file may be given, to save looking it up. The
+        file is downloaded whole if the planner finds that quicker, or if the
+        local file does not exist. mtime, if given, is set on the local file.
+
+        With a signature_cache, the signature of the new local file is
+        cached, as the file was replaced, so that the next sync needs not
+        read it.
+        """
+        if remote_size is None:
+            started = time.time()
+            remote_size = self.api.get('/path/info', remote)['size']
+            self.planner.observe_rtt(time.time() - started)
+        src = RemoteFile(remote, self.api, remote_size)
+        dst = LocalFile(local, self.signature_cache)
+        self._transfer(src, dst, remote_size, os.path.exists(local),
+                       lambda: self._download_whole(local, remote))
+        if mtime is not None:
+            os.utime(local, (mtime, mtime))
+        if self.signature_cache is not None:
+            close(dst.signature(block_size=self.block_size))
+
+    def _local_tree(self, local_root):
+        "Stats the files below local_root, keyed by relative path."
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(local_root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, local_root)
+                files[relpath.replace(os.sep, '/')] = os.stat(path)
+        return files
+
+    def _download_sync(self, local, remote, info):
+        # Record the remote mtime, so the file is seen to be current.
+        self.download(local, remote, info['size'],
+                      transfer.parse_time(info['time']))
+
+    def sync_tree(self, local_root, remote_root, direction=UPLOAD,
+                  delete=False, workers=DEFAULT_TRANSFER_WORKERS):
+        """
+        Synchronizes the files below local_root and remote_root, in the given
+        direction (UPLOAD or DOWNLOAD).
+
+        Both trees are listed first, and only the files that differ in size
+        or mtime are synchronized using the rsync algorithm. Files missing
+        from the destination are copied whole. When delete is true, files
+        missing from the source are removed from the destination. Work is
+        done on a pool of workers.
+
+        Returns a TransferResult per file, whose result is False if the file
+        was current. Failures do not stop the other files.
+        """
+        if direction not in (UPLOAD, DOWNLOAD):
+            raise ValueError('direction must be UPLOAD or DOWNLOAD')
+        remote_root = transfer.remote_path(remote_root)
+        try:
+            infos = self.api.walk_tree(remote_root, workers)
+        except ResponseError as e:
+            if e.status_code != 404 or direction != UPLOAD:
+                raise
+            # Uploading into a new folder.
+            infos = {}
+        remote = dict((relpath, info) for relpath, info in infos.items()
+                      if not info['isdir'])
+        if direction == DOWNLOAD:
+            transfer.makedirs(local_root)
+        local = self._local_tree(local_root)
+
+        def paths(relpath):
+            return (posixpath.join(remote_root, relpath),
+                    os.path.join(local_root, *relpath.split('/')))
+
+        current, changed, new, deleted = [], [], [], []
+        source, destination = (local, remote) if direction == UPLOAD else \
+            (remote, local)
+        for relpath in sorted(source):
+            if relpath not in destination:
+                new.append(paths(relpath))
+            elif self._is_current(local[relpath], remote[relpath],
+                                  direction):
+                current.append(transfer.TransferResult(*paths(relpath),
+                                                       result=False))
+            else:
+                changed.append(paths(relpath))
+        if delete:
+            deleted = [paths(relpath) for relpath in sorted(destination)
+                       if relpath not in source]
+
+        if direction == UPLOAD:
+            results = self.api.upload_many(new, workers) + transfer.run(
+                lambda remote_path, local_path: self.upload(
+                    local_path, remote_path,
+                    remote[posixpath.relpath(remote_path, remote_root)][
+                        'size']),
+                changed, workers)
+            if deleted:
+                results += self.api.remove_many(
+                    [remote_path for remote_path, _ in deleted],
+                    workers=workers)
+        else:
+            def copy(remote_path, local_path):
+                transfer.makedirs(os.path.dirname(local_path))
+                return self.api._download_to(infos[posixpath.relpath(
+                    remote_path, remote_root)], local_path)
+            results = transfer.run(copy, new, workers) + transfer.run(
+                lambda remote_path, local_path: self._download_sync(
+                    local_path, remote_path,
+                    remote[posixpath.relpath(remote_path, remote_root)]),
+                changed, workers)
+            results += transfer.run(
+                lambda remote_path, local_path: os.remove(local_path),
+                deleted, workers)
+        return current + results
+
+    def _is_current(self, st, info, direction):
+        """
+        Whether a file needs no synchronization, judged by the local stat
+        result and the remote info.
         """
-        self.sync(RemoteFile(remote, self.api), LocalFile(local))
+        if st.st_size != info['size']:
+            return False
+        mtime = transfer.parse_time(info['time'])
+        if direction == DOWNLOAD:
+            # Downloads set the remote mtime on the local file.
+            return int(st.st_mtime) == mtime
+        # Uploads are stamped with the time of the upload.
+        return int(st.st_mtime) <= mtime
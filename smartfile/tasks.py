@@ -0,0 +1,214 @@
+"""
+Tracking of the server side tasks started by long running operations, such
+as moving or removing paths.
+"""
+import logging
+import threading
+import time
+
+from concurrent.futures import TimeoutError
+
+from smartfile.errors import TaskError
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Task states that are final.
+DONE_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+
+class Task(dict):
+    """
+    A server side task, the response of the API call that started it. It is
+    updated in place as the task is polled.
+
+    Polling starts when the task is waited for, or a callback is added.
+    """
+    def __init__(self, response, tracker):
+        super(Task, self).__init__(response)
+        self.tracker = tracker
+        self.error = None
+        self._callbacks = []
+        self._done = threading.Event()
+        if self.status in DONE_STATES:
+            self._done.set()
+
+    def __repr__(self):
+        return '<Task %s %s>' % (self.uuid, self.status)
+
+    @property
+    def uuid(self):
+        return self['uuid']
+
+    @property
+    def status(self):
+        result = self.get('result')
+        if isinstance(result, dict) and 'status' in result:
+            return result['status']
+        return self.get('status')
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, fn):
+        "Calls fn with the task once it is done, at once if it is already."
+        with self.tracker.lock:
+            done = self.done()
+            if not done:
+                self._callbacks.append(fn)
+        if done:
+            fn(self)
+        else:
+            self.tracker.track(self)
+
+    def wait(self, timeout=None):
+        "Waits for the task to be done, returns whether it is."
+        if not self.done():
+            self.tracker.track(self)
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        Waits for the task and returns its result. Raises TaskError if it did
+        not succeed, or TimeoutError if it is not done within timeout.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError()
+        if self.error is not None:
+            raise self.error
+        if self.status != 'SUCCESS':
+            raise TaskError(self)
+        return self.get('result')
+
+    def _finish(self, error=None):
+        self.error = error
+        with self.tracker.lock:
+            callbacks, self._callbacks = self._callbacks, []
+            self._done.set()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                LOGGER.exception('Callback for task %s failed', self.uuid)
+
+
+def wait(tasks, timeout=None, return_when=ALL_COMPLETED):
+    """
+    Waits for all, or with FIRST_COMPLETED for any, of tasks to be done.
+    Returns a (done, not_done) pair of lists.
+    """
+    tasks = list(tasks)
+    event = threading.Event()
+    for task in tasks:
+        task.add_done_callback(lambda task: event.set())
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        event.clear()
+        done = [task for task in tasks if task.done()]
+        if len(done) == len(tasks) or \
+                (done and return_when == FIRST_COMPLETED):
+            break
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+            break
+        event.wait(remaining)
+    return done, [task for task in tasks if not task.done()]
+
+
+class TaskTracker(object):
+    """
+    Polls the status of tasks from a single background thread, which runs
+    while there are tasks to poll.
+
+    A task is polled min_interval seconds after it starts being tracked, and
+    the interval grows by backoff after every poll up to max_interval, so
+    that quick tasks finish quickly while long ones cost few requests.
+    """
+    def __init__(self, api, min_interval=0.25, max_interval=10.0,
+                 backoff=1.5):
+        self.api = api
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self._wakeup = threading.Condition(self.lock)
+        # id(task): (task, time of next poll, interval)
+        self._pending = {}
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def track(self, task):
+        "Starts polling a task, unless it is already polled or done."
+        with self.lock:
+            if task.done() or id(task) in self._pending:
+                return
+            self._pending[id(task)] = (
+                task, time.time() + self.min_interval, self.min_interval)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            else:
+                self._wakeup.notify()
+
+    def wait(self, tasks=None, timeout=None, return_when=ALL_COMPLETED):
+        "Waits for tasks, by default all those being polled."
+        if tasks is None:
+            with self.lock:
+                tasks = [entry[0] for entry in self._pending.values()]
+        return wait(tasks, timeout, return_when)
+
+    def _due(self):
+        "Waits until tasks are due to be polled, and returns them."
+        with self.lock:
+            while True:
+                if not self._pending:
+                    self._thread = None
+                    return None
+                now = time.time()
+                due = [entry for entry in self._pending.values()
+                       if entry[1] <= now]
+                if due:
+                    return due
+                self._wakeup.wait(min(entry[1] for entry in
+                                      self._pending.values()) - now)
+
+    def _poll(self, task, interval):
+        try:
+            info = self.api.get('/task', task.uuid)
+        except Exception as e:
+            # Transient errors were retried already. Whatever the error, it
+            # is the task's, not the poller's to die of.
+            return self._done(task, e)
+        if isinstance(info, dict):
+            task.update(info)
+        if task.status in DONE_STATES:
+            return self._done(task)
+        interval = min(interval * self.backoff, self.max_interval)
+        with self.lock:
+            self._pending[id(task)] = (task, time.time() + interval,
+                                       interval)
+
+    def _done(self, task, error=None):
+        with self.lock:
+            self._pending.pop(id(task), None)
+        task._finish(error)
+
+    def _run(self):
+        try:
+            while True:
+                due = self._due()
+                if due is None:
+                    return
+                for task, _, interval in due:
+                    self._poll(task, interval)
+        finally:
+            # Should the thread die, the next task tracked starts another.
+            with self.lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
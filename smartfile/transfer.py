@@ -0,0 +1,150 @@
+"""
+Helpers for transferring many files concurrently.
+"""
+import binascii
+import calendar
+import datetime
+import errno
+import os
+import posixpath
+import shutil
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TransferResult(object):
+    """
+    Outcome of transferring one file of a batch. Failures are recorded in
+    error instead of being raised, so one file does not stop the batch. For
+    downloads, result is False if the local file was already up to date.
+    """
+    def __init__(self, remote, local, result=None, error=None):
+        self.remote = remote
+        self.local = local
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<TransferResult %s %s>' % (
+            self.remote, 'ok' if self.ok else 'failed: %s' % self.error)
+
+
+def remote_path(*parts):
+    "Joins parts into an absolute remote path."
+    return posixpath.normpath(posixpath.join('/', *parts))
+
+
+def parse_time(value):
+    "Converts a timestamp from the API (in UTC) to seconds since the epoch."
+    value = value.rstrip('Z').split('.')[0]
+    t = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(t.utctimetuple())
+
+
+def is_current(info, local):
+    "Whether the local file has the size and mtime of the remote file."
+    try:
+        st = os.stat(local)
+    except OSError:
+        return False
+    return (st.st_size == info['size'] and
+            int(st.st_mtime) == parse_time(info['time']))
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def temporary_file(local, prefix):
+    """
+    Creates a file beside local, to be moved over it once written, and
+    returns its descriptor and path as tempfile.mkstemp() does. Unlike those
+    of tempfile, the file is created with the mode of new files, the umask
+    being applied to it.
+    """
+    directory, name = os.path.split(local)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    for attempt in range(tempfile.TMP_MAX):
+        path = os.path.join(directory, prefix + binascii.hexlify(
+            os.urandom(6)).decode('ascii') + name)
+        try:
+            return os.open(path, flags, 0o666), path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    raise IOError(errno.EEXIST, 'No usable temporary file name found')
+
+
+def copy_mode(local, path):
+    "Gives path the mode of local, if local exists."
+    try:
+        shutil.copymode(local, path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def write_atomic(fileobj, local, mtime=None):
+    """
+    Copies fileobj to a temporary file beside local, then moves it into
+    place, so that local is never left partially written. The file keeps
+    the mode of the file it replaces.
+    """
+    fd, path = temporary_file(local, '.download')
+    with os.fdopen(fd, 'wb') as output:
+        try:
+            shutil.copyfileobj(fileobj, output)
+            output.close()
+            copy_mode(local, path)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+            getattr(os, 'replace', os.rename)(path, local)
+        finally:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def folder_levels(paths):
+    """
+    Lists the remote folders containing the given paths, grouped by depth,
+    shallowest first, so that parents can be created before their children.
+    """
+    folders = set()
+    for path in paths:
+        folder = posixpath.dirname(remote_path(path))
+        while folder != '/' and folder not in folders:
+            folders.add(folder)
+            folder = posixpath.dirname(folder)
+    levels = {}
+    for folder in folders:
+        levels.setdefault(folder.count('/'), []).append(folder)
+    return [sorted(levels[depth]) for depth in sorted(levels)]
+
+
+def run(func, pairs, workers):
+    """
+    Calls func(remote, local) for each pair on a pool of workers. Returns a
+    TransferResult for each pair, in order. An exception raised for a pair
+    is recorded in its result.
+    """
+    def call(pair):
+        result = TransferResult(*pair)
+        try:
+            result.result = func(*pair)
+        except Exception as e:
+            result.error = e
+        return result
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(call, pairs))
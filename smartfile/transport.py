@@ -0,0 +1,485 @@
+"""
+Transports send the HTTP requests of a client. RequestsTransport, the default,
+uses a pooled requests Session. Urllib3Transport sends requests straight to a
+urllib3 pool, without the per-call work of a Session. HTTP2Transport uses
+httpx, which multiplexes concurrent requests over a single connection to
+servers that speak HTTP/2. MockTransport answers requests with a function,
+without sockets, for tests and benchmarks.
+
+Whatever the transport, requests are prepared by requests (so authentication,
+parameters and bodies are handled alike), a requests Response streaming the
+body is returned, and connection errors and timeouts are raised as requests
+exceptions, so that clients handle errors and retries the same way.
+
+    >>> api = BasicClient(transport='http2')
+"""
+import io
+import os
+import ssl
+import threading
+import time
+
+import requests
+import urllib3
+from requests import exceptions
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+from requests.utils import default_headers
+from requests.utils import get_encoding_from_headers
+from requests.utils import get_environ_proxies
+
+from smartfile.constants import CHUNK_SIZE
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+# Number of redirects followed.
+MAX_REDIRECTS = 30
+
+# Urllib3Transport only follows redirects, clients retry failed requests.
+RETRIES = urllib3.Retry(total=None, connect=0, read=False, status=0, other=0,
+                        redirect=MAX_REDIRECTS)
+
+# Headers requests adds to every request made through a Session.
+DEFAULT_HEADERS = default_headers()
+
+
+def prepare(method, url, params=None, data=None, headers=None, auth=None):
+    "Prepares a request as a requests Session would."
+    merged = CaseInsensitiveDict(DEFAULT_HEADERS)
+    merged.update(headers or {})
+    return requests.Request(method.upper(), url, headers=merged,
+                            params=params, data=data, auth=auth).prepare()
+
+
+def build_response(request, raw):
+    "Wraps a raw response, whose body is read as it is consumed."
+    response = requests.Response()
+    response.status_code = raw.status
+    response.headers = CaseInsensitiveDict(raw.headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.reason = raw.reason
+    response.raw = raw
+    response.url = request.url
+    response.request = request
+    return response
+
+
+def verify_from_environ():
+    "The CA bundle given by the environment, as requests looks it up."
+    return os.environ.get('REQUESTS_CA_BUNDLE') or \
+        os.environ.get('CURL_CA_BUNDLE') or True
+
+
+def make_response(request, status, headers, body):
+    "Builds a response to request, streaming body from a file-like object."
+    return build_response(request, urllib3.HTTPResponse(
+        body=body, headers=headers, status=status, preload_content=False))
+
+
+class BodyWrapper(object):
+    """
+    Wraps the raw body of a streamed response. Subclasses are passed what is
+    read of it by _data, and _finish is called once, with whether the body
+    was read to its end, when it is or when it is closed. Anything else is
+    passed through to the wrapped body.
+    """
+    def __init__(self, raw):
+        self.__dict__.update(_raw=raw, _finished=False)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def _data(self, data):
+        pass
+
+    def _finish(self, complete):
+        pass
+
+    def _end(self, complete):
+        if not self._finished:
+            self.__dict__['_finished'] = True
+            self._finish(complete)
+
+    def read(self, amt=None, *args, **kwargs):
+        data = self._raw.read(amt, *args, **kwargs)
+        self._data(data)
+        if amt is None or not data:
+            self._end(True)
+        return data
+
+    def stream(self, *args, **kwargs):
+        for chunk in self._raw.stream(*args, **kwargs):
+            self._data(chunk)
+            yield chunk
+        self._end(True)
+
+    def close(self):
+        try:
+            self._raw.close()
+        finally:
+            self._end(False)
+
+
+class Transport(object):
+    """
+    Sends requests. request() takes the method, URL and the params, data,
+    headers, auth and timeout arguments of requests, and returns a requests
+    Response whose body has not been read yet.
+    """
+    def request(self, method, url, params=None, data=None, headers=None,
+                auth=None, timeout=None):
+        raise NotImplementedError()
+
+    def close(self):
+        "Closes pooled connections. The transport may still be used after."
+
+
+class PooledTransport(Transport):
+    """
+    A transport keeping a pool of connections, created on first use.
+    Connections idle for longer than keepalive_timeout seconds are dropped,
+    as the server will most likely have closed them already.
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, keepalive_timeout=60):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keepalive_timeout = keepalive_timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self._last_used = None
+        self._proxies = {}
+
+    def _create_pool(self):
+        raise NotImplementedError()
+
+    def _drop_idle(self, pool):
+        "Drops the pooled connections, the pools are recreated on demand."
+        raise NotImplementedError()
+
+    def _close_pool(self, pool):
+        raise NotImplementedError()
+
+    @property
+    def pool(self):
+        "The connection pool, created on first use."
+        with self._lock:
+            now = time.time()
+            if self._pool is None:
+                self._pool = self._create_pool()
+            elif self.keepalive_timeout is not None and \
+                    now - self._last_used > self.keepalive_timeout:
+                self._drop_idle(self._pool)
+            self._last_used = now
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._close_pool(self._pool)
+                self._pool = None
+
+    def proxies(self, url):
+        """The proxies given by the environment for the host of url, looked
+        up once per host rather than on every call."""
+        scheme, netloc = urlsplit(url)[:2]
+        try:
+            return self._proxies[scheme, netloc]
+        except KeyError:
+            proxies = self._proxies[scheme, netloc] = get_environ_proxies(
+                '%s://%s/' % (scheme, netloc))
+            return proxies
+
+
+class RequestsTransport(PooledTransport):
+    "Sends requests through a pooled requests Session."
+    def _create_pool(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # The environment is looked up once, rather than by requests on
+        # every call.
+        session.verify = verify_from_environ()
+        session.trust_env = False
+        return session
+
+    def _drop_idle(self, session):
+        for adapter in session.adapters.values():
+            adapter.close()
+
+    def _close_pool(self, session):
+        session.close()
+
+    @property
+    def session(self):
+        return self.pool
+
+    @property
+    def _session(self):
+        return self._pool
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url, stream=True,
+                                    proxies=self.proxies(url), **kwargs)
+
+
+class Urllib3Transport(PooledTransport):
+    """Sends requests straight to a urllib3 PoolManager, or a ProxyManager
+    when the environment gives a proxy."""
+    def _create_pool(self):
+        verify = verify_from_environ()
+        if verify is True:
+            verify = DEFAULT_CA_BUNDLE_PATH
+        kwargs = dict(num_pools=self.pool_connections,
+                      maxsize=self.pool_maxsize, block=self.pool_block,
+                      cert_reqs='CERT_REQUIRED')
+        if os.path.isdir(verify):
+            kwargs['ca_cert_dir'] = verify
+        else:
+            kwargs['ca_certs'] = verify
+        return {None: urllib3.PoolManager(**kwargs), 'kwargs': kwargs}
+
+    def _drop_idle(self, pools):
+        for key, pool in pools.items():
+            if key != 'kwargs':
+                pool.clear()
+
+    _close_pool = _drop_idle
+
+    def _manager(self, url):
+        pools = self.pool
+        proxy = self.proxies(url).get(urlsplit(url).scheme)
+        if proxy is None:
+            return pools[None]
+        with self._lock:
+            if proxy not in pools:
+                pools[proxy] = urllib3.ProxyManager(proxy, **pools['kwargs'])
+            return pools[proxy]
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                auth=None, timeout=None):
+        request = prepare(method, url, params, data, headers, auth)
+        if isinstance(timeout, tuple):
+            timeout = urllib3.Timeout(connect=timeout[0], read=timeout[1])
+        elif timeout is not None:
+            timeout = urllib3.Timeout(connect=timeout, read=timeout)
+        try:
+            raw = self._manager(request.url).urlopen(
+                request.method, request.url, body=request.body,
+                headers=request.headers, preload_content=False,
+                decode_content=False, timeout=timeout,
+                retries=RETRIES,
+                chunked=request.headers.get('Transfer-Encoding') ==
+                'chunked')
+        except urllib3.exceptions.HTTPError as e:
+            raise self._error(e, request)
+        return build_response(request, raw)
+
+    def _error(self, e, request):
+        "Maps a urllib3 error to the exception requests would raise."
+        errors = urllib3.exceptions
+        if isinstance(e, errors.MaxRetryError):
+            if isinstance(e.reason, errors.ResponseError):
+                return exceptions.TooManyRedirects(e, request=request)
+            e = e.reason
+        if isinstance(e, errors.SSLError):
+            return exceptions.SSLError(e, request=request)
+        if isinstance(e, errors.ProxyError):
+            return exceptions.ProxyError(e, request=request)
+        if isinstance(e, errors.NewConnectionError):
+            return exceptions.ConnectionError(e, request=request)
+        if isinstance(e, errors.ConnectTimeoutError):
+            return exceptions.ConnectTimeout(e, request=request)
+        if isinstance(e, errors.ReadTimeoutError):
+            return exceptions.ReadTimeout(e, request=request)
+        return exceptions.ConnectionError(e, request=request)
+
+
+def _httpx():
+    try:
+        import httpx
+    except ImportError:
+        raise NotImplementedError('You must install httpx to use the HTTP/2 '
+                                  'transport. Try "pip install '
+                                  'smartfile[http2]".')
+    return httpx
+
+
+def _httpx_error(httpx, e, request=None):
+    "Maps an httpx error to the exception requests would raise."
+    if isinstance(e, httpx.ConnectTimeout):
+        return exceptions.ConnectTimeout(e, request=request)
+    if isinstance(e, httpx.TimeoutException):
+        return exceptions.ReadTimeout(e, request=request)
+    if isinstance(e, httpx.TooManyRedirects):
+        return exceptions.TooManyRedirects(e, request=request)
+    if isinstance(e, httpx.ProxyError):
+        return exceptions.ProxyError(e, request=request)
+    if isinstance(e.__cause__ or e.__context__, ssl.SSLError):
+        return exceptions.SSLError(e, request=request)
+    return exceptions.ConnectionError(e, request=request)
+
+
+class HTTPXBody(object):
+    """The body of a streamed httpx response, read as the raw body of a
+    requests Response. Content encodings are always decoded."""
+    def __init__(self, httpx, response):
+        self.httpx = httpx
+        self.response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        self.reason = response.reason_phrase
+        self.decode_content = True
+        self._chunks = response.iter_bytes()
+        self._buffer = bytearray()
+
+    def _fill(self, amt):
+        try:
+            while amt is None or len(self._buffer) < amt:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer += chunk
+        except self.httpx.HTTPError as e:
+            raise _httpx_error(self.httpx, e)
+
+    def read(self, amt=None, decode_content=None):
+        self._fill(amt)
+        amt = len(self._buffer) if amt is None else amt
+        data = bytes(self._buffer[:amt])
+        del self._buffer[:amt]
+        return data
+
+    def stream(self, amt=CHUNK_SIZE, decode_content=None):
+        while True:
+            data = self.read(amt)
+            if not data:
+                break
+            yield data
+
+    def tell(self):
+        "The bytes received, before decoding."
+        return self.response.num_bytes_downloaded
+
+    def close(self):
+        self.response.close()
+
+    release_conn = close
+
+
+def _chunks(body):
+    "Reads a file-like body a chunk at a time."
+    while True:
+        chunk = body.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+class HTTP2Transport(Transport):
+    """
+    Sends requests with httpx, over HTTP/2 where the server supports it, so
+    that concurrent requests to a host share a single connection. Requires
+    httpx and h2. keepalive_timeout is the time after which idle connections
+    are closed, further arguments are passed to httpx.Client.
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, keepalive_timeout=60, **kwargs):
+        self.httpx = _httpx()
+        kwargs.setdefault('http2', True)
+        if 'verify' not in kwargs:
+            verify = verify_from_environ()
+            if verify is not True:
+                verify = ssl.create_default_context(
+                    capath=verify if os.path.isdir(verify) else None,
+                    cafile=None if os.path.isdir(verify) else verify)
+            kwargs['verify'] = verify
+        kwargs.setdefault('limits', self.httpx.Limits(
+            max_connections=pool_connections * pool_maxsize,
+            max_keepalive_connections=pool_maxsize,
+            keepalive_expiry=keepalive_timeout))
+        self.kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        "The httpx Client, created on first use."
+        with self._lock:
+            if self._client is None:
+                self._client = self.httpx.Client(
+                    timeout=None, follow_redirects=True,
+                    max_redirects=MAX_REDIRECTS, **self.kwargs)
+            return self._client
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                auth=None, timeout=None):
+        httpx = self.httpx
+        request = prepare(method, url, params, data, headers, auth)
+        body = request.body
+        if hasattr(body, 'read'):
+            body = _chunks(body)
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        client = self.client
+        try:
+            response = client.send(client.build_request(
+                request.method, request.url, headers=dict(request.headers),
+                content=body, timeout=timeout), stream=True)
+        except httpx.HTTPError as e:
+            raise _httpx_error(httpx, e, request)
+        return build_response(request, HTTPXBody(httpx, response))
+
+
+class MockTransport(Transport):
+    """
+    Answers requests with handler, without sockets. handler is called with
+    the prepared request, whose body has been read, and returns the status,
+    headers and body of the response.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                auth=None, timeout=None):
+        request = prepare(method, url, params, data, headers, auth)
+        if hasattr(request.body, 'read'):
+            request.body = request.body.read()
+        elif request.body is not None and \
+                not isinstance(request.body, (bytes, str)):
+            request.body = b''.join(request.body)
+        status, headers, body = self.handler(request)
+        return make_response(request, status, headers, io.BytesIO(body))
+
+
+TRANSPORTS = {
+    'requests': RequestsTransport,
+    'urllib3': Urllib3Transport,
+    'http2': HTTP2Transport,
+}
+
+
+def create(transport=None, **kwargs):
+    """Returns transport if it is a Transport, otherwise builds the one it
+    names (requests by default) with the pool settings in kwargs."""
+    if isinstance(transport, Transport):
+        return transport
+    return TRANSPORTS[transport or 'requests'](**kwargs)
@@ -1,9 +1,21 @@
 import cgi
+import hashlib
+import io
 import json
 import os
+import posixpath
+import re
+import shutil
+import socket
+import stat
+import subprocess
+import sys
 import tempfile
 import threading
+import time
+import types
 import unittest
+import zlib
 try:
     import urlparse
 except ImportError:
@@ -16,10 +28,60 @@ except ImportError:
     from http.server import HTTPServer
     from http.server import BaseHTTPRequestHandler
 
+import requests
+
 from smartfile import BasicClient
 from smartfile import OAuthClient
+from smartfile import jsondecode
+from smartfile import jsonstream
+from smartfile import netrc_authenticators
+from smartfile.cache import DiskHTTPCache
+from smartfile.cache import HTTPCache
+from smartfile.cache import MetadataCache
+from smartfile.compression import CompressedBody
+from smartfile.compression import Compression
+from smartfile.cache import SignatureCache
 from smartfile.errors import APIError
+from smartfile.metrics import Hooks
+from smartfile.metrics import MetricsCollector
+from smartfile.multipart import MultipartEncoder
+from smartfile.ratelimit import RateLimiter
+from smartfile.retry import RetryPolicy
+from smartfile.segmented import SegmentedDownload
+from smartfile.transport import MockTransport
+from smartfile import planner
+from smartfile import tasks
+from smartfile import transfer
+from smartfile.errors import TaskError
 from smartfile.errors import RequestError
+from smartfile.errors import ResponseError
+try:
+    import asyncio
+    from smartfile import aio
+except (ImportError, SyntaxError):
+    aio = None
+try:
+    import librsync
+except ImportError:
+    # A stand-in for python-librsync, whose deltas hold the whole source
+    # file, so that synchronization can be tested without it.
+    librsync = types.ModuleType('librsync')
+
+    def _copy(src, dst=None):
+        dst = dst or tempfile.SpooledTemporaryFile()
+        shutil.copyfileobj(src, dst)
+        dst.seek(0)
+        return dst
+    librsync.signature = lambda f, s=None, block_size=2048: _copy(
+        io.BytesIO(hashlib.sha1(f.read()).digest()), s)
+    librsync.delta = lambda f, s, d=None: _copy(f, d)
+    librsync.patch = lambda f, d, o=None: _copy(d, o)
+    sys.modules['librsync'] = librsync
+from smartfile import sync
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 
 API_KEY = '8g1aq1UF2QfZTG47yEVhVLAFqyfDdp'
@@ -35,12 +97,14 @@ class TestHTTPRequestHandler(BaseHTTPRequestHandler):
     A simple handler that logs requests for examination.
     """
     class TestRequest(object):
-        def __init__(self, method, path, query=None, data=None, headers=None):
+        def __init__(self, method, path, query=None, data=None, headers=None,
+                     client_address=None):
             self.method = method.upper()
             self.path = path
             self.query = query
             self.data = data
             self.headers = headers
+            self.client_address = client_address
 
     def __init__(self, *args, **kwargs):
         self.verbose = kwargs.pop('verbose', False)
@@ -54,7 +118,8 @@ class TestHTTPRequestHandler(BaseHTTPRequestHandler):
             data=data,
             headers=dict(
                 self.headers.items()
-            )
+            ),
+            client_address=self.client_address
         )
         self.server.requests.append(request)
         return request
@@ -65,17 +130,30 @@ class TestHTTPRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b"Hello World!")
 
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return b''.join(chunks)
+
     def parse_and_record(self, method):
         urlp = urlparse.urlparse(self.path)
         query, data = urlparse.parse_qs(urlp.query), None
         if method in ('POST', 'PUT'):
-            l = int(self.headers['Content-Length'])
+            body = self.read_body()
             ct, params = cgi.parse_header(self.headers['Content-Type'])
             if ct == 'multipart/form-data':
-                data = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                headers = {'content-type': self.headers['Content-Type'],
+                           'content-length': str(len(body))}
+                data = cgi.FieldStorage(fp=io.BytesIO(body), headers=headers,
                                         environ={'REQUEST_METHOD': 'POST'})
             else:
-                data = urlparse.parse_qs(self.rfile.read(l))
+                data = urlparse.parse_qs(body)
         request = self.record(method, urlp.path, query=query, data=data)
         self.respond(request)
 
@@ -165,17 +243,25 @@ class ClientTestCase(TestServerTestCase):
         super(ClientTestCase, self).setUp()
         self.client = self.getClient()
 
+    def tearDown(self):
+        self.client.close()
+        super(ClientTestCase, self).tearDown()
+
 
 class BasicTestCase(ClientTestCase):
+    client_class = BasicClient
+
     def getClient(self, **kwargs):
         kwargs.setdefault('key', API_KEY)
         kwargs.setdefault('password', API_PASSWORD)
         kwargs.setdefault('url', 'http://127.0.0.1:%s/' %
                           self.server.server_port)
-        return BasicClient(**kwargs)
+        return self.client_class(**kwargs)
 
 
 class OAuthTestCase(ClientTestCase):
+    client_class = OAuthClient
+
     def getClient(self, **kwargs):
         kwargs.setdefault('client_token', CLIENT_TOKEN)
         kwargs.setdefault('client_secret', CLIENT_SECRET)
@@ -183,7 +269,7 @@ class OAuthTestCase(ClientTestCase):
         kwargs.setdefault('access_secret', ACCESS_SECRET)
         kwargs.setdefault('url', 'http://127.0.0.1:%s/' %
                           self.server.server_port)
-        return OAuthClient(**kwargs)
+        return self.client_class(**kwargs)
 
 
 class UrlGenerationTestCase(object):
@@ -207,6 +293,21 @@ class UrlGenerationTestCase(object):
                 self.assertMethod('GET')
                 self.assertPath('/api/{0}/ping/'.format(client.version))
 
+    def test_slashes(self):
+        self.client.get('//path/info//', '//foo//bar')
+        self.assertPath('/api/{0}/path/info/foo/bar/'.format(
+            self.client.version))
+
+    def test_routes(self):
+        client = self.getClient()
+        url = client._url('/path/info', '/foo')
+        self.assertEqual(url, client._url('/path/info', '/foo'))
+        self.assertEqual(len(client._routes), 1)
+        # A route is not used once the base URL or version change.
+        client.version = '3'
+        self.assertNotEqual(client._url('/path/info', '/foo'), url)
+        self.assertEqual(len(client._routes), 2)
+
 
 class MethodTestCase(object):
     "Tests the HTTP methods used by CRUD methods."
@@ -319,6 +420,70 @@ class BasicClientTestCase(DownloadTestCase, UploadTestCase, MethodTestCase,
             except:
                 pass
 
+    def test_auth_built_once(self):
+        self.client.get('/ping')
+        auth = self.client._auth[1]
+        self.client.get('/ping')
+        self.assertIs(self.client._auth[1], auth)
+        self.client.password = API_PASSWORD[::-1]
+        self.client.get('/ping')
+        self.assertIsNot(self.client._auth[1], auth)
+        self.assertEqual(self.client._auth[1].password, API_PASSWORD[::-1])
+
+    def test_netrc_cached(self):
+        fd, t = tempfile.mkstemp()
+        try:
+            os.write(fd, b'machine example.com login foo password bar')
+            os.close(fd)
+            self.assertEqual(netrc_authenticators('example.com', t),
+                             ('foo', '', 'bar'))
+            with open(t, 'w') as f:
+                f.write('machine example.com login baz password qux')
+            # Parsed again once its mtime changes.
+            os.utime(t, (0, 0))
+            self.assertEqual(netrc_authenticators('example.com', t),
+                             ('baz', '', 'qux'))
+            self.assertIsNone(netrc_authenticators('example.org', t))
+        finally:
+            os.unlink(t)
+        self.assertIsNone(netrc_authenticators('example.com', t))
+
+    def test_netrc_home(self):
+        "The default file is found in the current home directory."
+        homes = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        home = os.environ.get('HOME')
+        try:
+            for login, path in zip(('foo', 'bar'), homes):
+                fd = os.open(os.path.join(path, '.netrc'),
+                             os.O_WRONLY | os.O_CREAT, 0o600)
+                os.write(fd, ('machine example.com login %s password '
+                              'secret' % login).encode('utf8'))
+                os.close(fd)
+            for login, path in zip(('foo', 'bar'), homes):
+                os.environ['HOME'] = path
+                self.assertEqual(netrc_authenticators('example.com'),
+                                 (login, '', 'secret'))
+        finally:
+            if home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = home
+            for path in homes:
+                shutil.rmtree(path)
+
+
+class StartupTestCase(unittest.TestCase):
+    def test_lazy_imports(self):
+        "Optional features are not imported with the package."
+        output = subprocess.check_output([sys.executable, '-c', (
+            'import sys, smartfile; print(sorted(set(sys.modules) & set(['
+            '"requests_oauthlib", "oauthlib", "aiohttp", "netrc", '
+            '"smartfile.sync", "smartfile.cache", "smartfile.compression", '
+            '"smartfile.metrics", "smartfile.ratelimit", '
+            '"smartfile.segmented", "smartfile.transfer", '
+            '"smartfile.jsonstream", "smartfile.tasks"])))')])
+        self.assertEqual(output.strip(), b'[]')
+
 
 class OAuthClientTestCase(DownloadTestCase, UploadTestCase, MethodTestCase,
                           UrlGenerationTestCase, OAuthTestCase):
@@ -330,6 +495,17 @@ class OAuthClientTestCase(DownloadTestCase, UploadTestCase, MethodTestCase,
         client = self.getClient(access_token='', access_secret='')
         self.assertRaises(APIError, client.get, '/ping')
 
+    def test_auth_built_once(self):
+        self.client.get('/ping')
+        auth = self.client._auth[1]
+        self.client.get('/ping')
+        self.assertIs(self.client._auth[1], auth)
+        self.client._access.token = ACCESS_TOKEN[::-1]
+        self.client.get('/ping')
+        self.assertIsNot(self.client._auth[1], auth)
+        self.client._access.token = ''
+        self.assertRaises(APIError, self.client.get, '/ping')
+
 
 class HTTPThrottleRequestHandler(TestHTTPRequestHandler):
     def respond(self, request):
@@ -355,6 +531,42 @@ class OAuthThrottleTestCase(ThrottleTestCase, OAuthTestCase):
     pass
 
 
+class HTTPThrottleOnceRequestHandler(TestHTTPRequestHandler):
+    "Throttles the first request."
+    def respond(self, request):
+        if len(self.server.requests) > 1:
+            return TestHTTPRequestHandler.respond(self, request)
+        self.send_response(503)
+        self.send_header("X-Throttle", "throttled; next=0.01 sec")
+        self.end_headers()
+        self.wfile.write(b"Request Throttled!")
+
+
+class ThrottleOnceTestCase(object):
+    handler = HTTPThrottleOnceRequestHandler
+
+    def test_upload_rewound(self):
+        self.client.upload('foobar.txt', io.BytesIO(b'hello world'))
+        self.assertRequestCount(2)
+        self.assertData('file', b'hello world')
+
+    def test_upload_stream(self):
+        chunks = (chunk for chunk in [b'hello ', b'world'])
+        self.assertRaises(ResponseError, self.client.upload, 'foobar.txt',
+                          chunks)
+        self.assertRequestCount(1)
+
+    def test_compressed_stream(self):
+        client = self.getClient(compression=Compression(upload=True))
+        chunks = (chunk for chunk in [b'hello ', b'world'])
+        self.assertRaises(ResponseError, client.upload, 'foobar.txt', chunks)
+        self.assertRequestCount(1)
+
+
+class BasicThrottleOnceTestCase(ThrottleOnceTestCase, BasicTestCase):
+    pass
+
+
 class HTTPJSONRequestHandler(TestHTTPRequestHandler):
     def respond(self, request):
         self.send_response(200)
@@ -371,6 +583,26 @@ class JSONTestCase(object):
         self.assertMethod('GET')
         self.assertEqual(r, {'foo': 'bar'})
 
+    def test_decoders(self):
+        for name in jsondecode.DECODERS:
+            try:
+                client = self.getClient(json_decoder=name)
+                self.assertEqual(client.get('/user'), {'foo': 'bar'})
+            except NotImplementedError:
+                # Not installed.
+                pass
+
+    def test_custom_decoder(self):
+        bodies = []
+        client = self.getClient(json_decoder=lambda body: bodies.append(body)
+                                or 'decoded')
+        self.assertEqual(client.get('/user'), 'decoded')
+        self.assertEqual(bodies, [b'{"foo": "bar"}'])
+
+    def test_unknown_decoder(self):
+        client = self.getClient(json_decoder='simplejson')
+        self.assertRaises(ValueError, client.get, '/user')
+
 
 class BasicJSONTestCase(JSONTestCase, BasicTestCase):
     pass
@@ -380,6 +612,2064 @@ class OAuthJSONTestCase(JSONTestCase, OAuthTestCase):
     pass
 
 
+class HTTPKeepAliveRequestHandler(TestHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    # Our server handles one connection at a time, don't let an idle
+    # keep-alive connection block it forever.
+    timeout = 1
+
+    def respond(self, request):
+        body = json.dumps({'foo': 'bar'}).encode('utf8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class KeepAliveTestCase(object):
+    handler = HTTPKeepAliveRequestHandler
+
+    def assertConnections(self, num):
+        addresses = set(r.client_address for r in self.server.requests)
+        self.assertEqual(num, len(addresses))
+
+    def test_connection_reused(self):
+        for i in range(5):
+            self.client.get('/ping')
+        self.assertRequestCount(5)
+        self.assertConnections(1)
+
+    def test_idle_connections_dropped(self):
+        with self.getClient(keepalive_timeout=0) as client:
+            for i in range(3):
+                time.sleep(0.01)
+                client.get('/ping')
+        self.assertConnections(3)
+
+    def test_close(self):
+        self.client.get('/ping')
+        self.client.close()
+        self.assertIsNone(self.client.transport._pool)
+        # The client reconnects on demand after being closed.
+        self.client.get('/ping')
+        self.assertConnections(2)
+
+    def test_context_manager(self):
+        with self.getClient() as client:
+            client.get('/ping')
+            self.assertIsNotNone(client.transport._pool)
+        self.assertIsNone(client.transport._pool)
+
+
+class BasicKeepAliveTestCase(KeepAliveTestCase, BasicTestCase):
+    pass
+
+
+class OAuthKeepAliveTestCase(KeepAliveTestCase, OAuthTestCase):
+    pass
+
+
+@unittest.skipIf(aio is None or aio.aiohttp is None, 'aiohttp unavailable')
+class AsyncTestCase(object):
+    "Runs each test's coroutines on a fresh event loop."
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        super(AsyncTestCase, self).setUp()
+
+    def tearDown(self):
+        self.wait(self.client.close())
+        self.loop.close()
+        TestServerTestCase.tearDown(self)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class AsyncMethodTestCase(AsyncTestCase):
+    def test_get_is_GET(self):
+        self.wait(self.client.get('/user', 'bobafett'))
+        self.assertMethod('GET')
+        self.assertPath('/api/{0}/user/bobafett/'.format(self.client.version))
+
+    def test_post_is_POST(self):
+        self.wait(self.client.post('/user', username='bobafett'))
+        self.assertMethod('POST')
+
+    def test_put_is_PUT(self):
+        self.wait(self.client.put('/user', 'bobafett', full_name='Boba Fett'))
+        self.assertMethod('PUT')
+
+    def test_delete_is_DELETE(self):
+        self.wait(self.client.delete('/user', 'bobafett'))
+        self.assertMethod('DELETE')
+
+    def test_file_response(self):
+        r = self.wait(self.client.get('/user'))
+        self.assertEqual(self.wait(r.read()), b'Hello World!')
+
+    def test_file_upload(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'foobar')
+            f.seek(0)
+            self.wait(self.client.upload('foobar.txt', f))
+        self.assertMethod('POST')
+        self.assertData('file', b'foobar')
+
+    def test_download(self):
+        fd, t = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.wait(self.client.download('/foobar.txt', download_to_path=t))
+            with open(t, 'rb') as f:
+                self.assertEqual(f.read(), b'Hello World!')
+        finally:
+            os.unlink(t)
+
+    def test_concurrent(self):
+        tasks = [self.loop.create_task(self.client.get('/ping'))
+                 for i in range(10)]
+        self.wait(asyncio.wait(tasks))
+        self.assertRequestCount(10)
+
+    def test_blocking_only(self):
+        for call in (lambda: self.client.upload_many([('/a', io.BytesIO())]),
+                     lambda: self.client.upload_tree(tempfile.gettempdir()),
+                     lambda: self.client.remove_many(['/a']),
+                     lambda: self.client.move_many([('/a', '/b')]),
+                     lambda: self.client.walk_tree('/'),
+                     lambda: self.client.download_tree('/', 'local'),
+                     lambda: self.client.iter_children('/')):
+            self.assertRaises(NotImplementedError, call)
+        self.assertRequestCount(0)
+
+    def test_retry_policy(self):
+        error = RequestError(aio.aiohttp.ClientConnectionError())
+        self.assertTrue(self.client.retry_policy.retryable('get', error))
+        # Those of the blocking clients are left alone.
+        self.assertFalse(RetryPolicy().retryable('get', error))
+
+    def test_list_fields(self):
+        self.wait(self.client.post('/path/oper/remove', path=['/a', '/b'],
+                                   recursive=True, skip=None))
+        data = self.server.requests[-1].data
+        self.assertEqual(data[b'path'], [b'/a', b'/b'])
+        self.assertEqual(data[b'recursive'], [b'True'])
+        self.assertNotIn(b'skip', data)
+        self.wait(self.client.get('/path/info', '/', fields=['name', 'size']))
+        self.assertEqual(self.server.requests[-1].query['fields'],
+                         ['name', 'size'])
+
+
+class AsyncBasicClientTestCase(AsyncMethodTestCase, BasicTestCase):
+    client_class = aio and aio.AsyncBasicClient
+
+
+class AsyncOAuthClientTestCase(AsyncMethodTestCase, OAuthTestCase):
+    client_class = aio and aio.AsyncOAuthClient
+
+    def test_blank_access_token(self):
+        client = self.getClient(access_token='', access_secret='')
+        self.assertRaises(APIError, self.wait, client.get('/ping'))
+
+
+class AsyncThrottleTestCase(AsyncTestCase):
+    handler = HTTPThrottleRequestHandler
+
+    def test_throttle_GET(self):
+        self.assertRaises(RequestError, self.wait, self.client.get('/ping'))
+        self.assertRequestCount(3)
+
+    def test_rate_limited(self):
+        self.client.rate_limiter = limiter = RateLimiter()
+        self.assertRaises(RequestError, self.wait, self.client.get('/ping'))
+        self.assertRequestCount(3)
+        self.assertEqual(limiter.throttles, 3)
+
+
+class AsyncBasicThrottleTestCase(AsyncThrottleTestCase, BasicTestCase):
+    client_class = aio and aio.AsyncBasicClient
+
+
+class AsyncJSONTestCase(AsyncTestCase):
+    handler = HTTPJSONRequestHandler
+
+    def test_json(self):
+        r = self.wait(self.client.get('/user'))
+        self.assertEqual(r, {'foo': 'bar'})
+
+
+class AsyncBasicJSONTestCase(AsyncJSONTestCase, BasicTestCase):
+    client_class = aio and aio.AsyncBasicClient
+
+
+class HTTPBrokenUploadRequestHandler(TestHTTPRequestHandler):
+    "Fails uploads into folders named broken."
+    def respond(self, request):
+        if request.method == 'POST' and '/broken/' in request.path:
+            self.send_response(500)
+            self.end_headers()
+        else:
+            TestHTTPRequestHandler.respond(self, request)
+
+
+class BulkUploadTestCase(object):
+    handler = HTTPBrokenUploadRequestHandler
+
+    def setUp(self):
+        super(BulkUploadTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        for path in ('a.txt', 'foo/b.txt', 'foo/bar/c.txt'):
+            path = os.path.join(self.root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'contents')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(BulkUploadTestCase, self).tearDown()
+
+    def paths(self, method):
+        return sorted(r.path for r in self.server.requests
+                      if r.path.startswith('/api/{0}/path/{1}/'.format(
+                          self.client.version, method)))
+
+    def test_upload_many(self):
+        files = [('/dst/one.txt', os.path.join(self.root, 'a.txt')),
+                 ('/dst/sub/two.txt', io.BytesIO(b'two'))]
+        results = self.client.upload_many(files, workers=2)
+        self.assertEqual([r.remote for r in results],
+                         ['/dst/one.txt', '/dst/sub/two.txt'])
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(self.paths('data'), [
+            '/api/{0}/path/data/dst/'.format(self.client.version),
+            '/api/{0}/path/data/dst/sub/'.format(self.client.version)])
+        mkdirs = [r.data[b'path'] for r in self.server.requests
+                  if r.path.endswith('/mkdir/')]
+        # Parents are created before their children.
+        self.assertEqual(mkdirs, [[b'/dst'], [b'/dst/sub']])
+
+    def test_upload_many_errors(self):
+        files = [('/broken/one.txt', io.BytesIO(b'one')),
+                 ('/fine/two.txt', io.BytesIO(b'two')),
+                 ('/fine/three.txt', os.path.join(self.root, 'missing.txt'))]
+        results = self.client.upload_many(files, create_folders=False)
+        self.assertEqual([r.ok for r in results], [False, True, False])
+        self.assertEqual(results[0].error.status_code, 500)
+        self.assertIsInstance(results[2].error, EnvironmentError)
+
+    def test_upload_tree(self):
+        results = self.client.upload_tree(self.root, '/backup')
+        self.assertEqual(sorted(r.remote for r in results), [
+            '/backup/a.txt', '/backup/foo/b.txt', '/backup/foo/bar/c.txt'])
+        self.assertTrue(all(r.ok for r in results))
+        self.assertData('file', b'contents')
+
+
+class BasicBulkUploadTestCase(BulkUploadTestCase, BasicTestCase):
+    pass
+
+
+class HTTPTreeRequestHandler(TestHTTPRequestHandler):
+    "Serves info and data for the remote files in tree."
+    tree = {
+        '/src': None,
+        '/src/a.txt': b'aaa',
+        '/src/sub': None,
+        '/src/sub/b.txt': b'bbbb',
+        '/src/sub/deeper': None,
+    }
+    time = '2013-02-23T22:49:30'
+
+    def info(self, path):
+        return {'path': path, 'isdir': self.tree[path] is None,
+                'size': len(self.tree[path] or b''), 'time': self.time}
+
+    def respond(self, request):
+        m = re.match('^/api/[^/]+/path/(info|data)(/.*)/$', request.path)
+        endpoint, path = m.groups()
+        if endpoint == 'info':
+            children = [self.info(p) for p in sorted(self.tree)
+                        if p.rsplit('/', 1)[0] == path]
+            body = json.dumps({'children': children}).encode('utf8')
+            content_type = 'application/json'
+        else:
+            body, content_type = self.tree[path], 'application/octet-stream'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DownloadTreeTestCase(object):
+    handler = HTTPTreeRequestHandler
+
+    def setUp(self):
+        super(DownloadTreeTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(DownloadTreeTestCase, self).tearDown()
+
+    def downloads(self):
+        return len([r for r in self.server.requests if '/data/' in r.path])
+
+    def test_download_tree(self):
+        results = self.client.download_tree('/src', self.root)
+        self.assertEqual(sorted((r.remote, r.result) for r in results),
+                         [('/src/a.txt', True), ('/src/sub/b.txt', True)])
+        with open(os.path.join(self.root, 'sub', 'b.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'bbbb')
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'sub',
+                                                   'deeper')))
+        # Nothing but the mirrored files is left behind.
+        self.assertEqual(sorted(os.listdir(self.root)), ['a.txt', 'sub'])
+
+    def test_walk_tree(self):
+        infos = self.client.walk_tree('/src')
+        self.assertEqual(sorted(infos), ['a.txt', 'sub', 'sub/b.txt',
+                                         'sub/deeper'])
+        self.assertEqual(infos['sub/b.txt']['size'], 4)
+
+    def test_skip_unchanged(self):
+        self.client.download_tree('/src', self.root)
+        self.assertEqual(self.downloads(), 2)
+        # Change one of the local files, only it is downloaded again.
+        with open(os.path.join(self.root, 'a.txt'), 'wb') as f:
+            f.write(b'changed')
+        results = self.client.download_tree('/src', self.root)
+        self.assertEqual(self.downloads(), 3)
+        self.assertEqual(sorted((r.remote, r.result) for r in results),
+                         [('/src/a.txt', True), ('/src/sub/b.txt', False)])
+
+    def test_file_mode(self):
+        self.client.download_tree('/src', self.root)
+        a = os.path.join(self.root, 'a.txt')
+        b = os.path.join(self.root, 'sub', 'b.txt')
+        # Not only readable by the owner, as temporary files are.
+        umask = os.umask(0o022)
+        os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(a).st_mode), 0o666 & ~umask)
+        # A file replaced keeps its mode.
+        os.chmod(b, 0o604)
+        with open(a, 'wb') as f:
+            f.write(b'changed')
+        os.chmod(a, 0o600)
+        self.client.download_tree('/src', self.root)
+        self.assertEqual(stat.S_IMODE(os.stat(a).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(b).st_mode), 0o604)
+
+
+class BasicDownloadTreeTestCase(DownloadTreeTestCase, BasicTestCase):
+    pass
+
+
+class StreamingUploadTestCase(object):
+    def test_progress(self):
+        reports = []
+        data = os.urandom(300 * 1024)
+        self.client.upload('foobar.bin', io.BytesIO(data),
+                           progress=lambda m: reports.append(
+                               (m.bytes_read, m.len)))
+        self.assertData('file', data)
+        # The file is read in chunks, and reported after each.
+        self.assertTrue(len(reports) > 4)
+        self.assertEqual(reports[-1][0], reports[-1][1])
+        request = self.server.requests[-1]
+        self.assertEqual(int(request.headers['Content-Length']),
+                         reports[-1][1])
+
+    def test_unknown_length(self):
+        chunks = (b'chunk %i ' % i for i in range(100))
+        self.client.upload('foobar.txt', chunks)
+        request = self.server.requests[-1]
+        self.assertEqual(request.headers['Transfer-Encoding'], 'chunked')
+        self.assertData('file', b''.join(b'chunk %i ' % i
+                                         for i in range(100)))
+
+    def test_post_fields(self):
+        self.client.post('/path/data', '/foo', name='bar',
+                         file=('foobar.txt', io.BytesIO(b'foobar')))
+        self.assertData('name', 'bar')
+        self.assertData('file', b'foobar')
+
+    def test_post_field_types(self):
+        self.client.post('/path/data/', '/foo', overwrite=True, count=3,
+                         tags=['a', 'b'], skip=None,
+                         file=('foobar.txt', io.BytesIO(b'foobar')))
+        data = self.server.requests[-1].data
+        self.assertEqual(data.getvalue('overwrite'), 'True')
+        self.assertEqual(data.getvalue('count'), '3')
+        self.assertEqual(data.getlist('tags'), ['a', 'b'])
+        self.assertNotIn('skip', data)
+        self.assertEqual(data.getvalue('file'), b'foobar')
+
+
+class MultipartEncoderTestCase(unittest.TestCase):
+    class ReadRecorder(io.BytesIO):
+        def read(self, size=-1):
+            self.largest = max(getattr(self, 'largest', 0), size)
+            return io.BytesIO.read(self, size)
+
+    def test_bounded_reads(self):
+        f = self.ReadRecorder(b'x' * 1024 * 1024)
+        encoder = MultipartEncoder([('file', f)], chunk_size=1024)
+        body = b''.join(iter(lambda: encoder.read(8192), b''))
+        self.assertEqual(f.largest, 1024)
+        self.assertEqual(len(body), encoder.len)
+
+    def test_rewind(self):
+        encoder = MultipartEncoder([('name', 'value'),
+                                    ('file', io.BytesIO(b'foobar'))])
+        body = encoder.read()
+        encoder.rewind()
+        self.assertEqual(b''.join(encoder), body)
+        self.assertEqual(len(body), encoder.len)
+
+    def test_temporary_files(self):
+        with tempfile.SpooledTemporaryFile(max_size=1024) as spooled:
+            spooled.write(b'signature')
+            spooled.seek(0)
+            encoder = MultipartEncoder([('signature', spooled)])
+            self.assertIn(b'filename="signature"', encoder.read())
+            # Still in memory.
+            self.assertFalse(spooled._rolled)
+            spooled.seek(0)
+            spooled.rollover()
+            # Now named by its descriptor.
+            encoder = MultipartEncoder([('signature', spooled)])
+            self.assertEqual(len(encoder.read()), encoder.len)
+
+
+class BasicStreamingUploadTestCase(StreamingUploadTestCase, BasicTestCase):
+    pass
+
+
+class HTTPRangeRequestHandler(TestHTTPRequestHandler):
+    "Serves content, honouring Range and If-Range headers."
+    content = bytes(bytearray(range(256))) * 40
+    etag = '"v1"'
+    ranges = True
+
+    def respond(self, request):
+        m = re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        if self.ranges and m and (not if_range or if_range == self.etag):
+            start, end = int(m.group(1)), int(m.group(2))
+            end = min(end, len(self.content) - 1)
+            body = self.content[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (
+                start, end, len(self.content)))
+        else:
+            body = self.content
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTPNoRangeRequestHandler(HTTPRangeRequestHandler):
+    ranges = False
+
+
+class HTTPNoValidatorRangeRequestHandler(HTTPRangeRequestHandler):
+    etag = None
+
+
+class LocalDownloadTestCase(object):
+    def setUp(self):
+        super(LocalDownloadTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.local = os.path.join(self.root, 'foobar.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(LocalDownloadTestCase, self).tearDown()
+
+    def assertDownloaded(self):
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), self.handler.content)
+        self.assertEqual(os.listdir(self.root), ['foobar.bin'])
+
+
+class SegmentedDownloadTestCase(LocalDownloadTestCase):
+    handler = HTTPRangeRequestHandler
+
+    def test_segmented(self):
+        self.client.download('/foobar.bin', download_to_path=self.local,
+                             workers=3, segment_size=1000)
+        self.assertDownloaded()
+        self.assertRequestCount(11)
+
+    def test_resume(self):
+        # Pretend an earlier download fetched all but segments 3 and 7.
+        content = bytearray(self.handler.content)
+        for i in (3, 7):
+            content[i * 1000:(i + 1) * 1000] = b'\0' * 1000
+        with open(self.local + '.part', 'wb') as f:
+            f.write(content)
+        with open(self.local + '.part.json', 'w') as f:
+            json.dump({'size': len(content), 'segment_size': 1000,
+                       'validator': self.handler.etag,
+                       'done': [i for i in range(11) if i not in (3, 7)]}, f)
+        self.client.download('/foobar.bin', download_to_path=self.local,
+                             workers=2, segment_size=5000)
+        self.assertDownloaded()
+        self.assertRequestCount(2)
+
+    def test_resume_changed(self):
+        with open(self.local + '.part', 'wb') as f:
+            f.write(b'\0' * len(self.handler.content))
+        with open(self.local + '.part.json', 'w') as f:
+            json.dump({'size': len(self.handler.content),
+                       'segment_size': 1000, 'validator': '"v0"',
+                       'done': list(range(1, 11))}, f)
+        self.client.download('/foobar.bin', download_to_path=self.local,
+                             workers=2)
+        self.assertDownloaded()
+        self.assertRequestCount(1)
+
+
+class NoValidatorDownloadTestCase(LocalDownloadTestCase):
+    handler = HTTPNoValidatorRangeRequestHandler
+
+    def test_not_resumed(self):
+        # The file may have changed since the segments were downloaded.
+        with open(self.local + '.part', 'wb') as f:
+            f.write(b'\0' * len(self.handler.content))
+        with open(self.local + '.part.json', 'w') as f:
+            json.dump({'size': len(self.handler.content),
+                       'segment_size': 1000, 'validator': None,
+                       'done': list(range(1, 11))}, f)
+        self.client.download('/foobar.bin', download_to_path=self.local,
+                             workers=3, segment_size=1000)
+        self.assertDownloaded()
+        self.assertRequestCount(11)
+
+    def test_no_state(self):
+        download = SegmentedDownload(self.client, '/foobar.bin', self.local,
+                                     1, 1000)
+        download.state = {'size': 10, 'segment_size': 1000,
+                          'validator': None, 'done': [0]}
+        download._save_state()
+        self.assertFalse(os.path.exists(download.state_path))
+
+
+class NoRangeDownloadTestCase(LocalDownloadTestCase):
+    handler = HTTPNoRangeRequestHandler
+
+    def test_fallback(self):
+        self.client.download('/foobar.bin', download_to_path=self.local,
+                             workers=3, segment_size=1000)
+        self.assertDownloaded()
+        self.assertRequestCount(1)
+
+
+class BasicSegmentedDownloadTestCase(SegmentedDownloadTestCase,
+                                     BasicTestCase):
+    pass
+
+
+class BasicNoRangeDownloadTestCase(NoRangeDownloadTestCase, BasicTestCase):
+    pass
+
+
+class BasicNoValidatorDownloadTestCase(NoValidatorDownloadTestCase,
+                                       BasicTestCase):
+    pass
+
+
+class HTTPInfoRequestHandler(TestHTTPRequestHandler):
+    def respond(self, request):
+        body = json.dumps({'path': request.path}).encode('utf8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class InfoCacheTestCase(object):
+    handler = HTTPInfoRequestHandler
+
+    def setUp(self):
+        self.cache = MetadataCache(maxsize=2, ttl=60)
+        super(InfoCacheTestCase, self).setUp()
+
+    def getClient(self, **kwargs):
+        kwargs.setdefault('info_cache', self.cache)
+        return super(InfoCacheTestCase, self).getClient(**kwargs)
+
+    def test_cached(self):
+        info = self.client.get('/path/info', '/foo')
+        self.assertEqual(self.client.get('/path/info', 'foo/'), info)
+        self.assertRequestCount(1)
+        # Other parameters are cached separately.
+        self.client.get('/path/info', '/foo', children=True)
+        self.assertRequestCount(2)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_list_params(self):
+        info = self.client.get('/path/info', '/foo', fields=['name', 'size'])
+        self.assertEqual(self.client.get('/path/info', '/foo',
+                                         fields=['name', 'size']), info)
+        self.assertRequestCount(1)
+        self.client.get('/path/info', '/foo', fields=['name'])
+        self.assertRequestCount(2)
+
+    def test_expired(self):
+        self.cache.ttl = 0.01
+        self.client.get('/path/info', '/foo')
+        time.sleep(0.02)
+        self.client.get('/path/info', '/foo')
+        self.assertRequestCount(2)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_evicted(self):
+        for path in ('/foo', '/bar', '/baz', '/foo'):
+            self.client.get('/path/info', path)
+        self.assertRequestCount(4)
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_invalidation(self):
+        paths = ('/', '/foo', '/foo/bar.txt', '/foo/sub/baz.txt', '/other')
+        self.cache.maxsize = 10
+        for path in paths:
+            self.client.get('/path/info', path)
+        self.client.upload('/foo/bar.txt', io.BytesIO(b'bar'))
+        self.client.move('/foo/sub', '/other')
+        self.client.post('/path/oper/remove', path='/spam')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_unrelated_kept(self):
+        self.client.get('/path/info', '/foo/bar.txt')
+        self.client.get('/path/info', '/other')
+        self.client.remove('/foo/bar.txt')
+        self.client.get('/path/info', '/other')
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+
+class BasicInfoCacheTestCase(InfoCacheTestCase, BasicTestCase):
+    pass
+
+
+class HTTPPagedRequestHandler(TestHTTPRequestHandler):
+    """
+    Lists 25 children, a page at a time, of at most server.max_limit
+    children. With server.ignore_page, always sends the first page. With
+    metadata, tells the number of pages and of items.
+    """
+    children = [{'path': '/foo/%s' % i, 'size': i} for i in range(25)]
+    metadata = True
+
+    def respond(self, request):
+        page = int(request.query['page'][0])
+        if self.server.ignore_page:
+            page = 1
+        limit = min(int(request.query['limit'][0]), self.server.max_limit)
+        listing = {
+            'path': '/foo', 'isdir': True,
+            'children': self.children[(page - 1) * limit:page * limit]}
+        if self.metadata:
+            listing.update(items=len(self.children),
+                           pages=-(-len(self.children) // limit))
+        body = json.dumps(listing).encode('utf8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class IterChildrenTestCase(object):
+    handler = HTTPPagedRequestHandler
+
+    def setUp(self):
+        super(IterChildrenTestCase, self).setUp()
+        self.server.max_limit = 100
+        self.server.ignore_page = False
+
+    def test_pages(self):
+        children = list(self.client.iter_children('/foo', page_size=10))
+        self.assertEqual(children, self.handler.children)
+        self.assertRequestCount(3)
+        self.assertEqual(self.server.requests[-1].query['page'], ['3'])
+
+    def test_lazy(self):
+        children = self.client.iter_children('/foo', page_size=10)
+        self.assertEqual(next(children), self.handler.children[0])
+        self.assertRequestCount(1)
+        children.close()
+
+    def test_exact_pages(self):
+        children = list(self.client.iter_children('/foo', page_size=5))
+        self.assertEqual(len(children), 25)
+        self.assertRequestCount(5)
+
+    def test_capped_limit(self):
+        self.server.max_limit = 10
+        children = list(self.client.iter_children('/foo', page_size=20))
+        self.assertEqual(children, self.handler.children)
+        self.assertRequestCount(3)
+
+    def test_page_ignored(self):
+        self.server.ignore_page = True
+        children = list(self.client.iter_children('/foo', page_size=10))
+        self.assertEqual(children, self.handler.children[:10])
+        self.assertRequestCount(2)
+
+
+class NoMetadataIterChildrenTestCase(IterChildrenTestCase):
+    "Pages without the number of pages or of children."
+    class handler(HTTPPagedRequestHandler):
+        metadata = False
+
+    def test_pages(self):
+        children = list(self.client.iter_children('/foo', page_size=10))
+        self.assertEqual(children, self.handler.children)
+        # The last, empty, page shows that the listing is complete.
+        self.assertRequestCount(4)
+
+    def test_exact_pages(self):
+        children = list(self.client.iter_children('/foo', page_size=5))
+        self.assertEqual(len(children), 25)
+        self.assertRequestCount(6)
+
+    def test_capped_limit(self):
+        self.server.max_limit = 10
+        children = list(self.client.iter_children('/foo', page_size=20))
+        self.assertEqual(children, self.handler.children)
+        self.assertRequestCount(4)
+
+
+class JSONStreamTestCase(unittest.TestCase):
+    document = json.dumps({
+        'before': {'children': ['not', 'these'], 'text': '}]"'},
+        'children': [{'name': u'\u00e9t\u00e9 %s' % i, 'size': 10 ** i}
+                     for i in range(20)] + [12345678901234567890, 'end'],
+        'after': [1, 2, 3],
+    }, ensure_ascii=False).encode('utf8')
+
+    def test_items(self):
+        for chunk_size in (1, 7, 4096):
+            items = list(jsonstream.iter_items(io.BytesIO(self.document),
+                                               'children', chunk_size))
+            self.assertEqual(items, json.loads(
+                self.document.decode('utf8'))['children'])
+
+    def test_empty(self):
+        for document in (b'{}', b'{"children": []}', b'{"other": 1}'):
+            self.assertEqual(list(jsonstream.iter_items(
+                io.BytesIO(document), 'children')), [])
+
+    def test_members(self):
+        members = {}
+        items = list(jsonstream.iter_items(io.BytesIO(self.document),
+                                           'children', 7, members))
+        self.assertEqual(len(items), 22)
+        self.assertEqual(sorted(members), ['after', 'before'])
+        self.assertEqual(members['after'], [1, 2, 3])
+
+    def test_invalid(self):
+        items = jsonstream.iter_items(io.BytesIO(b'{"children": [1, 2'),
+                                      'children')
+        self.assertRaises(ValueError, list, items)
+
+
+class BasicIterChildrenTestCase(IterChildrenTestCase, BasicTestCase):
+    pass
+
+
+class BasicNoMetadataIterChildrenTestCase(NoMetadataIterChildrenTestCase,
+                                          BasicTestCase):
+    pass
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_rate(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        start = time.time()
+        for i in range(6):
+            limiter.acquire()
+        # The first token is available after 1/50th of a second.
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_burst(self):
+        limiter = RateLimiter(rate=1, burst=5)
+        time.sleep(0.01)
+        limiter._tokens = 5
+        start = time.time()
+        for i in range(5):
+            limiter.acquire()
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_unlimited(self):
+        limiter = RateLimiter()
+        for i in range(100):
+            self.assertEqual(limiter.reserve(), 0)
+
+    def test_throttled(self):
+        limiter = RateLimiter()
+        for i in range(10):
+            limiter.acquire()
+        limiter.throttled(0.05)
+        # The rate is learned from the rate achieved before throttling.
+        self.assertEqual(limiter.rate, 8)
+        self.assertGreater(limiter.reserve(), 0.04)
+        rate = limiter.rate
+        limiter.success()
+        self.assertGreater(limiter.rate, rate)
+        limiter.throttled(0)
+        self.assertLess(limiter.rate, rate)
+
+    def test_min_rate(self):
+        limiter = RateLimiter(min_rate=2)
+        for i in range(5):
+            limiter.throttled(0)
+        self.assertEqual(limiter.rate, 2)
+
+    def test_threads(self):
+        limiter = RateLimiter(rate=100, burst=1)
+        start = time.time()
+        threads = [threading.Thread(target=lambda: [
+            limiter.acquire() for i in range(5)]) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+    def test_shared(self):
+        limiter = RateLimiter.shared('example.com', 'key')
+        self.assertIs(RateLimiter.shared('example.com', 'key'), limiter)
+        self.assertIsNot(RateLimiter.shared('example.com', 'other'), limiter)
+
+
+class RateLimitedTestCase(object):
+    handler = HTTPThrottleRequestHandler
+
+    def test_throttled(self):
+        limiter = RateLimiter()
+        client = self.getClient(rate_limiter=limiter)
+        start = time.time()
+        self.assertRaises(RequestError, client.get, '/ping')
+        self.assertGreaterEqual(time.time() - start, 0.02)
+        self.assertRequestCount(3)
+        self.assertEqual(limiter.throttles, 3)
+        self.assertIsNotNone(limiter.rate)
+
+    def test_no_wait(self):
+        limiter = RateLimiter()
+        client = self.getClient(rate_limiter=limiter, throttle_wait=False)
+        self.assertRaises(APIError, client.get, '/ping')
+        self.assertRequestCount(1)
+        self.assertEqual(limiter.throttles, 1)
+
+    def test_shared(self):
+        first = self.getClient(rate_limiter=True)
+        second = self.getClient(rate_limiter=True)
+        self.assertIs(first._limiter(), second._limiter())
+        self.assertIsInstance(first._limiter(), RateLimiter)
+
+
+class BasicRateLimitedTestCase(RateLimitedTestCase, BasicTestCase):
+    pass
+
+
+class OAuthRateLimitedTestCase(RateLimitedTestCase, OAuthTestCase):
+    pass
+
+
+class HTTPFlakyRequestHandler(TestHTTPRequestHandler):
+    "Fails the first two requests with a bad gateway error."
+    def respond(self, request):
+        if len(self.server.requests) > 2:
+            return TestHTTPRequestHandler.respond(self, request)
+        self.send_response(502)
+        self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(b"Bad Gateway")
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=1, multiplier=2, max_backoff=5,
+                             jitter=False)
+        self.assertEqual([policy.backoff_delay(i) for i in range(1, 6)],
+                         [1, 2, 4, 5, 5])
+        policy.jitter = True
+        for i in range(20):
+            self.assertTrue(0 <= policy.backoff_delay(3) <= 4)
+
+    def test_retryable(self):
+        policy = RetryPolicy()
+        error = RequestError(requests.exceptions.ConnectionError())
+        self.assertTrue(policy.retryable('get', error))
+        self.assertTrue(policy.retryable('DELETE', error))
+        self.assertFalse(policy.retryable('post', error))
+        self.assertFalse(policy.retryable('get', RequestError(
+            requests.exceptions.SSLError())))
+        self.assertFalse(policy.retryable('get', RequestError(
+            requests.exceptions.InvalidURL())))
+
+    def test_delay(self):
+        policy = RetryPolicy(max_attempts=3, backoff=1, jitter=False,
+                             budget=10)
+        error = RequestError(requests.exceptions.Timeout())
+        self.assertEqual(policy.delay('get', error, 1, 0), 1)
+        self.assertEqual(policy.delay('get', error, 2, 0), 2)
+        self.assertIsNone(policy.delay('get', error, 3, 0))
+        # Beyond the budget.
+        self.assertIsNone(policy.delay('get', error, 2, 9))
+
+
+class RetryTestCase(object):
+    handler = HTTPFlakyRequestHandler
+
+    def getClient(self, **kwargs):
+        kwargs.setdefault('retry_policy', RetryPolicy(backoff=0.01))
+        return super(RetryTestCase, self).getClient(**kwargs)
+
+    def test_retried(self):
+        self.assertEqual(self.client.get('/ping').read(), b'Hello World!')
+        self.assertRequestCount(3)
+
+    def test_exhausted(self):
+        client = self.getClient(retry_policy=RetryPolicy(max_attempts=2,
+                                                         backoff=0.01))
+        with self.assertRaises(ResponseError) as cm:
+            client.get('/ping')
+        self.assertEqual(cm.exception.status_code, 502)
+        self.assertRequestCount(2)
+
+    def test_budget(self):
+        client = self.getClient(retry_policy=RetryPolicy(backoff=1,
+                                                         budget=0.5,
+                                                         jitter=False))
+        self.assertRaises(ResponseError, client.get, '/ping')
+        self.assertRequestCount(1)
+
+    def test_post_not_retried(self):
+        self.assertRaises(ResponseError, self.client.post, '/path/oper/move',
+                          src='/foo', dst='/bar')
+        self.assertRequestCount(1)
+
+    def test_upload_rewound(self):
+        client = self.getClient(retry_policy=RetryPolicy(
+            backoff=0.01, methods=('post',)))
+        client.upload('foo.txt', io.BytesIO(b'foo' * 1000))
+        self.assertRequestCount(3)
+        self.assertData('file', b'foo' * 1000)
+
+
+class BasicRetryTestCase(RetryTestCase, BasicTestCase):
+    pass
+
+
+class OAuthRetryTestCase(RetryTestCase, OAuthTestCase):
+    pass
+
+
+class HTTPTaskRequestHandler(TestHTTPRequestHandler):
+    """
+    Starts a task named after the path operated on. Tasks succeed on their
+    third poll, except those whose name starts with fail, which fail, and
+    those whose name starts with slow, which never finish.
+    """
+    def respond(self, request):
+        if request.method == 'POST':
+            path = (request.data.get(b'path') or request.data[b'src'])[0]
+            body = {'uuid': path.decode('utf8').strip('/')}
+        else:
+            uuid = request.path.split('/')[-2]
+            polls = len([r for r in self.server.requests
+                         if r.path == request.path])
+            status = 'PENDING'
+            if uuid.startswith('fail'):
+                status = 'FAILURE'
+            elif polls >= 3 and not uuid.startswith('slow'):
+                status = 'SUCCESS'
+            body = {'uuid': uuid, 'result': {'status': status}}
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf8'))
+
+
+class TaskTestCase(object):
+    handler = HTTPTaskRequestHandler
+
+    def setUp(self):
+        super(TaskTestCase, self).setUp()
+        self.client.tasks.min_interval = 0.01
+        self.client.tasks.max_interval = 0.05
+
+    def polls(self):
+        return len([r for r in self.server.requests if r.method == 'GET'])
+
+    def test_result(self):
+        task = self.client.move('/foo', '/bar')
+        self.assertEqual(task['uuid'], 'foo')
+        self.assertEqual(task.result(timeout=5), {'status': 'SUCCESS'})
+        self.assertEqual(task.status, 'SUCCESS')
+        self.assertEqual(self.polls(), 3)
+        self.assertPath('/api/{0}/task/foo/'.format(self.client.version))
+
+    def test_failure(self):
+        task = self.client.remove('/failed')
+        self.assertRaises(TaskError, task.result, 5)
+
+    def test_not_polled(self):
+        # Polling starts when the task is waited for.
+        self.client.remove('/foo')
+        time.sleep(0.05)
+        self.assertEqual(self.polls(), 0)
+
+    def test_timeout(self):
+        task = self.client.remove('/slow')
+        self.assertFalse(task.wait(0.1))
+        self.assertRaises(tasks.TimeoutError, task.result, 0)
+
+    def test_wait(self):
+        started = [self.client.remove(path)
+                   for path in ('/foo', '/bar', '/slow')]
+        done, not_done = tasks.wait(started, timeout=0.5)
+        self.assertEqual([t.uuid for t in done], ['foo', 'bar'])
+        self.assertEqual([t.uuid for t in not_done], ['slow'])
+        done, not_done = self.client.tasks.wait(
+            return_when=tasks.FIRST_COMPLETED, timeout=0.1)
+        self.assertEqual((done, len(not_done)), ([], 1))
+
+    def test_wait_any(self):
+        started = [self.client.remove(path) for path in ('/slow', '/fail')]
+        done, not_done = tasks.wait(started, timeout=5,
+                                    return_when=tasks.FIRST_COMPLETED)
+        self.assertEqual([t.uuid for t in done], ['fail'])
+
+    def test_callback(self):
+        task = self.client.remove('/foo')
+        finished = threading.Event()
+        task.add_done_callback(lambda task: finished.set())
+        self.assertTrue(finished.wait(5))
+        # Called at once when already done.
+        called = []
+        task.add_done_callback(called.append)
+        self.assertEqual(called, [task])
+
+    def test_poll_error(self):
+        def decoder(body):
+            if b'"result"' in body and b'"bad"' in body:
+                raise RuntimeError('Bad status')
+            return json.loads(body.decode('utf8'))
+        self.client.json_decoder = decoder
+        task = self.client.remove('/bad')
+        self.assertRaises(RuntimeError, task.result, 5)
+        # The poller survived, or was started again.
+        self.assertEqual(self.client.remove('/foo').result(5),
+                         {'status': 'SUCCESS'})
+
+    def test_backoff(self):
+        self.client.tasks.max_interval = 1
+        self.client.remove('/slow').wait(0.5)
+        # The interval grows by half after each poll, rather than the task
+        # being polled 50 times.
+        self.assertLessEqual(self.polls(), 8)
+
+
+class BasicTaskTestCase(TaskTestCase, BasicTestCase):
+    pass
+
+
+class HTTPOperRequestHandler(TestHTTPRequestHandler):
+    "Starts a task per request, fails requests for paths under /fail."
+    def respond(self, request):
+        paths = request.data.get(b'path') or request.data[b'src']
+        if any(path.startswith(b'/fail') for path in paths):
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({'uuid': b','.join(paths).decode(
+            'utf8')}).encode('utf8'))
+
+
+class BatchTestCase(object):
+    handler = HTTPOperRequestHandler
+
+    def test_remove_many(self):
+        paths = ['/foo/%s' % i for i in range(5)]
+        results = self.client.remove_many(paths, batch_size=2)
+        self.assertRequestCount(3)
+        self.assertEqual([r.remote for r in results], paths)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertIs(results[0].result, results[1].result)
+        self.assertEqual(results[4].result.uuid, '/foo/4')
+        batches = sorted(r.data[b'path'] for r in self.server.requests)
+        self.assertEqual(batches[0], [b'/foo/0', b'/foo/1'])
+
+    def test_move_many(self):
+        pairs = [('/a', '/x'), ('/b', '/y'), ('c', '/x'), ('/d', 'x')]
+        results = self.client.move_many(pairs)
+        self.assertRequestCount(2)
+        self.assertEqual([r.result.uuid for r in results],
+                         ['/a/,/c/,/d/', '/b/', '/a/,/c/,/d/', '/a/,/c/,/d/'])
+        self.assertEqual(sorted(r.data[b'dst'] for r in self.server.requests),
+                         [[b'/x/'], [b'/y/']])
+
+    def test_failed_batch(self):
+        results = self.client.remove_many(['/foo', '/fail', '/bar'],
+                                          batch_size=2)
+        self.assertEqual([r.ok for r in results], [False, False, True])
+        self.assertEqual(results[0].error.status_code, 500)
+
+
+class BasicBatchTestCase(BatchTestCase, BasicTestCase):
+    pass
+
+
+class AsyncOperTestCase(AsyncTestCase):
+    handler = HTTPOperRequestHandler
+
+    def test_remove(self):
+        task = self.wait(self.client.remove(['/foo', '/bar']))
+        self.assertEqual(task, {'uuid': '/foo,/bar'})
+        self.assertNotIsInstance(task, tasks.Task)
+
+    def test_move(self):
+        task = self.wait(self.client.move('foo', 'bar'))
+        self.assertEqual(task, {'uuid': '/foo/'})
+        self.assertEqual(self.server.requests[-1].data[b'dst'], [b'/bar/'])
+
+
+class AsyncBasicOperTestCase(AsyncOperTestCase, BasicTestCase):
+    client_class = aio and aio.AsyncBasicClient
+
+
+class SignatureCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = SignatureCache(os.path.join(self.root, 'cache'),
+                                    maxsize=100)
+        self.path = os.path.join(self.root, 'file')
+        self.write(b'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, data, path=None):
+        with open(path or self.path, 'wb') as f:
+            f.write(data)
+
+    def test_cached(self):
+        key = self.cache.key(self.path, 1024)
+        self.assertIsNone(self.cache.get(key))
+        with self.cache.set(key, io.BytesIO(b'signature')) as f:
+            self.assertEqual(f.read(), b'signature')
+        with self.cache.get(self.cache.key(self.path, 1024)) as f:
+            self.assertEqual(f.read(), b'signature')
+        self.assertEqual(self.cache.stats(), {'size': 9, 'hits': 1,
+                                              'misses': 1, 'evictions': 0})
+        # Other block sizes have their own signatures.
+        self.assertIsNone(self.cache.get(self.cache.key(self.path, 2048)))
+
+    def test_changed(self):
+        key = self.cache.key(self.path)
+        self.cache.set(key, io.BytesIO(b'signature')).close()
+        self.write(b'other')
+        self.assertNotEqual(self.cache.key(self.path), key)
+        # Replaced by a file of the same size and mtime.
+        other = os.path.join(self.root, 'other')
+        self.write(b'data', other)
+        st = os.stat(self.path)
+        os.utime(other, (st.st_atime, st.st_mtime))
+        os.rename(other, self.path)
+        self.assertNotEqual(self.cache.key(self.path), key)
+
+    def test_evicted(self):
+        keys = [('key', i) for i in range(3)]
+        for i, key in enumerate(keys[:2]):
+            self.cache.set(key, io.BytesIO(b'x' * 40)).close()
+            # Make the order of use unambiguous.
+            os.utime(self.cache._path(key), (i, i))
+        self.cache.get(keys[0]).close()
+        self.cache.set(keys[2], io.BytesIO(b'x' * 40)).close()
+        self.assertEqual(self.cache.size(), 80)
+        self.assertIsNone(self.cache.get(keys[1]))
+        f = self.cache.get(keys[0])
+        self.assertIsNotNone(f)
+        f.close()
+        self.assertEqual(self.cache.evictions, 1)
+
+
+class BlockSizeTestCase(unittest.TestCase):
+    def test_sqrt_block_size(self):
+        self.assertEqual(sync.sqrt_block_size(0), sync.MIN_BLOCK_SIZE)
+        self.assertEqual(sync.sqrt_block_size(1024 ** 3), 32768)
+        self.assertEqual(sync.sqrt_block_size(10 ** 7), 3160)
+        self.assertEqual(sync.sqrt_block_size(1024 ** 5),
+                         sync.MAX_BLOCK_SIZE)
+
+    def test_resolved(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 10 ** 6)
+            f.flush()
+            local = sync.LocalFile(f.name)
+            self.assertEqual(local.block_size(sync.sqrt_block_size), 1000)
+            self.assertEqual(local.block_size(2048), 2048)
+        remote = sync.RemoteFile('/foo', None, size=4 * 10 ** 6)
+        self.assertEqual(remote.block_size(sync.sqrt_block_size), 2000)
+
+
+class HTTPSyncRequestHandler(TestHTTPRequestHandler):
+    """
+    Keeps the remote files in server.files, as path: (data, mtime). Serves
+    their info and data, folder listings, uploads, removals and the sync
+    API. Folders exist while they contain files.
+    """
+    pattern = re.compile('^/api/[^/]+/path/(info|data|oper/mkdir|oper/remove'
+                         '|sync/signature|sync/delta|sync/patch)(/.*)?/$')
+
+    def info(self, path):
+        files = self.server.files
+        if path in files:
+            data, mtime = files[path]
+            return {'path': path, 'isdir': False, 'size': len(data),
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                          time.gmtime(mtime))}
+        prefix = path.rstrip('/') + '/'
+        if any(p.startswith(prefix) for p in files):
+            return {'path': path, 'isdir': True, 'size': 0,
+                    'time': '2013-02-23T22:49:30'}
+        return None
+
+    def respond(self, request):
+        endpoint, path = self.pattern.match(request.path).groups()
+        path, files, body = path or '/', self.server.files, {}
+        if endpoint == 'info':
+            body = self.info(path)
+            if body is not None and request.query.get('children'):
+                prefix = path.rstrip('/') + '/'
+                names = sorted(set(p[len(prefix):].split('/')[0]
+                                   for p in files if p.startswith(prefix)))
+                body['children'] = [self.info(prefix + name)
+                                    for name in names]
+                body.update(items=len(names), pages=1)
+        elif endpoint == 'data' and request.method == 'GET':
+            body = files[path][0]
+        elif endpoint == 'data':
+            upload = request.data['file']
+            files[posixpath.join(path, upload.filename)] = (upload.value,
+                                                            time.time())
+        elif endpoint == 'oper/remove':
+            for removed in request.data[b'path']:
+                del files[removed.decode('utf8')]
+            body = {'uuid': 'remove'}
+        elif endpoint == 'sync/signature':
+            body = librsync.signature(io.BytesIO(files[path][0])).read()
+        elif endpoint == 'sync/delta':
+            body = librsync.delta(io.BytesIO(files[path][0]),
+                                  request.data['signature'].file).read()
+        elif endpoint == 'sync/patch':
+            patched = librsync.patch(io.BytesIO(files[path][0]),
+                                     request.data['delta'].file)
+            files[path] = (patched.read(), time.time())
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if isinstance(body, bytes):
+            self.send_header('Content-Type', 'application/octet-stream')
+        else:
+            self.send_header('Content-Type', 'application/json')
+            body = json.dumps(body).encode('utf8')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SyncingPlanner(planner.TransferPlanner):
+    "Syncs every file that exists at the destination."
+    def plan(self, path, size, exists=True, block_size=None):
+        plan = super(SyncingPlanner, self).plan(path, size, exists,
+                                                block_size)
+        if exists:
+            plan.update(strategy=planner.DELTA)
+        return plan
+
+
+class SyncTreeTestCase(object):
+    handler = HTTPSyncRequestHandler
+
+    def setUp(self):
+        super(SyncTreeTestCase, self).setUp()
+        self.server.files = {}
+        self.root = tempfile.mkdtemp()
+        self.sync = sync.SyncClient(self.client, planner=SyncingPlanner())
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(SyncTreeTestCase, self).tearDown()
+
+    def local(self, relpath):
+        return os.path.join(self.root, *relpath.split('/'))
+
+    def write(self, relpath, data):
+        transfer.makedirs(os.path.dirname(self.local(relpath)))
+        with open(self.local(relpath), 'wb') as f:
+            f.write(data)
+
+    def read(self, relpath):
+        with open(self.local(relpath), 'rb') as f:
+            return f.read()
+
+    def requested(self, endpoint):
+        "The paths requested from an endpoint."
+        prefix = '/api/%s/%s' % (self.client.version, endpoint)
+        return sorted(r.path[len(prefix):-1] for r in self.server.requests
+                      if r.path.startswith(prefix))
+
+    def test_upload(self):
+        self.write('a.txt', b'aaa')
+        self.write('sub/b.txt', b'new b')
+        self.write('sub/c.txt', b'c')
+        old = time.time() - 3600
+        # Older than the remote copy.
+        os.utime(self.local('sub/c.txt'), (old - 60, old - 60))
+        self.server.files.update({'/dst/sub/b.txt': (b'b', old),
+                                  '/dst/sub/c.txt': (b'c', old),
+                                  '/dst/d.txt': (b'd', old)})
+        results = self.sync.sync_tree(self.root, '/dst', delete=True)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(sorted((r.remote, r.result is not False)
+                                for r in results),
+                         [('/dst/a.txt', True), ('/dst/d.txt', True),
+                          ('/dst/sub/b.txt', True), ('/dst/sub/c.txt', False)])
+        self.assertEqual(dict((path, data) for path, (data, mtime)
+                              in self.server.files.items()),
+                         {'/dst/a.txt': b'aaa', '/dst/sub/b.txt': b'new b',
+                          '/dst/sub/c.txt': b'c'})
+        # Only the changed file was synced.
+        self.assertEqual(self.requested('path/sync/patch'), ['/dst/sub/b.txt'])
+        # Everything is current now.
+        del self.server.requests[:]
+        results = self.sync.sync_tree(self.root, '/dst', delete=True)
+        self.assertEqual([r.result for r in results], [False] * 3)
+        self.assertEqual([r.method for r in self.server.requests],
+                         ['GET'] * 2)
+
+    def test_download(self):
+        mtime = time.time() - 3600
+        self.server.files.update({'/src/a.txt': (b'aaa', mtime),
+                                  '/src/sub/b.txt': (b'new b', mtime)})
+        self.write('sub/b.txt', b'b')
+        self.write('sub/c.txt', b'c')
+        results = self.sync.sync_tree(self.root, '/src', sync.DOWNLOAD,
+                                      delete=True)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(sorted(os.listdir(self.root)), ['a.txt', 'sub'])
+        self.assertEqual(os.listdir(self.local('sub')), ['b.txt'])
+        self.assertEqual(self.read('sub/b.txt'), b'new b')
+        self.assertEqual(int(os.path.getmtime(self.local('sub/b.txt'))),
+                         int(mtime))
+        self.assertEqual(self.requested('path/sync/delta'), ['/src/sub/b.txt'])
+        # The size of the changed file is known from the listing.
+        self.assertEqual(self.requested('path/info'), ['/src', '/src/sub'])
+        results = self.sync.sync_tree(self.root, '/src', sync.DOWNLOAD)
+        self.assertEqual([r.result for r in results], [False] * 2)
+
+    def test_signature_cached(self):
+        cache = SignatureCache(os.path.join(self.root, 'cache'))
+        self.sync.signature_cache = cache
+        local = self.local('a.txt')
+        self.write('a.txt', b'a')
+        for data in (b'aa', b'aaa'):
+            self.server.files['/src/a.txt'] = (data, time.time())
+            self.sync.download(local, '/src/a.txt')
+            self.assertEqual(self.read('a.txt'), data)
+        # The second sync used the signature cached after the first.
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(self.requested('path/sync/delta'),
+                         ['/src/a.txt'] * 2)
+        # As does a sync_tree, which sets the remote mtime.
+        self.server.files['/src/a.txt'] = (b'aaaa', time.time() - 3600)
+        self.sync.sync_tree(self.root, '/src', sync.DOWNLOAD)
+        self.assertEqual(self.read('a.txt'), b'aaaa')
+        self.assertEqual(cache.hits, 2)
+
+    def test_upload_new_folder(self):
+        self.write('a.txt', b'aaa')
+        results = self.sync.sync_tree(self.root, '/new')
+        self.assertEqual([(r.remote, r.ok) for r in results],
+                         [('/new/a.txt', True)])
+        self.assertEqual(self.server.files['/new/a.txt'][0], b'aaa')
+
+
+class BasicSyncTreeTestCase(SyncTreeTestCase, BasicTestCase):
+    pass
+
+
+class RemoteFileTestCase(unittest.TestCase):
+    def respond(self, request):
+        self.requests.append(request)
+        if request.path_url.startswith('/api/2/path/info/'):
+            return 404, {'Content-Type': 'application/json'}, \
+                b'{"detail": "Not found."}'
+        return 200, {'Content-Type': 'application/json'}, b'{}'
+
+    def setUp(self):
+        self.requests = []
+        self.client = BasicClient(API_KEY, API_PASSWORD,
+                                  url='http://127.0.0.1/',
+                                  transport=MockTransport(self.respond))
+
+    def test_missing(self):
+        remote = sync.RemoteFile('/foo.txt', self.client)
+        self.assertIsNone(remote.size())
+        self.assertIsNone(remote.size())
+        self.assertEqual(len(self.requests), 1)
+
+    def test_upload_missing(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'foo')
+            f.flush()
+            sync.SyncClient(self.client).upload(f.name, '/foo.txt')
+        # The file was looked up once, then sent whole.
+        self.assertEqual([r.path_url for r in self.requests],
+                         ['/api/2/path/info/foo.txt/', '/api/2/path/data/'])
+
+
+class TransferRunTestCase(unittest.TestCase):
+    def test_errors(self):
+        def call(remote, local):
+            if remote == 'fail':
+                raise ValueError(remote)
+            return local
+        results = transfer.run(call, [('fail', 1), ('ok', 2)], 2)
+        self.assertIsInstance(results[0].error, ValueError)
+        self.assertEqual((results[1].ok, results[1].result), (True, 2))
+
+
+class TransferPlannerTestCase(unittest.TestCase):
+    MB = 1024 * 1024
+
+    def setUp(self):
+        self.audit = io.StringIO()
+        self.planner = planner.TransferPlanner(rtt=0.1, bandwidth=self.MB,
+                                               audit=self.audit)
+
+    def test_missing(self):
+        plan = self.planner.plan('/foo', 10 * self.MB, exists=False)
+        self.assertEqual(plan.strategy, planner.WHOLE)
+        self.assertEqual(plan['reason'], 'destination missing')
+
+    def test_small(self):
+        plan = self.planner.plan('/foo', 1024)
+        self.assertEqual(plan.strategy, planner.WHOLE)
+        self.assertEqual(plan['reason'], 'small file')
+
+    def test_estimates(self):
+        plan = self.planner.plan('/foo', 10 * self.MB)
+        self.assertEqual(plan.strategy, planner.DELTA)
+        self.assertLess(plan['estimated_delta'], plan['estimated_whole'])
+        # On a fast network with long round trips, sending it is quicker.
+        self.planner.rtt, self.planner.bandwidth = 1, 1000 * self.MB
+        self.assertEqual(self.planner.plan('/foo', 10 * self.MB).strategy,
+                         planner.WHOLE)
+
+    def test_history(self):
+        plan = self.planner.plan('/foo', 10 * self.MB)
+        # The file changed completely, next time it is sent whole.
+        self.planner.record(plan, 10 * self.MB, 10.3, delta_size=10 * self.MB)
+        self.assertEqual(self.planner.plan('/foo', 10 * self.MB).strategy,
+                         planner.WHOLE)
+        # Other files are affected by the average only.
+        self.assertEqual(self.planner.plan('/bar', 10 * self.MB).strategy,
+                         planner.DELTA)
+
+    def test_bandwidth(self):
+        plan = self.planner.plan('/foo', 1024, exists=False)
+        self.planner.record(plan, 10 * self.MB, 1.1)
+        self.assertGreater(self.planner.bandwidth, self.MB)
+        self.planner.observe_rtt(1.1)
+        self.assertAlmostEqual(self.planner.rtt, 0.4)
+
+    def test_audit(self):
+        plan = self.planner.plan('/foo', 10 * self.MB)
+        self.planner.record(plan, self.MB, 2.0, delta_size=self.MB)
+        plan = self.planner.plan('/bar', 1024, exists=False)
+        self.planner.record(plan, 1024, 0.1)
+        lines = [json.loads(line) for line in
+                 self.audit.getvalue().splitlines()]
+        self.assertEqual([(line['path'], line['strategy'], line['sent'])
+                          for line in lines],
+                         [('/foo', 'delta', self.MB), ('/bar', 'whole', 1024)])
+        self.assertEqual(self.planner.summary(), {
+            'whole': 1, 'delta': 1, 'size': 10 * self.MB + 1024,
+            'sent': self.MB + 1024, 'saved': 9 * self.MB})
+
+
+class RecordingHooks(Hooks):
+    "Records the name and a copy of each event."
+    def __init__(self):
+        self.events = []
+
+    def __getattribute__(self, name):
+        if name in ('request_started', 'response_headers', 'body_done',
+                    'retry', 'throttle_sleep'):
+            return lambda event: self.events.append((name, dict(event)))
+        return object.__getattribute__(self, name)
+
+    def names(self):
+        return [name for name, event in self.events]
+
+
+class HooksTestCase(object):
+    handler = HTTPFlakyRequestHandler
+
+    def getClient(self, **kwargs):
+        kwargs.setdefault('retry_policy', RetryPolicy(backoff=0.01))
+        return super(HooksTestCase, self).getClient(**kwargs)
+
+    def test_events(self):
+        hooks = RecordingHooks()
+        client = self.getClient(hooks=[hooks])
+        self.assertEqual(client.get('/ping').read(), b'Hello World!')
+        self.assertEqual(hooks.names(), [
+            'request_started', 'response_headers', 'body_done', 'retry',
+            'request_started', 'response_headers', 'body_done', 'retry',
+            'request_started', 'response_headers', 'body_done'])
+        name, event = hooks.events[-1]
+        self.assertEqual(event['method'], 'get')
+        self.assertEqual(event['endpoint'], 'ping')
+        self.assertEqual(event['attempt'], 3)
+        self.assertEqual(event['status'], 200)
+        self.assertEqual(event['bytes_received'], len(b'Hello World!'))
+        self.assertLessEqual(event['headers_elapsed'], event['elapsed'])
+        name, event = hooks.events[3]
+        self.assertEqual(event['status'], 502)
+        self.assertEqual(event['error'].status_code, 502)
+        self.assertIsNotNone(event['delay'])
+
+    def test_bytes_sent(self):
+        hooks = RecordingHooks()
+        client = self.getClient(hooks=[hooks], retry_policy=RetryPolicy(
+            backoff=0.01, methods=('post',)))
+        client.upload('foo.txt', io.BytesIO(b'foo' * 1000))
+        events = [e for name, e in hooks.events if name == 'response_headers']
+        self.assertEqual(len(events), 3)
+        self.assertGreater(events[-1]['bytes_sent'], 3000)
+
+    def test_collector(self):
+        metrics = MetricsCollector()
+        client = self.getClient(hooks=[metrics])
+        client.get('/ping').read()
+        self.assertEqual(metrics.counters[
+            'responses_total', ('get', 'ping', 502)], 2)
+        self.assertEqual(metrics.counters[
+            'responses_total', ('get', 'ping', 200)], 1)
+        self.assertEqual(metrics.counters['retries_total', ('get', 'ping')],
+                         2)
+        self.assertEqual(metrics.histograms[
+            'request_seconds', ('get', 'ping')].count, 3)
+
+
+class BasicHooksTestCase(HooksTestCase, BasicTestCase):
+    pass
+
+
+class OAuthHooksTestCase(HooksTestCase, OAuthTestCase):
+    pass
+
+
+class ThrottleHooksTestCase(object):
+    handler = HTTPThrottleRequestHandler
+
+    def test_throttle_sleep(self):
+        metrics = MetricsCollector()
+        client = self.getClient(hooks=[metrics])
+        self.assertRaises(RequestError, client.get, '/ping')
+        self.assertEqual(metrics.counters[
+            'throttle_sleeps_total', ('get', 'ping')], 2)
+        self.assertAlmostEqual(metrics.counters[
+            'throttle_sleep_seconds_total', ('get', 'ping')], 0.02)
+
+    def test_rate_limiter_sleep(self):
+        hooks = RecordingHooks()
+        client = self.getClient(hooks=[hooks], rate_limiter=RateLimiter())
+        self.assertRaises(RequestError, client.get, '/ping')
+        sleeps = [e for name, e in hooks.events if name == 'throttle_sleep']
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(all(e['sleep'] > 0 for e in sleeps))
+
+
+class BasicThrottleHooksTestCase(ThrottleHooksTestCase, BasicTestCase):
+    pass
+
+
+class MetricsCollectorTestCase(unittest.TestCase):
+    def test_prometheus(self):
+        metrics = MetricsCollector(buckets=(0.1, 1))
+        event = {'method': 'get', 'endpoint': 'path/info', 'status': 200,
+                 'headers_elapsed': 0.05, 'bytes_sent': None,
+                 'elapsed': 0.5, 'bytes_received': 10}
+        metrics.response_headers(event)
+        metrics.body_done(event)
+        metrics.body_done(dict(event, elapsed=2.0, bytes_received=5))
+        text = metrics.prometheus()
+        self.assertIn('# TYPE smartfile_request_seconds histogram\n', text)
+        for line in [
+                'smartfile_request_seconds_bucket{method="get",'
+                'endpoint="path/info",le="0.1"} 0',
+                'smartfile_request_seconds_bucket{method="get",'
+                'endpoint="path/info",le="1.0"} 1',
+                'smartfile_request_seconds_bucket{method="get",'
+                'endpoint="path/info",le="+Inf"} 2',
+                'smartfile_request_seconds_sum{method="get",'
+                'endpoint="path/info"} 2.5',
+                'smartfile_request_seconds_count{method="get",'
+                'endpoint="path/info"} 2',
+                'smartfile_responses_total{method="get",'
+                'endpoint="path/info",status="200"} 1',
+                'smartfile_received_bytes_total{method="get",'
+                'endpoint="path/info"} 15']:
+            self.assertIn(line + '\n', text)
+        self.assertNotIn('smartfile_sent_bytes_total{', text)
+
+    def test_escaping(self):
+        metrics = MetricsCollector()
+        metrics.retry({'method': 'get', 'endpoint': 'a"b\\c'})
+        self.assertIn('endpoint="a\\"b\\\\c"', metrics.prometheus())
+
+
+class TransportTestCase(object):
+    "Runs client tests over the transport named by transport."
+    transport = 'urllib3'
+
+    def getClient(self, **kwargs):
+        kwargs.setdefault('transport', self.transport)
+        return super(TransportTestCase, self).getClient(**kwargs)
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        client = self.getClient(url='http://127.0.0.1:%s/' % port,
+                                retry_policy=RetryPolicy(max_attempts=1))
+        with self.assertRaises(RequestError) as cm:
+            client.get('/ping')
+        self.assertIsInstance(cm.exception.exc,
+                              requests.exceptions.ConnectionError)
+
+
+class BasicUrllib3TestCase(TransportTestCase, MethodTestCase,
+                           DownloadTestCase, UploadTestCase, BasicTestCase):
+    pass
+
+
+class OAuthUrllib3TestCase(TransportTestCase, MethodTestCase,
+                           DownloadTestCase, OAuthTestCase):
+    pass
+
+
+class Urllib3KeepAliveTestCase(TransportTestCase, KeepAliveTestCase,
+                               BasicTestCase):
+    pass
+
+
+class Urllib3HooksTestCase(TransportTestCase, HooksTestCase, BasicTestCase):
+    pass
+
+
+class Urllib3RetryTestCase(TransportTestCase, RetryTestCase, BasicTestCase):
+    pass
+
+
+@unittest.skipIf(httpx is None, 'httpx unavailable')
+class BasicHTTP2TestCase(TransportTestCase, MethodTestCase,
+                         DownloadTestCase, UploadTestCase, BasicTestCase):
+    transport = 'http2'
+
+
+@unittest.skipIf(httpx is None, 'httpx unavailable')
+class OAuthHTTP2TestCase(TransportTestCase, MethodTestCase,
+                         DownloadTestCase, OAuthTestCase):
+    transport = 'http2'
+
+
+@unittest.skipIf(httpx is None, 'httpx unavailable')
+class HTTP2HooksTestCase(TransportTestCase, HooksTestCase, BasicTestCase):
+    transport = 'http2'
+
+
+@unittest.skipIf(httpx is None, 'httpx unavailable')
+class HTTP2RetryTestCase(TransportTestCase, RetryTestCase, BasicTestCase):
+    transport = 'http2'
+
+
+class MockTransportTestCase(unittest.TestCase):
+    def respond(self, request):
+        self.requests.append(request)
+        if request.path_url.startswith('/api/2/missing/'):
+            return 404, {'Content-Type': 'application/json'}, \
+                b'{"detail": "Not found."}'
+        return 200, {'Content-Type': 'application/json'}, json.dumps(
+            {'path': request.path_url}).encode('utf8')
+
+    def setUp(self):
+        self.requests = []
+        self.client = BasicClient(API_KEY, API_PASSWORD,
+                                  url='http://127.0.0.1/',
+                                  transport=MockTransport(self.respond))
+
+    def test_json(self):
+        self.assertEqual(self.client.get('/path/info', '/foo'),
+                         {'path': '/api/2/path/info/foo/'})
+        self.assertTrue(self.requests[0].headers['Authorization'].startswith(
+            'Basic '))
+
+    def test_body(self):
+        self.client.upload('foo.txt', io.BytesIO(b'foo'))
+        self.assertIn(b'foo', self.requests[0].body)
+
+    def test_response_error(self):
+        with self.assertRaises(ResponseError) as cm:
+            self.client.get('/missing')
+        self.assertEqual(cm.exception.status_code, 404)
+
+    def test_json_consumed(self):
+        responses = []
+        request = self.client.transport.request
+        self.client.transport.request = lambda *args, **kwargs: \
+            responses.append(request(*args, **kwargs)) or responses[-1]
+        self.client.get('/path/info', '/foo')
+        self.assertRaises(ResponseError, self.client.get, '/missing')
+        for response in responses:
+            self.assertTrue(response._content_consumed)
+            self.assertTrue(response.raw.closed)
+
+    def test_hooks(self):
+        metrics = MetricsCollector()
+        self.client.hooks.append(metrics)
+        self.client.get('/path/info', '/foo')
+        self.assertEqual(metrics.counters[
+            'responses_total', ('get', 'path/info', 200)], 1)
+
+
+class HTTPCompressionRequestHandler(TestHTTPRequestHandler):
+    "Decodes compressed request bodies, gzips responses if accepted."
+    def read_body(self):
+        body = TestHTTPRequestHandler.read_body(self)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif self.headers.get('Content-Encoding') == 'deflate':
+            body = zlib.decompress(body)
+        return body
+
+    def respond(self, request):
+        if request.path.startswith('/api/2/path/data/'):
+            content_type, body = 'text/plain', b'Hello World!' * 1000
+        else:
+            content_type, body = 'application/json', json.dumps(
+                {'path': request.path, 'items': [1] * 1000}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CompressionTestCase(object):
+    handler = HTTPCompressionRequestHandler
+
+    def test_not_compressed_by_default(self):
+        self.client.upload('foo.csv', io.BytesIO(b'foo,bar\n' * 1000))
+        self.assertNotIn('Content-Encoding', self.server.requests[-1].headers)
+
+    def test_upload(self):
+        data = b'foo,bar\n' * 10000
+        compression = Compression(upload=True)
+        client = self.getClient(compression=compression)
+        client.upload('foo.csv', io.BytesIO(data))
+        request = self.server.requests[-1]
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(request.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(request.data['file'].value, data)
+        self.assertGreater(compression.sent, len(data))
+        self.assertLess(compression.sent_compressed, len(data) / 10)
+        self.assertEqual(compression.saved,
+                         compression.sent - compression.sent_compressed)
+
+    def test_upload_override(self):
+        client = self.getClient(compression=Compression(upload=True))
+        client.upload('foo.csv', io.BytesIO(b'foo'), compress=False)
+        self.assertNotIn('Content-Encoding', self.server.requests[-1].headers)
+        self.client.upload('foo.csv', io.BytesIO(b'foo'), compress=True)
+        self.assertEqual(self.server.requests[-1].headers['Content-Encoding'],
+                         'gzip')
+
+    def test_json(self):
+        compression = Compression()
+        client = self.getClient(compression=compression)
+        self.assertEqual(len(client.get('/path/info', '/foo')['items']), 1000)
+        self.assertIn('gzip',
+                      self.server.requests[-1].headers['Accept-Encoding'])
+        self.assertGreater(compression.received,
+                           compression.received_compressed)
+
+    def test_download(self):
+        compression = Compression()
+        client = self.getClient(compression=compression)
+        response = client.download('/foo', perform_download=False)
+        self.assertEqual(response.raw.read(), b'Hello World!' * 1000)
+        self.assertEqual(compression.received, 12000)
+        self.assertLess(compression.received_compressed, 1000)
+
+    def test_download_identity(self):
+        client = self.getClient(compression=True)
+        response = client.download('/foo', perform_download=False,
+                                   compress=False)
+        self.assertEqual(response.raw.read(), b'Hello World!' * 1000)
+        self.assertEqual(self.server.requests[-1].headers['Accept-Encoding'],
+                         'identity')
+        self.assertEqual(client.compression.received, 0)
+
+
+class BasicCompressionTestCase(CompressionTestCase, BasicTestCase):
+    pass
+
+
+class OAuthCompressionTestCase(CompressionTestCase, OAuthTestCase):
+    pass
+
+
+class Urllib3CompressionTestCase(TransportTestCase, CompressionTestCase,
+                                 BasicTestCase):
+    pass
+
+
+@unittest.skipIf(httpx is None, 'httpx unavailable')
+class HTTP2CompressionTestCase(TransportTestCase, CompressionTestCase,
+                               BasicTestCase):
+    transport = 'http2'
+
+
+class CompressedBodyTestCase(unittest.TestCase):
+    def test_rewind(self):
+        data = os.urandom(1000) * 200
+        body = CompressedBody(io.BytesIO(data), 'deflate')
+        compressed = body.read(1000) + body.read()
+        self.assertEqual(zlib.decompress(compressed), data)
+        body.rewind()
+        self.assertEqual(b''.join(body), compressed)
+
+    def test_not_rewindable(self):
+        class Stream(object):
+            def read(self, size):
+                return b''
+        self.assertFalse(hasattr(CompressedBody(Stream()), 'rewind'))
+
+    def test_encoding(self):
+        self.assertRaises(ValueError, Compression, upload_encoding='br')
+
+
+class HTTPConditionalRequestHandler(TestHTTPRequestHandler):
+    """Serves path info and file data of version server.version, with
+    validators unless the path contains /nocache/."""
+    def respond(self, request):
+        version = self.server.version
+        etag = '"v%s"' % version
+        if request.path.startswith('/api/2/path/data/'):
+            content_type = 'application/octet-stream'
+            body = ('data v%s\n' % version).encode('ascii') * 1000
+        else:
+            content_type = 'application/json'
+            body = json.dumps({'path': request.path,
+                               'version': version}).encode('utf8')
+        validated = '/nocache/' not in request.path
+        if validated and self.headers.get('If-None-Match') == etag:
+            self.server.statuses.append(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.server.statuses.append(200)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if validated:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified',
+                             'Sat, 23 Feb 2013 22:49:30 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTPCacheTestCase(object):
+    handler = HTTPConditionalRequestHandler
+
+    def setUp(self):
+        super(HTTPCacheTestCase, self).setUp()
+        self.server.version = 1
+        self.server.statuses = []
+        self.cache = self.getCache()
+        self.client = self.getClient(http_cache=self.cache)
+
+    def getCache(self):
+        return HTTPCache()
+
+    def test_json(self):
+        first = self.client.get('/path/info', '/foo')
+        self.assertEqual(self.client.get('/path/info', '/foo'), first)
+        self.assertEqual(self.server.statuses, [200, 304])
+        headers = self.server.requests[-1].headers
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'],
+                         'Sat, 23 Feb 2013 22:49:30 GMT')
+
+    def test_modified(self):
+        self.client.get('/path/info', '/foo')
+        self.server.version = 2
+        self.assertEqual(self.client.get('/path/info', '/foo')['version'], 2)
+        self.assertEqual(self.client.get('/path/info', '/foo')['version'], 2)
+        self.assertEqual(self.server.statuses, [200, 200, 304])
+
+    def test_params(self):
+        self.client.get('/path/info', '/foo', children=True)
+        self.client.get('/path/info', '/foo')
+        self.assertEqual(self.server.statuses, [200, 200])
+
+    def test_list_params(self):
+        self.client.get('/path/info', '/foo', fields=['name', 'size'])
+        self.client.get('/path/info', '/foo', fields=['name', 'size'])
+        self.assertEqual(self.server.statuses, [200, 304])
+
+    def test_hooks_status(self):
+        hooks = RecordingHooks()
+        client = self.getClient(http_cache=self.cache, hooks=[hooks])
+        client.get('/path/info', '/foo')
+        client.get('/path/info', '/foo')
+        self.assertEqual([event['status'] for name, event in hooks.events
+                          if name == 'response_headers'], [200, 304])
+
+    def test_download(self):
+        data = b'data v1\n' * 1000
+        response = self.client.download('/foo', perform_download=False)
+        self.assertEqual(response.raw.read(), data)
+        response = self.client.download('/foo', perform_download=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"v1"')
+        self.assertEqual(response.raw.read(), data)
+        path = os.path.join(tempfile.mkdtemp(), 'foo')
+        try:
+            self.client.download('/foo', download_to_path=path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        self.assertEqual(self.server.statuses, [200, 304, 304])
+
+    def test_partial_read(self):
+        raw = self.client.get('/path/data', '/foo')
+        raw.read(10)
+        raw.close()
+        self.client.get('/path/data', '/foo').read()
+        self.assertNotIn('If-None-Match', self.server.requests[-1].headers)
+        self.assertEqual(self.server.statuses, [200, 200])
+
+    def test_without_validators(self):
+        self.client.get('/path/info', '/nocache/foo')
+        self.client.get('/path/info', '/nocache/foo')
+        self.assertEqual(self.server.statuses, [200, 200])
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+
+class BasicHTTPCacheTestCase(HTTPCacheTestCase, BasicTestCase):
+    pass
+
+
+class OAuthHTTPCacheTestCase(HTTPCacheTestCase, OAuthTestCase):
+    pass
+
+
+class DiskHTTPCacheTestCase(HTTPCacheTestCase, BasicTestCase):
+    def getCache(self):
+        self.root = tempfile.mkdtemp()
+        return DiskHTTPCache(self.root)
+
+    def tearDown(self):
+        super(DiskHTTPCacheTestCase, self).tearDown()
+        shutil.rmtree(self.root)
+
+
+class HTTPCacheEvictionTestCase(unittest.TestCase):
+    def test_memory(self):
+        cache = HTTPCache(maxsize=10)
+        for key in 'abc':
+            cache.set(key, [('ETag', key)], b'1234')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a'))
+        headers, body = cache.get('c')
+        self.assertEqual((headers, body.read()), ([('ETag', 'c')], b'1234'))
+        cache.set('d', [], b'x' * 11)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def temporaries(self, root):
+        return [name for name in os.listdir(root) if name.startswith('.tmp')]
+
+    def test_disk(self):
+        root = tempfile.mkdtemp()
+        try:
+            cache = DiskHTTPCache(root, maxsize=1000)
+            for i, key in enumerate('abc'):
+                writer = cache.writer(key, [('ETag', key)])
+                writer.write(b'x' * 400)
+                writer.commit()
+                os.utime(cache._path(key), (i, i))
+            self.assertIsNone(cache.get('a'))
+            headers, body = cache.get('c')
+            with body:
+                self.assertEqual(headers, [('ETag', 'c')])
+                self.assertEqual(body.read(), b'x' * 400)
+            writer = cache.writer('d', [])
+            writer.write(b'x')
+            writer.abort()
+            self.assertIsNone(cache.get('d'))
+            self.assertEqual(self.temporaries(root), [])
+            # A body dropped unread leaves no file behind.
+            cache.writer('e', [])
+            self.assertEqual(self.temporaries(root), [])
+            # Nor does a process that died while writing one, once it is
+            # stale.
+            writer = cache.writer('f', [])
+            writer.write(b'x')
+            writer.output.close()
+            path = writer.output.name
+            cache.writer('g', []).commit()
+            self.assertEqual(self.temporaries(root), [os.path.basename(path)])
+            os.utime(path, (0, 0))
+            cache.writer('h', []).commit()
+            self.assertEqual(self.temporaries(root), [])
+        finally:
+            shutil.rmtree(root)
+
+
 # TODO: Test with missing oauthlib...
 # Must invoke an ImportError when smartfile tries to import it. Then the test
 # case should verify that the correct exception (NotImplementedError) is raised